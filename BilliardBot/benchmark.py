@@ -0,0 +1,797 @@
+import argparse
+import functools
+import json
+import math
+import main
+import time
+import cv2
+import numpy as np
+from main import get_processed_frame, process_frame
+from frame_context import FrameContext
+from segmentation import Segmenter
+from calibration import TableCalibration
+from scene_gate import SceneGate
+from tiling import TileExecutor
+from tracking import PoseTracker
+from robot_control import RobotClient, RobotError, MotionProgram
+from esp32_sim import ESP32Simulator
+from command_channel import CommandChannel
+import requests
+import concurrent.futures
+import os
+import tracemalloc
+from buffer_pool import BufferPool
+from image_processing import detect_backgroud_boudary, detect_pink_paper, detect_colored_spots, detect_balls
+from utility_functions import calculate_center, detect_and_draw_Y_axis, calculate_ball_measurements, measure_balls
+from synthetic import render_scene, SyntheticCapture, SYNTHETIC_TABLE_CM
+from constants import LOWER_CENTER, UPPER_CENTER, LOWER_Y_AXIS, UPPER_Y_AXIS, LOWER_BALL, UPPER_BALL, LOWER_TABLE, UPPER_TABLE, LOWER_ROBOT, UPPER_ROBOT, POOL_BALL_DIAMETER
+
+THRESHOLDS = [LOWER_BALL, UPPER_BALL, LOWER_Y_AXIS, UPPER_Y_AXIS, LOWER_CENTER, UPPER_CENTER, LOWER_TABLE, UPPER_TABLE, LOWER_ROBOT, UPPER_ROBOT]
+
+# A stage is reported as a regression when it is this much slower than the baseline
+REGRESSION_TOLERANCE = 0.25
+# Largest difference in pixels allowed between the balls of the coarse-to-fine mode and of
+# the full resolution path
+PYRAMID_TOLERANCE_PX = 1.0
+# Largest median memory allocated during a frame, in bytes, once the buffer pool is warm.
+# What is left are contours and blob statistics, which grow with the noise, not the images
+ALLOCATION_LIMIT_BYTES = 128 * 1024
+
+
+"""
+    Runs a benchmark with a scratch calibration of the synthetic table in place of
+    main.table_calibration, so that the synthetic table does not overwrite the calibration of
+    the real one, and puts the calibration of main back afterwards.
+    """
+def scratch_calibration(bench):
+    @functools.wraps(bench)
+    def run(*args, **kwargs):
+        saved = main.table_calibration
+        main.table_calibration = TableCalibration(path=None, table_size_cm=SYNTHETIC_TABLE_CM, lens=main.lens_calibration)
+        try:
+            return bench(*args, **kwargs)
+        finally:
+            main.table_calibration = saved
+    return run
+
+
+"""
+    Renders the synthetic workload: n_frames scenes with different seeds and robot poses.
+    """
+def make_workload(n_frames, width, height, n_balls, noise, lighting, seed=0):
+    rng = np.random.default_rng(seed)
+    scenes = []
+    for i in range(n_frames):
+        pose = (width / 2 + rng.uniform(-0.15, 0.15) * width, height / 2 + rng.uniform(-0.15, 0.15) * height, rng.uniform(-180, 180))
+        scenes.append(render_scene(width, height, n_balls=n_balls, robot_pose=pose, noise=noise, lighting=lighting, seed=seed + i))
+    return scenes
+
+
+"""
+    Returns the mean, p50, p90 and p99 of a list of latencies in milliseconds.
+    """
+def summarize(samples):
+    samples = np.asarray(samples) * 1000
+    return {
+        "mean": float(samples.mean()),
+        "p50": float(np.percentile(samples, 50)),
+        "p90": float(np.percentile(samples, 90)),
+        "p99": float(np.percentile(samples, 99)),
+    }
+
+
+"""
+    Times every stage of the pipeline separately on each frame of the workload, in the
+    same order and with the same inputs as main.process_frame, in headless mode.
+    Stages that cannot run on a frame (e.g. no paper found) are skipped for that frame.
+
+    Returns:
+    dict: Latency samples in seconds for each stage.
+    """
+def bench_stages(scenes, repeat):
+    segmenter = Segmenter()
+    segmenter.update(THRESHOLDS)
+    samples = {name: [] for name in ["context", "detect_backgroud_boudary", "detect_pink_paper",
+                                     "detect_colored_spots", "detect_balls", "calculate_ball_measurements"]}
+
+    def timed(name, function, *args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        samples[name].append(time.perf_counter() - start)
+        return result
+
+    for _ in range(repeat):
+        for frame, _ in scenes:
+            ctx = timed("context", FrameContext, frame, segmenter, False)
+            table_contour = timed("detect_backgroud_boudary", detect_backgroud_boudary, ctx, (LOWER_TABLE, UPPER_TABLE))
+            if table_contour is None:
+                continue
+            table_mask = np.zeros_like(frame[:, :, 0])
+            cv2.drawContours(table_mask, [table_contour], -1, 255, -1)
+            table_roi = cv2.boundingRect(table_contour)
+
+            paper = timed("detect_pink_paper", detect_pink_paper, ctx, table_mask, (LOWER_ROBOT, UPPER_ROBOT), roi=table_roi)
+            if paper is None:
+                continue
+            paper_mask = np.zeros_like(frame[:, :, 0])
+            cv2.drawContours(paper_mask, [paper], 0, 255, -1)
+            paper_roi = cv2.boundingRect(paper)
+            center_spot = timed("detect_colored_spots", detect_colored_spots, ctx, (LOWER_CENTER, UPPER_CENTER), paper_mask, roi=paper_roi)
+            origin = calculate_center(center_spot[0]) if center_spot else None
+            y_direction = detect_and_draw_Y_axis(ctx, (LOWER_Y_AXIS, UPPER_Y_AXIS), paper_mask, origin, roi=paper_roi)
+            if origin is None or y_direction is None:
+                continue
+
+            balls = timed("detect_balls", detect_balls, ctx, table_mask, (LOWER_BALL, UPPER_BALL), roi=table_roi)
+            timed("calculate_ball_measurements", calculate_ball_measurements, balls, origin, y_direction)
+    return samples
+
+
+"""
+    Times main.process_frame end to end in headless mode, with the table cache of main
+    working as it does on a live camera. The scenes are unrelated, so ball tracking is off.
+    """
+@scratch_calibration
+def bench_pipeline(scenes, repeat):
+    samples = []
+    for _ in range(repeat):
+        for frame, _ in scenes:
+            start = time.perf_counter()
+            process_frame(frame, THRESHOLDS, render=False, track=False)
+            samples.append(time.perf_counter() - start)
+    return samples
+
+
+"""
+    Compares the pipeline output with the ground truth of the scenes.
+
+    Returns:
+    dict: Fraction of frames with measurements, mean/max ball center error in pixels and
+          mean/max error of the X, Y position of the balls in centimeters.
+    """
+@scratch_calibration
+def check_accuracy(scenes):
+    errors = []
+    position_errors = []
+    measured_frames = 0
+    for frame, truth in scenes:
+        _, measurements, _ = process_frame(frame, THRESHOLDS, render=False, track=False)
+        if not measurements:
+            continue
+        measured_frames += 1
+        for center, measurement in zip(measurements.centers().tolist(), measurements):
+            distances = [math.dist(center, true_center) for true_center, _ in truth["balls"]]
+            nearest = int(np.argmin(distances))
+            errors.append(distances[nearest])
+            _, _, X, Y = truth["measurements"][nearest]
+            position_errors.append(math.hypot(measurement["X"] - X, measurement["Y"] - Y))
+    return {
+        "measured_frames": measured_frames / len(scenes),
+        "mean_center_error_px": float(np.mean(errors)) if errors else None,
+        "max_center_error_px": float(np.max(errors)) if errors else None,
+        "mean_position_error_cm": float(np.mean(position_errors)) if position_errors else None,
+        "max_position_error_cm": float(np.max(position_errors)) if position_errors else None,
+    }
+
+
+def print_report(results, baseline=None):
+    print(f"{'stage':<30}{'mean':>9}{'p50':>9}{'p90':>9}{'p99':>9}   (ms)")
+    regressions = []
+    for name, stats in results["latency"].items():
+        line = f"{name:<30}" + "".join(f"{stats[key]:>9.3f}" for key in ("mean", "p50", "p90", "p99"))
+        if baseline is not None and name in baseline["latency"]:
+            ratio = stats["p50"] / baseline["latency"][name]["p50"]
+            line += f"   {ratio:.2f}x baseline p50"
+            if ratio > 1 + REGRESSION_TOLERANCE:
+                regressions.append(name)
+                line += "  <-- slower"
+        print(line)
+    print(f"pipeline fps (p50): {1000 / results['latency']['pipeline']['p50']:.1f}")
+    for key, value in results["accuracy"].items():
+        print(f"{key}: {value}")
+    return regressions
+
+
+"""
+    Compares the two detect_balls backends on a busy table: n_balls balls and many ball
+    colored speckles on the table, so the mask has lots of small noise blobs.
+    """
+def bench_ball_backends(n_frames, n_balls=16, speckles=3000):
+    segmenter = Segmenter()
+    segmenter.update(THRESHOLDS)
+    cases = []
+    for i in range(n_frames):
+        frame, truth = render_scene(n_balls=n_balls, speckles=speckles, noise=4.0, seed=i)
+        table_mask = np.zeros(frame.shape[:2], np.uint8)
+        cv2.fillPoly(table_mask, [truth["table_corners"]], 255)
+        ctx = FrameContext(frame, segmenter, False)
+        ctx.mask((LOWER_BALL, UPPER_BALL))  # segmentation is not part of this comparison
+        cases.append((ctx, table_mask, len(truth["balls"])))
+
+    for backend in ("contours", "components"):
+        samples = []
+        found = 0
+        for ctx, table_mask, _ in cases:
+            start = time.perf_counter()
+            balls = detect_balls(ctx, table_mask, (LOWER_BALL, UPPER_BALL), backend=backend)
+            samples.append(time.perf_counter() - start)
+            found += len(balls)
+        stats = summarize(samples)
+        print(f"{backend:<12} p50 {stats['p50']:.3f} ms  p99 {stats['p99']:.3f} ms  balls found {found}/{sum(case[2] for case in cases)}")
+
+
+"""
+    Checks that the pose tracker starts a new track after a dropout longer than max_coast,
+    instead of blending the measurement with a stale prediction and inventing a rate.
+    """
+def check_pose_reacquire(dropout=30):
+    tracker = PoseTracker()
+    tracker.update((100, 100), (0, -50))
+    for _ in range(dropout):
+        tracker.coast()
+    tracker.update((400, 100), (0, -50))
+    assert np.allclose(tracker.pose[:2], (400, 100)) and not tracker.rate.any(), (tracker.pose, tracker.rate)
+    assert np.allclose(tracker.predict()[:2], (400, 100)), tracker.predict()
+    print(f"pose after a {dropout} frame dropout: new track at the measurement")
+
+
+"""
+    Plays a sequence where the robot drives and turns across the table and its markers are
+    hidden on some frames, with and without the pose tracker. Reports the fraction of
+    frames with measurements and the pose error against the ground truth.
+
+    Parameters:
+    n_frames (int): Length of the sequence.
+    dropout_every (int): The markers are hidden for dropout_length frames every dropout_every frames.
+    dropout_length (int): Length of each dropout in frames.
+    """
+@scratch_calibration
+def bench_pose_dropouts(n_frames, dropout_every=10, dropout_length=2):
+    scenes = []
+    for i in range(n_frames):
+        pose = (300 + 200 * i / n_frames, 350 + 100 * math.sin(i / 8), 4.0 * i)
+        visible = i % dropout_every >= dropout_length
+        scenes.append(render_scene(robot_pose=pose, markers=visible, noise=4.0, seed=0))
+
+    for track in (False, True):
+        main.pose_tracker.reset()
+        measured = 0
+        errors = []
+        for frame, truth in scenes:
+            _, measurements, _ = process_frame(frame, THRESHOLDS, render=False, track=track)
+            if measurements is None:
+                continue
+            measured += 1
+            origin, _ = main.pose_tracker.origin_and_y_direction() if track else (None, None)
+            if origin is not None:
+                errors.append(math.dist(origin, truth["origin"]))
+        line = f"pose tracking {'on ' if track else 'off'}  frames with measurements {measured / n_frames:.0%}"
+        if errors:
+            line += f"  origin error mean {np.mean(errors):.1f} px, max {np.max(errors):.1f} px"
+        print(line)
+
+
+"""
+    The per-ball loop calculate_ball_measurements used before measure_balls, kept here as
+    the reference of bench_measurements.
+    """
+def loop_ball_measurements(balls, origin, y_direction, ball_diameter_cm=POOL_BALL_DIAMETER):
+    ball_data = []
+    y_length = math.sqrt(y_direction[0]**2 + y_direction[1]**2)
+    for center, radius in balls:
+        ball_vector = (center[0] - origin[0], center[1] - origin[1])
+        distance_pixels = math.sqrt(ball_vector[0]**2 + ball_vector[1]**2)
+        pixel_to_cm_ratio = ball_diameter_cm / (2 * radius)
+        angle = math.acos((ball_vector[0]*y_direction[0] + ball_vector[1]*y_direction[1]) / (distance_pixels * y_length))
+        angle_degrees = math.degrees(angle)
+        if y_direction[0] * ball_vector[1] - y_direction[1] * ball_vector[0] < 0:
+            angle_degrees = -angle_degrees
+        dirX = distance_pixels * pixel_to_cm_ratio * math.sin(angle)
+        dirY = distance_pixels * pixel_to_cm_ratio * math.cos(angle)
+        dirX = -dirX if angle_degrees < 0 else dirX
+        ball_data.append((center, radius, distance_pixels * pixel_to_cm_ratio, angle_degrees, dirX, dirY))
+    return ball_data
+
+
+"""
+    Compares the per-ball loop with measure_balls for growing numbers of balls, on n_frames
+    random frames each, as in an offline replay.
+    """
+def bench_measurements(n_frames):
+    rng = np.random.default_rng(0)
+    origin, y_direction = (400, 400), (12, -38)
+    for n_balls in (5, 16, 100, 1000):
+        frames = [np.column_stack([rng.integers(0, 800, n_balls), rng.integers(0, 800, n_balls), rng.integers(10, 16, n_balls)])
+                  for _ in range(n_frames)]
+        ball_lists = [[((int(x), int(y)), int(r)) for x, y, r in frame] for frame in frames]
+
+        start = time.perf_counter()
+        for balls in ball_lists:
+            loop_ball_measurements(balls, origin, y_direction)
+        loop_time = (time.perf_counter() - start) / n_frames
+        start = time.perf_counter()
+        for balls in frames:
+            measure_balls(balls, origin, y_direction)
+        array_time = (time.perf_counter() - start) / n_frames
+        print(f"{n_balls:>5} balls  loop {1e6 * loop_time:9.1f} us  measure_balls {1e6 * array_time:7.1f} us  {loop_time / array_time:6.1f}x")
+
+
+"""
+    Runs the workload at full resolution and in the coarse-to-fine mode of process_frame,
+    and compares the balls found: every ball of one path must have a ball of the other
+    within tolerance pixels, with a radius within tolerance pixels.
+
+    Parameters:
+    scenes (list): The workload.
+    levels (int): Pyramid levels of the coarse-to-fine mode.
+    tolerance (float): Largest allowed difference in pixels.
+
+    Returns:
+    bool: True if the coarse-to-fine mode is within the tolerance on every frame measured by both.
+    """
+@scratch_calibration
+def bench_pyramid(scenes, levels, tolerance=PYRAMID_TOLERANCE_PX):
+    results = {}
+    for pyramid in (0, levels):
+        main.table_model = main.TableModel()
+        process_frame(scenes[0][0], THRESHOLDS, render=False, track=False, pyramid=pyramid)  # warm up
+        samples = []
+        outputs = []
+        for frame, _ in scenes:
+            start = time.perf_counter()
+            _, measurements, _ = process_frame(frame, THRESHOLDS, render=False, track=False, pyramid=pyramid)
+            samples.append(time.perf_counter() - start)
+            outputs.append(measurements)
+        results[pyramid] = (summarize(samples), outputs)
+
+    worst = 0.0
+    compared = 0
+    for full, coarse in zip(results[0][1], results[levels][1]):
+        if full is None or coarse is None:
+            continue
+        compared += 1
+        for a, b in ((full, coarse), (coarse, full)):
+            if len(a) and not len(b):
+                worst = math.inf
+            for record in a.records if len(b) else []:
+                distances = np.hypot(b["x"] - record["x"], b["y"] - record["y"])
+                nearest = int(np.argmin(distances))
+                worst = max(worst, float(distances[nearest]), abs(float(b["radius"][nearest] - record["radius"])))
+
+    for pyramid in (0, levels):
+        stats, outputs = results[pyramid]
+        measured = sum(output is not None for output in outputs) / len(outputs)
+        print(f"pyramid {pyramid}  p50 {stats['p50']:.3f} ms  p99 {stats['p99']:.3f} ms  measured frames {measured:.2f}")
+    print(f"speedup (p50): {results[0][0]['p50'] / results[levels][0]['p50']:.2f}x")
+    print(f"largest ball difference on {compared} frames: {worst:.2f} px (tolerance {tolerance} px)")
+    return worst <= tolerance
+
+
+"""
+    Measures with tracemalloc the memory allocated by process_frame during each frame
+    (peak above the memory in use before the frame), with and without the buffer pool of
+    main. NumPy reports its allocations to tracemalloc, including the arrays OpenCV returns.
+    The frames that detect the table again still allocate its new mask, hence the median.
+
+    With the pool the steady state must stay below limit, and no buffer may be allocated
+    after the warm up: the default run of the benchmark fails otherwise.
+
+    Parameters:
+    scenes (list): The workload.
+    pyramid (int): Pyramid levels of process_frame.
+    limit (int): Largest allowed median in bytes with the pool.
+    compare (bool): Also measure without the pool, for comparison.
+
+    Returns:
+    list: The failed conditions, empty if the pool holds them.
+    """
+@scratch_calibration
+def bench_allocations(scenes, pyramid=0, limit=ALLOCATION_LIMIT_BYTES, compare=True):
+    pool = main.frame_buffers
+    medians = {}
+    failures = []
+    runs = (("no pool", None), ("pool", BufferPool())) if compare else (("pool", BufferPool()),)
+    for name, buffers in runs:
+        main.frame_buffers = buffers
+        main.table_model = main.TableModel()
+        for frame, _ in scenes[:3]:
+            process_frame(frame, THRESHOLDS, render=False, pyramid=pyramid)  # warm up
+        allocations = buffers.allocations if buffers is not None else 0
+        tracemalloc.start()
+        samples = []
+        for frame, _ in scenes:
+            in_use = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            process_frame(frame, THRESHOLDS, render=False, pyramid=pyramid)
+            samples.append(tracemalloc.get_traced_memory()[1] - in_use)
+        tracemalloc.stop()
+        medians[name] = float(np.median(samples))
+        new_buffers = buffers.allocations - allocations if buffers is not None else 0
+        print(f"{name:8} allocated per frame: median {medians[name] / 1024:9.1f} KB  max {max(samples) / 1024:9.1f} KB  "
+              f"new buffers after warm up {new_buffers}")
+        if buffers is not None and new_buffers:
+            failures.append(f"{new_buffers} buffers allocated after the warm up")
+    main.frame_buffers = pool
+    print(f"limit {limit / 1024:.1f} KB")
+    if medians["pool"] > limit:
+        failures.append(f"median allocation per frame {medians['pool'] / 1024:.1f} KB above {limit / 1024:.1f} KB")
+    return failures
+
+
+"""
+    Times the whole frame stages (blur, HSV, labels, table mask and its morphology) on one
+    thread and in tiles on n_threads threads, at 1080p and 4K, and checks that the tiled
+    masks are identical.
+    """
+def bench_tiles(n_frames, n_threads):
+    segmenter = Segmenter()
+    segmenter.update(THRESHOLDS)
+    opencv_threads = cv2.getNumThreads()
+    executor = TileExecutor(n_threads, min_pixels=0)
+    print(f"{os.cpu_count()} cores, {n_threads} tiles, OpenCV on its own uses {opencv_threads} threads")
+
+    def run(frame, tiles):
+        ctx = FrameContext(frame, segmenter, False, executor=executor if tiles else None)
+        return ctx, detect_backgroud_boudary(ctx, (LOWER_TABLE, UPPER_TABLE))
+
+    for width, height in ((1920, 1080), (3840, 2160)):
+        frames = [render_scene(width, height, n_balls=8, noise=4.0, seed=i)[0] for i in range(n_frames)]
+        single, tiled = run(frames[0], False), run(frames[0], True)
+        identical = np.array_equal(single[0].labels, tiled[0].labels) and np.array_equal(single[1], tiled[1])
+        times = {}
+        # No tiles with one OpenCV thread, no tiles with the threads of OpenCV, tiles (which
+        # set OpenCV to one thread themselves)
+        for name, tiles, threads in (("one thread", False, 1), ("opencv", False, opencv_threads), ("tiles", True, opencv_threads)):
+            cv2.setNumThreads(threads)
+            samples = []
+            for frame in frames:
+                start = time.perf_counter()
+                run(frame, tiles)
+                samples.append(time.perf_counter() - start)
+            times[name] = summarize(samples)["p50"]
+        cv2.setNumThreads(opencv_threads)
+        print(f"{width}x{height}  one thread {times['one thread']:.2f} ms  OpenCV threads {times['opencv']:.2f} ms  "
+              f"tiles {times['tiles']:.2f} ms  speedup {times['one thread'] / times['tiles']:.2f}x  identical {identical}")
+    executor.close()
+
+
+"""
+    Measures the round trip of status and control requests to the ESP32 simulator with a
+    bare requests.get per request (a new connection every time, as before RobotClient) and
+    with RobotClient (one kept alive connection), without and with connect_latency added to
+    every new connection, like the TCP handshake over WiFi. Then stalls the simulator and
+    measures how long a request of each takes to give up.
+    """
+def bench_robot(n_requests, connect_latency=0.005):
+    params = {"stepsX": 10, "speedX": 1500, "stepsY": 10, "speedY": 1500, "stepsZ": 10, "speedZ": 1500}
+    for setup in (0.0, connect_latency):
+        with ESP32Simulator(connect_latency=setup, time_scale=0.0) as simulator, RobotClient(simulator.address) as client:
+            url = f"http://{simulator.address}"
+            for name, send in (("requests.get", lambda endpoint, params: requests.get(f"{url}/{endpoint}", params=params).text),
+                               ("RobotClient", lambda endpoint, params: client.request(endpoint, params))):
+                connections = simulator.connections
+                samples = []
+                for i in range(n_requests):
+                    endpoint = "control" if i % 2 else "status"
+                    start = time.perf_counter()
+                    send(endpoint, params if endpoint == "control" else None)
+                    samples.append(time.perf_counter() - start)
+                stats = summarize(samples)
+                print(f"connect latency {1000 * setup:4.1f} ms  {name:12}  p50 {stats['p50']:7.3f} ms  p99 {stats['p99']:7.3f} ms  "
+                      f"connections {simulator.connections - connections}")
+
+    with ESP32Simulator() as simulator, RobotClient(simulator.address, deadline=1.0) as client:
+        simulator.stall(3.0)
+        start = time.perf_counter()
+        try:
+            client.status()
+            outcome = f"answered, {client.retries} retries"
+        except RobotError as e:
+            outcome = str(e)
+        print(f"stalled status: {time.perf_counter() - start:.2f} s ({outcome}), requests.get waits for the whole stall")
+        simulator.stall(3.0)
+        start = time.perf_counter()
+        try:
+            client.control(**params)
+            outcome = "answered"
+        except RobotError as e:
+            outcome = str(e)
+        print(f"stalled control: {time.perf_counter() - start:.2f} s ({outcome}), not retried")
+
+
+"""
+    Measures the dead time between the end of a move on the ESP32 simulator and the moment
+    the client sees it, and the number of requests per move, when polling /status every
+    0.5 s (the old check_movement_complete), every 0.05 s and with the /wait long poll.
+    """
+def bench_completion(n_moves):
+    rng = np.random.default_rng(0)
+    durations = rng.uniform(0.1, 0.6, n_moves)
+    for name, long_poll, poll_interval in (("poll 0.5 s", False, 0.5), ("poll 0.05 s", False, 0.05), ("long poll", True, 0.5)):
+        with ESP32Simulator(long_poll=long_poll) as simulator, RobotClient(simulator.address) as client:
+            dead_times = []
+            requests_before = client.requests
+            for duration in durations:
+                client.control(int(1500 * duration), 1500, 0, 1500, 0, 1500)
+                client.wait_for_movement(poll_interval=poll_interval)
+                dead_times.append(time.monotonic() - simulator.moving_until)
+            stats = summarize(dead_times)
+            per_move = (client.requests - requests_before) / n_moves - 1
+            print(f"{name:12} dead time p50 {stats['p50']:7.1f} ms  p99 {stats['p99']:7.1f} ms  status requests per move {per_move:.1f}")
+
+
+"""
+    Sends rotation + translation pairs through a CommandChannel to the ESP32 simulator, and
+    measures the idle time between the end of the rotation and the start of the
+    translation (main.py used to wait a fixed 2 s). Then measures how long a strike waits
+    when it preempts a running jog.
+    """
+def bench_channel(n_pairs):
+    with ESP32Simulator() as simulator, RobotClient(simulator.address) as client:
+        channel = CommandChannel(client, poll_interval=0.01)
+        gaps = []
+        for i in range(n_pairs):
+            steps = 150 + 150 * (i % 4)  # 0.1 to 0.4 s at 1500 steps/s
+            channel.move(steps, 1500, steps, 1500, steps, 1500).result()
+            rotation_end = simulator.moving_until
+            channel.move(150, 1500, 0, 1500, -150, 1500).result()
+            gaps.append(simulator.moving_until - 0.1 - rotation_end)
+        stats = summarize(gaps)
+        print(f"rotation to translation gap: p50 {stats['p50']:.1f} ms  p99 {stats['p99']:.1f} ms  (fixed sleep: 1600 to 1900 ms)")
+
+        waits = []
+        for _ in range(n_pairs):
+            jog = channel.jog(15000, 1500, 0, 1500, 0, 1500)
+            time.sleep(0.05)
+            start = time.perf_counter()
+            channel.strike(100).result()
+            waits.append(time.perf_counter() - start)
+            assert jog.cancelled() or isinstance(jog.exception(), concurrent.futures.CancelledError)
+        stats = summarize(waits)
+        print(f"strike during a 10 s jog: done after p50 {stats['p50']:.1f} ms  p99 {stats['p99']:.1f} ms  preemptions {channel.preemptions}")
+        channel.close()
+
+
+"""
+    Sends jog commands back to back to the ESP32 simulator over HTTP and with the binary UDP
+    protocol, and reports the commands per second, the latency of a command, and how many
+    commands the simulator executed (a retransmitted command must not run twice). The UDP
+    protocol is also measured with loss of the datagrams dropped at random.
+    """
+def bench_udp(n_commands, loss=0.1):
+    for name, transport, udp_loss in (("http", "http", 0.0), ("udp", "udp", 0.0), (f"udp {loss:.0%} loss", "udp", loss)):
+        # Every lost datagram costs a retransmit timeout
+        count = n_commands // 4 if udp_loss else n_commands
+        with ESP32Simulator(udp_port=0, loss=udp_loss) as simulator, RobotClient(simulator.address, transport=transport, udp_port=simulator.udp_port) as client:
+            client.status()
+            latencies = []
+            start = time.perf_counter()
+            for i in range(count):
+                sent = time.perf_counter()
+                client.control(10 + i % 10, 1500, 0, 1500, -10 - i % 10, 1500)
+                latencies.append(time.perf_counter() - sent)
+            elapsed = time.perf_counter() - start
+            stats = summarize(latencies)
+            executed = sum(1 for command in simulator.commands if command[0] == "control")
+            retransmits = client.udp.retransmits if client.udp is not None else client.retries
+            print(f"{name:14} {count / elapsed:7.0f} commands/s  p50 {stats['p50']:6.2f} ms  p99 {stats['p99']:6.2f} ms  "
+                  f"executed {executed}/{count}  retransmits {retransmits}  duplicates {simulator.duplicates}")
+
+
+"""
+    Runs shots (rotation, translation, strike) on the ESP32 simulator with latency seconds
+    per answer, like the WiFi round trip, and measures the time each shot takes on top of
+    its moves and the number of requests: three commands through the CommandChannel, one
+    MotionProgram, and the same program on a firmware without /program (one request per
+    segment).
+    """
+def bench_program(n_shots, latency=0.02):
+    # The simulator reads back exactly what was sent, large step counts and fractional
+    # speeds included
+    program = MotionProgram().move(1234567, 1500.25, -7654321, 0.1, 0, 2000).strike(1500)
+    with ESP32Simulator() as simulator:
+        parsed = simulator._parse_program(program.encode())
+    assert parsed == [(kind, list(values)) for kind, values in program.segments], (program.encode(), parsed)
+
+    for name, programs in (("3 commands", None), ("program", True), ("no /program", False)):
+        with ESP32Simulator(latency=latency, programs=bool(programs)) as simulator, RobotClient(simulator.address) as client:
+            channel = CommandChannel(client, poll_interval=0.01)
+            overheads = []
+            requests_before = client.requests
+            for i in range(n_shots):
+                steps = 150 + 150 * (i % 4)  # 0.1 to 0.4 s at 1500 steps/s
+                start = time.perf_counter()
+                if programs is None:
+                    channel.move(steps, 1500, steps, 1500, steps, 1500)
+                    # A strike goes before the queued moves, it can only be sent after them
+                    channel.move(300, 1500, 0, 1500, -300, 1500).result()
+                    channel.strike(100).result()
+                else:
+                    program = MotionProgram().rotation(steps, 1500).translation(300, 1500).strike(100)
+                    channel.program(program).result()
+                overheads.append(time.perf_counter() - start - (steps + 300) / 1500)
+            channel.close()
+            stats = summarize(overheads)
+            per_shot = (client.requests - requests_before) / n_shots
+            print(f"{name:12} overhead per shot p50 {stats['p50']:6.1f} ms  p99 {stats['p99']:6.1f} ms  requests per shot {per_shot:.1f}")
+
+
+"""
+    Plays a sequence that is static most of the time, with camera noise on every frame, and
+    the robot turning for a few frames every now and then, with and without the static
+    scene gate of get_processed_frame. Reports the fps, the gate metrics and how many
+    frames reused measurements that no longer matched the scene.
+
+    Parameters:
+    n_frames (int): Length of the sequence.
+    move_every (int): The robot moves for move_length frames every move_every frames.
+    move_length (int): Length of each movement in frames.
+    """
+@scratch_calibration
+def bench_static_gating(n_frames, move_every=60, move_length=5):
+    rng = np.random.default_rng(0)
+    base = {}
+    frames = []
+    heading = 0.0
+    for i in range(n_frames):
+        if i % move_every >= move_every - move_length:
+            heading += 6.0
+        if heading not in base:
+            base[heading] = render_scene(robot_pose=(400, 400, heading), seed=0)[0]
+        noisy = np.clip(base[heading] + rng.normal(0, 3.0, base[heading].shape), 0, 255).astype(np.uint8)
+        frames.append((noisy, heading))
+
+    class Replay:
+        def __init__(self):
+            self.index = 0
+
+        def read(self):
+            frame = frames[self.index][0]
+            self.index += 1
+            return True, frame
+
+    for skip_static in (False, True):
+        main.scene_gate = SceneGate()
+        main.pose_tracker.reset()
+        cap = Replay()
+        stale = 0
+        reference = None
+        start = time.perf_counter()
+        for i in range(n_frames):
+            _, measurements = get_processed_frame(cap, THRESHOLDS, render=False, skip_static=skip_static)
+            if measurements is not None and measurements.frame_id == reference:
+                # Reused: stale if the robot turned since the processed frame
+                stale += frames[i][1] != frames[processed_at][1]
+            elif measurements is not None:
+                reference, processed_at = measurements.frame_id, i
+        fps = n_frames / (time.perf_counter() - start)
+        print(f"static gate {'on ' if skip_static else 'off'}  {fps:6.1f} fps  stale frames {stale}")
+        if skip_static:
+            print("  " + ", ".join(f"{key} {value:.3f}" if isinstance(value, float) else f"{key} {value}"
+                                   for key, value in main.scene_gate.metrics().items()))
+
+
+"""
+    Times get_processed_frame on a static scene, then again with the four extra HSV
+    conversions the detectors used to do on their own (the previous behaviour).
+    """
+@scratch_calibration
+def bench_shared_hsv(n_frames):
+    cap = SyntheticCapture(n_frames=1)
+
+    def run(extra_conversions):
+        start = time.perf_counter()
+        for _ in range(n_frames):
+            frame, _ = get_processed_frame(cap, THRESHOLDS, skip_static=False)
+            for _ in range(extra_conversions):
+                cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
+        return n_frames / (time.perf_counter() - start)
+
+    run(0)  # warm up
+    shared_fps = run(0)
+    legacy_fps = run(4)
+    print(f"one HSV conversion per frame:   {shared_fps:.1f} fps")
+    print(f"five HSV conversions per frame: {legacy_fps:.1f} fps")
+    print(f"gain: {shared_fps / legacy_fps:.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="BilliardBot pipeline benchmark on synthetic scenes")
+    parser.add_argument("--frames", type=int, default=50, help="number of distinct synthetic frames")
+    parser.add_argument("--repeat", type=int, default=4, help="passes over the frames")
+    parser.add_argument("--width", type=int, default=800)
+    parser.add_argument("--height", type=int, default=800)
+    parser.add_argument("--balls", type=int, default=5)
+    parser.add_argument("--noise", type=float, default=4.0)
+    parser.add_argument("--lighting", type=float, default=0.1)
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--save", help="write the results as JSON, e.g. to use as a baseline")
+    parser.add_argument("--shared-hsv", action="store_true", help="only compare one vs five HSV conversions per frame")
+    parser.add_argument("--ball-backends", action="store_true", help="only compare the detect_balls backends on a noisy table")
+    parser.add_argument("--measurements", action="store_true", help="only compare the per-ball loop with measure_balls")
+    parser.add_argument("--static-gating", action="store_true", help="only compare get_processed_frame with and without the static scene gate")
+    parser.add_argument("--pyramid", type=int, default=0, help="only compare the coarse-to-fine mode with this many levels to full resolution")
+    parser.add_argument("--pyramid-tolerance", type=float, default=PYRAMID_TOLERANCE_PX, help="largest ball difference allowed, in pixels")
+    parser.add_argument("--completion", action="store_true", help="only compare status polling with the long poll on the ESP32 simulator")
+    parser.add_argument("--channel", action="store_true", help="only measure the command channel on the ESP32 simulator")
+    parser.add_argument("--udp", action="store_true", help="only compare the HTTP and binary UDP commands on the ESP32 simulator")
+    parser.add_argument("--program", action="store_true", help="only compare separate commands with a motion program on the ESP32 simulator")
+    parser.add_argument("--robot", action="store_true", help="only measure the round trip to the ESP32 simulator with and without RobotClient")
+    parser.add_argument("--allocations", action="store_true", help="only check the memory allocated per frame with and without the buffer pool (with --pyramid N in coarse-to-fine mode)")
+    parser.add_argument("--tiles", type=int, default=0, help="only compare the whole frame stages on one thread and in this many tiles")
+    parser.add_argument("--pose-dropouts", action="store_true", help="only compare the measured frames with and without pose tracking")
+    args = parser.parse_args()
+
+    if args.shared_hsv:
+        bench_shared_hsv(args.frames * args.repeat)
+        raise SystemExit
+    if args.ball_backends:
+        bench_ball_backends(args.frames)
+        raise SystemExit
+    if args.measurements:
+        bench_measurements(args.frames * args.repeat)
+        raise SystemExit
+    if args.completion:
+        bench_completion(args.frames)
+        raise SystemExit
+    if args.channel:
+        bench_channel(args.frames)
+        raise SystemExit
+    if args.program:
+        bench_program(args.frames)
+        raise SystemExit
+    if args.udp:
+        bench_udp(args.frames * args.repeat * 10)
+        raise SystemExit
+    if args.robot:
+        bench_robot(args.frames * args.repeat)
+        raise SystemExit
+    if args.tiles:
+        bench_tiles(args.frames, args.tiles)
+        raise SystemExit
+    if args.static_gating:
+        bench_static_gating(args.frames * args.repeat * 3)
+        raise SystemExit
+    if args.pose_dropouts:
+        check_pose_reacquire()
+        bench_pose_dropouts(args.frames * args.repeat)
+        raise SystemExit
+
+    scenes = make_workload(args.frames, args.width, args.height, args.balls, args.noise, args.lighting)
+    if args.allocations:
+        failures = bench_allocations(scenes, args.pyramid)
+        if failures:
+            print("Allocations: " + ", ".join(failures))
+            raise SystemExit(1)
+        raise SystemExit
+    if args.pyramid:
+        if not bench_pyramid(scenes, args.pyramid, args.pyramid_tolerance):
+            print("Coarse-to-fine mode outside of the tolerance")
+            raise SystemExit(1)
+        raise SystemExit
+    bench_pipeline(scenes[:5], 1)  # warm up
+    latency = {name: summarize(samples) for name, samples in bench_stages(scenes, args.repeat).items() if samples}
+    latency["pipeline"] = summarize(bench_pipeline(scenes, args.repeat))
+    results = {
+        "config": {key: value for key, value in vars(args).items() if key not in ("baseline", "save", "shared_hsv", "ball_backends", "measurements", "pose_dropouts", "static_gating", "pyramid", "pyramid_tolerance", "tiles", "allocations", "robot", "channel", "completion", "program", "udp")},
+        "latency": latency,
+        "accuracy": check_accuracy(scenes),
+    }
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    regressions = print_report(results, baseline)
+    # Steady state of the buffer pool, on a few frames (tracemalloc slows them down)
+    allocation_failures = bench_allocations(scenes[:10], compare=False)
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(results, file, indent=2)
+    if allocation_failures:
+        print("Allocations: " + ", ".join(allocation_failures))
+    if regressions:
+        print("Slower than baseline: " + ", ".join(regressions))
+    if regressions or allocation_failures:
+        raise SystemExit(1)
@@ -0,0 +1,58 @@
+from collections import OrderedDict
+import numpy as np
+
+
+"""
+    Images allocated once and reused from frame to frame. The stages write their outputs
+    into them with the dst= argument of OpenCV, so a frame does not allocate new arrays for
+    its masks, its HSV image or its temporaries.
+
+    Buffers are grouped by resolution (height, width) and named by the stage that uses them.
+    Only the buffers of the last max_resolutions resolutions are kept (e.g. the full and the
+    downsampled frames of the coarse-to-fine mode), a change of camera resolution frees the
+    old ones. Regions of interest are views of a buffer at frame resolution, never buffers
+    of their own.
+
+    A buffer is overwritten the next time its name is asked for, i.e. at the next frame:
+    anything that has to outlive the frame must be copied.
+
+    Parameters:
+    max_resolutions (int): Number of resolutions whose buffers are kept.
+
+    Attributes:
+    allocations (int): Number of buffers allocated so far, stops growing in steady state.
+    """
+class BufferPool:
+    def __init__(self, max_resolutions=2):
+        self.max_resolutions = max_resolutions
+        self.resolutions = OrderedDict()
+        self.allocations = 0
+
+    def clear(self):
+        self.resolutions.clear()
+
+    """
+        Returns the buffer of the given name, shape and type, allocated the first time.
+        Its content is whatever the previous frame left in it.
+
+        Parameters:
+        name: Any hashable name of the buffer.
+        shape (tuple): Shape of the buffer, starting with the height and width of the frame.
+        dtype: Type of the elements.
+        """
+    def get(self, name, shape, dtype=np.uint8):
+        resolution = tuple(shape[:2])
+        buffers = self.resolutions.get(resolution)
+        if buffers is None:
+            buffers = self.resolutions[resolution] = {}
+            while len(self.resolutions) > self.max_resolutions:
+                self.resolutions.popitem(last=False)
+        else:
+            self.resolutions.move_to_end(resolution)
+
+        key = (name, tuple(shape[2:]), np.dtype(dtype))
+        buffer = buffers.get(key)
+        if buffer is None:
+            buffer = buffers[key] = np.empty(shape, dtype)
+            self.allocations += 1
+        return buffer
@@ -0,0 +1,339 @@
+import argparse
+import glob
+import os
+import cv2
+import numpy as np
+from constants import TABLE_WIDTH_CM, TABLE_LENGTH_CM
+
+CALIBRATION_DIR = os.path.dirname(os.path.abspath(__file__))
+TABLE_CALIBRATION_PATH = os.path.join(CALIBRATION_DIR, "table_calibration.npz")
+LENS_CALIBRATION_PATH = os.path.join(CALIBRATION_DIR, "lens_calibration.npz")
+
+
+"""
+    Finds the four corners of the table in its contour.
+
+    Parameters:
+    contour (np.array): The table contour from detect_backgroud_boudary.
+
+    Returns:
+    np.array: The corners as a (4, 2) float32 array ordered top-left, top-right,
+              bottom-right, bottom-left in the image.
+    """
+def find_table_corners(contour):
+    hull = cv2.convexHull(contour)
+    corners = cv2.approxPolyDP(hull, 0.02 * cv2.arcLength(hull, True), True)
+    if len(corners) != 4:
+        # Rounded or partly hidden corners, fall back to the enclosing rectangle
+        corners = cv2.boxPoints(cv2.minAreaRect(hull))
+    corners = np.asarray(corners, np.float32).reshape(4, 2)
+
+    # Top-left has the smallest x + y, bottom-right the largest, top-right the smallest y - x
+    sums = corners.sum(axis=1)
+    differences = corners[:, 1] - corners[:, 0]
+    return np.array([corners[np.argmin(sums)], corners[np.argmin(differences)],
+                     corners[np.argmax(sums)], corners[np.argmax(differences)]], np.float32)
+
+
+"""
+    Maps image pixels to centimeters on the table with a homography fitted on the four
+    corners of the table, so every pixel to cm conversion is one matrix multiply instead of
+    a scale guessed from the radius of each ball.
+
+    The table plane has its origin at the top-left corner of the table in the image, x along
+    the top edge (TABLE_WIDTH_CM) and y along the left edge (TABLE_LENGTH_CM).
+
+    The calibration is loaded from path at the start. It is only fitted again when the table
+    model detects the table again and its corners moved by more than tolerance pixels. A fit
+    is only written back to path by save(), which only the live camera loops call: synthetic
+    scenes and video files must not replace the calibration of the real table.
+
+    With a lens calibration the corners are undistorted before the fit, and the homography
+    then applies to undistorted points.
+
+    Without a table size (TABLE_WIDTH_CM and TABLE_LENGTH_CM not set) there is no
+    calibration: update() returns None and the measurements keep the ball diameter scale.
+
+    Parameters:
+    path (str): File the calibration is cached in, None to keep it in memory only.
+    table_size_cm (tuple): Measured width and length of the table surface in centimeters,
+                           None if unknown.
+    tolerance (float): Corner movement in pixels above which the calibration is redone.
+    lens (LensCalibration): Optional lens calibration of the camera.
+    """
+class TableCalibration:
+    def __init__(self, path=TABLE_CALIBRATION_PATH, table_size_cm=(TABLE_WIDTH_CM, TABLE_LENGTH_CM), tolerance=3.0, lens=None):
+        self.path = path
+        if table_size_cm is None or None in table_size_cm:
+            self.table_size_cm = None
+        else:
+            self.table_size_cm = tuple(float(size) for size in table_size_cm)
+        self.tolerance = tolerance
+        self.lens = lens
+        self.homography = None
+        self.corners = None
+        self.fits = 0
+        self.unsaved = False
+        self.seen_detections = None
+        self.load()
+
+    """
+        Loads the cached calibration. Returns False if there is none for this table size.
+        """
+    def load(self):
+        if not self.configured or self.path is None or not os.path.exists(self.path):
+            return False
+        with np.load(self.path) as data:
+            if tuple(data["table_size_cm"]) != self.table_size_cm or bool(data["undistorted"]) != (self.lens is not None):
+                return False
+            self.homography = data["homography"]
+            self.corners = data["corners"]
+        return True
+
+    @property
+    def configured(self):
+        return self.table_size_cm is not None
+
+    """
+        Writes the last fit to path, if it was not written yet.
+        """
+    def save(self):
+        if self.path is None or not self.unsaved:
+            return
+        self.unsaved = False
+        np.savez(self.path, homography=self.homography, corners=self.corners, table_size_cm=np.array(self.table_size_cm),
+                 undistorted=self.lens is not None)
+
+    """
+        Fits the homography on the corners of a table contour.
+
+        Parameters:
+        contour (np.array): The table contour.
+        frame_size (tuple): Width and height of the frame of the contour.
+        """
+    def fit(self, contour, frame_size):
+        width, length = self.table_size_cm
+        table = np.array([[0, 0], [width, 0], [width, length], [0, length]], np.float32)
+        self.corners = find_table_corners(contour)
+        corners = self.corners if self.lens is None else self.lens.undistort_points(self.corners, frame_size).astype(np.float32)
+        self.homography = cv2.getPerspectiveTransform(corners, table)
+        self.fits += 1
+        self.unsaved = True
+
+    """
+        Checks the calibration against the table model after each new detection of the table,
+        and fits it again if there is none yet or if the table moved.
+
+        Parameters:
+        table_model (TableModel): The table model, already updated for the frame.
+
+        Returns:
+        np.array: The 3x3 homography, or None if there is no calibration.
+        """
+    def update(self, table_model):
+        if not self.configured:
+            return None
+        if table_model.contour is None or table_model.detections == self.seen_detections:
+            return self.homography
+        self.seen_detections = table_model.detections
+        frame_size = table_model.full_shape[1::-1]
+        if self.corners is None:
+            self.fit(table_model.contour, frame_size)
+        else:
+            moved = np.abs(find_table_corners(table_model.contour) - self.corners).max()
+            if moved > self.tolerance:
+                self.fit(table_model.contour, frame_size)
+        return self.homography
+
+
+"""
+    Maps image points to the plane of the homography.
+
+    Parameters:
+    homography (np.array): The 3x3 homography.
+    points (np.array): An (N, 2) array of image points.
+
+    Returns:
+    np.array: The (N, 2) mapped points.
+    """
+def apply_homography(homography, points):
+    points = np.asarray(points, np.float64).reshape(-1, 2)
+    mapped = points @ homography[:, :2].T + homography[:, 2]
+    return mapped[:, :2] / mapped[:, 2:]
+
+
+"""
+    Finds the inner corners of a checkerboard in calibration images and fits the camera
+    matrix and the distortion coefficients of the lens.
+
+    Parameters:
+    images (list): BGR images of the checkerboard seen from different positions and angles.
+    pattern_size (tuple): Number of inner corners per row and per column of the checkerboard.
+    square_size (float): Side of a square, in any unit (only scales the board poses).
+
+    Returns:
+    tuple: The camera matrix, the distortion coefficients, the RMS reprojection error in
+           pixels and the number of images the board was found in.
+    """
+def calibrate_lens(images, pattern_size=(9, 6), square_size=1.0):
+    board = np.zeros((pattern_size[0] * pattern_size[1], 3), np.float32)
+    board[:, :2] = np.mgrid[0:pattern_size[0], 0:pattern_size[1]].T.reshape(-1, 2) * square_size
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+
+    object_points = []
+    image_points = []
+    frame_size = None
+    for image in images:
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        frame_size = gray.shape[::-1]
+        found, corners = cv2.findChessboardCorners(gray, pattern_size, None)
+        if not found:
+            continue
+        corners = cv2.cornerSubPix(gray, corners, (11, 11), (-1, -1), criteria)
+        object_points.append(board)
+        image_points.append(corners)
+    if len(image_points) < 3:
+        raise ValueError(f"The checkerboard was found in {len(image_points)} images, at least 3 are needed")
+
+    rms, camera_matrix, dist_coeffs, _, _ = cv2.calibrateCamera(object_points, image_points, frame_size, None, None)
+    return camera_matrix, dist_coeffs, rms, len(image_points)
+
+
+"""
+    Lens distortion of the camera: the camera matrix and distortion coefficients, and the
+    remap tables of initUndistortRectifyMap for whole frames.
+
+    The pipeline only undistorts the points it measures (ball centers, markers, table
+    corners) with undistort_points. The remap tables are only needed to show an undistorted
+    frame. They are computed once, stored next to the calibration as .npy files and memory
+    mapped, so loading them is immediate and they are only read from disk when used.
+
+    The camera matrix only holds for frames of frame_size. Frames of another size with the
+    same aspect ratio (the camera scaled its output) get a camera matrix scaled to their
+    size, see for_size(). Frames of another aspect ratio (the camera cropped its output)
+    cannot be undistorted with this calibration: they are left as they are, with a warning.
+
+    Parameters:
+    camera_matrix (np.array): The 3x3 camera matrix.
+    dist_coeffs (np.array): The distortion coefficients.
+    frame_size (tuple): Width and height of the frames the calibration was made at.
+    path (str): The .npz file of the calibration, the tables are saved beside it.
+    """
+class LensCalibration:
+    def __init__(self, camera_matrix, dist_coeffs, frame_size, path=LENS_CALIBRATION_PATH):
+        self.camera_matrix = np.asarray(camera_matrix, np.float64)
+        self.dist_coeffs = np.asarray(dist_coeffs, np.float64)
+        self.frame_size = (int(frame_size[0]), int(frame_size[1]))
+        self.path = path
+        self._maps = None
+        self._sizes = {self.frame_size: self}
+
+    """
+        Loads the calibration saved at path, or returns None if there is none.
+        """
+    @classmethod
+    def load(cls, path=LENS_CALIBRATION_PATH):
+        if path is None or not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            return cls(data["camera_matrix"], data["dist_coeffs"], tuple(data["frame_size"]), path)
+
+    def _map_paths(self):
+        base = os.path.splitext(self.path)[0]
+        return base + "_map1.npy", base + "_map2.npy"
+
+    """
+        Saves the calibration and its remap tables.
+        """
+    def save(self):
+        np.savez(self.path, camera_matrix=self.camera_matrix, dist_coeffs=self.dist_coeffs, frame_size=np.array(self.frame_size))
+        for table, table_path in zip(self._compute_maps(), self._map_paths()):
+            np.save(table_path, table)
+        self._maps = None
+
+    def _compute_maps(self):
+        # Fixed point tables: half the size of float maps and faster in cv2.remap
+        return cv2.initUndistortRectifyMap(self.camera_matrix, self.dist_coeffs, None, self.camera_matrix,
+                                           self.frame_size, cv2.CV_16SC2)
+
+    """
+        Returns the calibration for frames of frame_size (width, height): this one, one with
+        the camera matrix scaled if the aspect ratio is the same, or None (and a warning the
+        first time) if it is not.
+        """
+    def for_size(self, frame_size):
+        frame_size = (int(frame_size[0]), int(frame_size[1]))
+        if frame_size not in self._sizes:
+            scale_x = frame_size[0] / self.frame_size[0]
+            scale_y = frame_size[1] / self.frame_size[1]
+            if abs(scale_x - scale_y) > 0.01 * scale_x:
+                print(f"Lens calibration made for {self.frame_size[0]}x{self.frame_size[1]} frames, "
+                      f"{frame_size[0]}x{frame_size[1]} frames are not undistorted")
+                self._sizes[frame_size] = None
+            else:
+                camera_matrix = np.diag([scale_x, scale_y, 1.0]) @ self.camera_matrix
+                self._sizes[frame_size] = LensCalibration(camera_matrix, self.dist_coeffs, frame_size, path=None)
+        return self._sizes[frame_size]
+
+    """
+        Returns the remap tables, memory mapped from disk (computed and saved if missing).
+        Without a path they are only computed in memory.
+        """
+    def maps(self):
+        if self._maps is None and self.path is None:
+            self._maps = self._compute_maps()
+        if self._maps is None:
+            paths = self._map_paths()
+            if not all(os.path.exists(table_path) for table_path in paths):
+                self.save()
+            self._maps = tuple(np.load(table_path, mmap_mode="r") for table_path in paths)
+        return self._maps
+
+    """
+        Maps image points to where they would be without lens distortion, in pixels of the
+        same camera matrix.
+
+        Parameters:
+        points (np.array): An (N, 2) array of image points.
+        frame_size (tuple): Width and height of the frame of the points.
+
+        Returns:
+        np.array: The (N, 2) undistorted points, the points unchanged if the calibration
+                  does not apply to frames of that size.
+        """
+    def undistort_points(self, points, frame_size):
+        points = np.asarray(points, np.float64).reshape(-1, 1, 2)
+        lens = self.for_size(frame_size)
+        if len(points) == 0 or lens is None:
+            return points.reshape(-1, 2)
+        return cv2.undistortPoints(points, lens.camera_matrix, lens.dist_coeffs, P=lens.camera_matrix).reshape(-1, 2)
+
+    """
+        Returns the undistorted frame, for display, or the frame itself if the calibration
+        does not apply to frames of its size.
+        """
+    def undistort_frame(self, frame, dst=None):
+        lens = self.for_size(frame.shape[1::-1])
+        if lens is None:
+            return frame
+        map1, map2 = lens.maps()
+        return cv2.remap(frame, map1, map2, cv2.INTER_LINEAR, dst=dst)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit the lens calibration from checkerboard images")
+    parser.add_argument("images", nargs="+", help="checkerboard images (glob patterns allowed)")
+    parser.add_argument("--pattern", default="9x6", help="inner corners of the checkerboard, e.g. 9x6")
+    parser.add_argument("--square", type=float, default=1.0, help="side of a square")
+    parser.add_argument("--output", default=LENS_CALIBRATION_PATH)
+    args = parser.parse_args()
+
+    paths = sorted(path for pattern in args.images for path in glob.glob(pattern))
+    images = [cv2.imread(path) for path in paths]
+    pattern_size = tuple(int(value) for value in args.pattern.lower().split("x"))
+    camera_matrix, dist_coeffs, rms, used = calibrate_lens(images, pattern_size, args.square)
+    height, width = images[0].shape[:2]
+    lens = LensCalibration(camera_matrix, dist_coeffs, (width, height), args.output)
+    lens.save()
+    print(f"Board found in {used}/{len(images)} images, RMS reprojection error {rms:.3f} px")
+    print(f"Saved {args.output}")
@@ -0,0 +1,103 @@
+import threading
+import time
+from collections import deque
+
+
+"""
+    Grabs frames continuously from a capture source on its own thread and keeps the last
+    few in a ring buffer, so the processing loop never blocks on the camera and never reads
+    the same frame twice.
+
+    Every buffered frame is stored as (sequence number, timestamp, frame). A frame that is
+    never handed to a consumer, because a newer one was taken or it fell out of the buffer,
+    is counted in dropped_frames.
+
+    It can be used in place of cv2.VideoCapture: read() returns (ret, frame) like cap.read().
+
+    Parameters:
+    source: Anything with a read() method returning (ret, frame), e.g. cv2.VideoCapture.
+    buffer_size (int): Number of frames kept in the ring buffer.
+    """
+class FrameGrabber:
+    def __init__(self, source, buffer_size=4):
+        self.source = source
+        self.buffer = deque(maxlen=buffer_size)
+        self.condition = threading.Condition()
+        self.sequence = 0
+        self.last_consumed = 0
+        self.dropped_frames = 0
+        self.running = False
+        self.ended = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._grab_loop, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    def release(self):
+        self.stop()
+        self.source.release()
+
+    def _grab_loop(self):
+        while self.running:
+            ret, frame = self.source.read()
+            timestamp = time.monotonic()
+            with self.condition:
+                if not ret:
+                    self.ended = True
+                    self.condition.notify_all()
+                    return
+                self.sequence += 1
+                self.buffer.append((self.sequence, timestamp, frame))
+                self.condition.notify_all()
+
+    def _consume(self, entry):
+        sequence = entry[0]
+        if sequence > self.last_consumed:
+            self.dropped_frames += sequence - self.last_consumed - 1
+            self.last_consumed = sequence
+        return entry
+
+    def _wait_for_unseen(self, timeout):
+        return self.condition.wait_for(lambda: self.ended or (self.buffer and self.buffer[-1][0] > self.last_consumed), timeout)
+
+    """
+        Returns the newest frame in the buffer as (sequence, timestamp, frame), or None.
+        With wait=True it blocks until a frame that has not been consumed yet is available.
+        """
+    def latest(self, wait=True, timeout=1.0):
+        with self.condition:
+            if wait and not self._wait_for_unseen(timeout):
+                return None
+            if not self.buffer:
+                return None
+            if wait and self.buffer[-1][0] <= self.last_consumed:
+                # Source ended and everything was already consumed
+                return None
+            return self._consume(self.buffer[-1])
+
+    """
+        Returns the oldest frame that has not been consumed yet as (sequence, timestamp, frame),
+        or None if no new frame arrives within the timeout.
+        """
+    def next(self, timeout=1.0):
+        with self.condition:
+            if not self._wait_for_unseen(timeout):
+                return None
+            for entry in self.buffer:
+                if entry[0] > self.last_consumed:
+                    return self._consume(entry)
+            return None
+
+    def read(self):
+        entry = self.latest()
+        if entry is None:
+            return False, None
+        return True, entry[2]
@@ -0,0 +1,315 @@
+import asyncio
+import concurrent.futures
+import functools
+import heapq
+import itertools
+import threading
+from robot_control import RobotError, robot
+
+# Priorities of the commands, the smallest goes first
+STRIKE = 0
+MOVE = 1
+JOG = 2
+
+# A move of zero steps: AccelStepper.move(0) sets the target to the current position
+STOP_PARAMS = {'stepsX': 0, 'speedX': 1, 'stepsY': 0, 'speedY': 1, 'stepsZ': 0, 'speedZ': 1}
+
+
+"""
+    Raised by CommandChannel.submit when the queue is full and the caller does not wait.
+    """
+class CommandQueueFull(RobotError):
+    pass
+
+
+"""
+    One command waiting in the channel or being executed.
+
+    Parameters:
+    endpoint (str): Endpoint of the ESP32, "control", "strike" or "program".
+    params: Query parameters of the request (dict), the MotionProgram of a program.
+    priority (int): STRIKE, MOVE or JOG.
+    preemptible (bool): Whether a command of a higher priority stops this one.
+    sequence (int): Order of submission, commands of the same priority keep it.
+    """
+class RobotCommand:
+    __slots__ = ("endpoint", "params", "priority", "preemptible", "sequence", "future")
+
+    def __init__(self, endpoint, params, priority, preemptible, sequence):
+        self.endpoint = endpoint
+        self.params = params
+        self.priority = priority
+        self.preemptible = preemptible
+        self.sequence = sequence
+        self.future = concurrent.futures.Future()
+
+    def __lt__(self, other):
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+    def __repr__(self):
+        return f"RobotCommand({self.endpoint}, {self.params}, priority={self.priority})"
+
+
+"""
+    Single channel through which all the commands go to the ESP32, one at a time, from an
+    asyncio event loop on its own thread.
+
+    Commands wait in a bounded priority queue: strikes before moves before jogs, and in
+    order of submission within a priority. A command is done when the robot reports it
+    done: for a move, when the status says the motors stopped. The next command is only
+    sent then, so commands never overlap and no caller has to sleep.
+
+    Every command has a concurrent.futures.Future, which completes with the answer of the
+    ESP32, fails with RobotError, or is cancelled. A queued command is cancelled with
+    future.cancel(), a running one with cancel(future), which stops the motors. A strike
+    submitted while a jog runs preempts it the same way.
+
+    A program is done when all its segments are. It goes in one request to the ESP32, or one
+    request per segment if the firmware has no /program.
+
+    The end of a move is waited for with the long poll of the client (see RobotClient), or by
+    polling the status every poll_interval seconds if the firmware has none.
+
+    The loop thread starts with the first command. The blocking requests of the client run
+    on a pool of two threads, so a stop can be sent while a long poll is in flight.
+
+    Parameters:
+    client (RobotClient): The client of the ESP32.
+    maxsize (int): Number of commands that can wait in the queue.
+    poll_interval (float): Time between two status requests during a move, in seconds.
+    move_timeout (float): Time after which a move that is not done fails, in seconds.
+    """
+class CommandChannel:
+    def __init__(self, client=robot, maxsize=8, poll_interval=0.05, move_timeout=30.0):
+        self.client = client
+        self.maxsize = maxsize
+        self.poll_interval = poll_interval
+        self.move_timeout = move_timeout
+        self.pending = []
+        self.space = threading.Condition()
+        self.sequence = itertools.count()
+        self.running = None
+        self.loop = None
+        self.thread = None
+        self.closing = False
+        self.requests = concurrent.futures.ThreadPoolExecutor(2, thread_name_prefix="robot")
+        self.preemptions = 0
+
+    def start(self):
+        with self.space:
+            if self.thread is not None:
+                return self
+            self.loop = asyncio.new_event_loop()
+            self.wakeup = asyncio.Event()
+            self.thread = threading.Thread(target=self.loop.run_until_complete, args=(self._worker(),), daemon=True, name="robot-channel")
+            self.thread.start()
+        return self
+
+    """
+        Cancels the queued commands, stops the running one and the loop thread.
+        """
+    def close(self):
+        if self.thread is None:
+            return
+        self.cancel_all()
+        self.closing = True
+        self.loop.call_soon_threadsafe(self.wakeup.set)
+        self.thread.join()
+        self.loop.close()
+        self.requests.shutdown()
+        self.thread = None
+
+    """
+        Queues a command and returns its future. Can be called from any thread.
+
+        Parameters:
+        endpoint (str): Endpoint of the ESP32, "control" or "strike".
+        params (dict): Query parameters of the request.
+        priority (int): STRIKE, MOVE or JOG.
+        preemptible (bool): Whether a higher priority stops the command, by default only
+                            jogs can be stopped.
+        block (bool): Wait for room in the queue instead of raising CommandQueueFull.
+        timeout (float): Longest wait for room in seconds, None to wait as long as it takes.
+
+        Returns:
+        concurrent.futures.Future: Completes with the answer of the ESP32 once the robot is
+                                   done.
+        """
+    def submit(self, endpoint, params, priority=MOVE, preemptible=None, block=False, timeout=None):
+        self.start()
+        preemptible = priority == JOG if preemptible is None else preemptible
+        with self.space:
+            if len(self.pending) >= self.maxsize:
+                if not block or not self.space.wait_for(lambda: len(self.pending) < self.maxsize, timeout):
+                    raise CommandQueueFull(f"{len(self.pending)} robot commands are already waiting")
+            command = RobotCommand(endpoint, params, priority, preemptible, next(self.sequence))
+            heapq.heappush(self.pending, command)
+        self.loop.call_soon_threadsafe(self._wake)
+        return command.future
+
+    """
+        Queues a command from a coroutine, waiting for room in the queue, and returns the
+        answer of the ESP32 once the robot is done.
+        """
+    async def send(self, endpoint, params, priority=MOVE, preemptible=None):
+        future = await asyncio.to_thread(self.submit, endpoint, params, priority, preemptible, True)
+        return await asyncio.wrap_future(future)
+
+    def move(self, stepsX, speedX, stepsY, speedY, stepsZ, speedZ, **options):
+        params = {'stepsX': stepsX, 'speedX': speedX, 'stepsY': stepsY, 'speedY': speedY, 'stepsZ': stepsZ, 'speedZ': speedZ}
+        return self.submit("control", params, MOVE, **options)
+
+    def jog(self, stepsX, speedX, stepsY, speedY, stepsZ, speedZ, **options):
+        params = {'stepsX': stepsX, 'speedX': speedX, 'stepsY': stepsY, 'speedY': speedY, 'stepsZ': stepsZ, 'speedZ': speedZ}
+        return self.submit("control", params, JOG, **options)
+
+    def strike(self, chargeDuration, **options):
+        return self.submit("strike", {'chargeDuration': chargeDuration}, STRIKE, **options)
+
+    def program(self, program, priority=MOVE, **options):
+        return self.submit("program", program, priority, **options)
+
+    """
+        Cancels a command: removes it from the queue, or stops the motors if it is running.
+        """
+    def cancel(self, future):
+        if future.cancel():
+            self._remove_cancelled()
+            return
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._cancel_running, future)
+
+    """
+        Cancels every queued command and stops the running one.
+        """
+    def cancel_all(self):
+        with self.space:
+            commands, self.pending = self.pending, []
+            self.space.notify_all()
+        for command in commands:
+            command.future.cancel()
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._cancel_running, None)
+
+    def _remove_cancelled(self):
+        with self.space:
+            self.pending = [command for command in self.pending if not command.future.cancelled()]
+            heapq.heapify(self.pending)
+            self.space.notify_all()
+
+    def _pop(self):
+        with self.space:
+            while self.pending:
+                command = heapq.heappop(self.pending)
+                self.space.notify_all()
+                # False if it was cancelled while queued
+                if command.future.set_running_or_notify_cancel():
+                    return command
+        return None
+
+    # On the loop thread: wakes the worker and preempts the running command if needed
+    def _wake(self):
+        self.wakeup.set()
+        if self.running is None:
+            return
+        command, task = self.running
+        with self.space:
+            first = self.pending[0] if self.pending else None
+        if command.preemptible and first is not None and first.priority < command.priority and not task.cancelling():
+            self.preemptions += 1
+            task.cancel()
+
+    def _cancel_running(self, future):
+        if self.running is None:
+            return
+        command, task = self.running
+        # Already being stopped otherwise
+        if (future is None or command.future is future) and not task.cancelling():
+            task.cancel()
+
+    async def _worker(self):
+        while not self.closing:
+            command = self._pop()
+            if command is None:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+            task = asyncio.ensure_future(self._execute(command))
+            self.running = (command, task)
+            await asyncio.wait([task])
+            self.running = None
+
+    # Starts a blocking call of the client on the request threads
+    def _call(self, function, *args):
+        try:
+            return self.loop.run_in_executor(self.requests, functools.partial(function, *args))
+        except RuntimeError as e:
+            # The interpreter is exiting
+            raise RobotError("the command channel is shut down") from e
+
+    # Sends one request, kept in sent so that a cancellation can wait for it
+    async def _send(self, sent, function, *args):
+        sent[:] = [self._call(function, *args)]
+        # Not abandoned if the command is cancelled, so the stop cannot overtake it
+        return await asyncio.shield(sent[0])
+
+    async def _execute(self, command):
+        sent = []
+        try:
+            if command.endpoint == "program":
+                answer = await self._run_program(command.params, sent)
+            else:
+                answer = await self._send(sent, self.client.request, command.endpoint, command.params)
+                if command.endpoint == "control":
+                    await asyncio.wait_for(self._wait_for_movement(), self.move_timeout)
+            command.future.set_result(answer)
+        except asyncio.CancelledError:
+            if sent:
+                await asyncio.wait(sent)
+            try:
+                await self._call(self.client.request, "control", STOP_PARAMS)
+            except RobotError as e:
+                print(f"Error stopping {command}: {e}")
+            command.future.set_exception(concurrent.futures.CancelledError())
+        except asyncio.TimeoutError:
+            command.future.set_exception(RobotError(f"{command} not done after {self.move_timeout} s"))
+        except RobotError as e:
+            print(f"Error sending {command}: {e}")
+            command.future.set_exception(e)
+
+    async def _run_program(self, program, sent):
+        if self.client.programs:
+            try:
+                answer = await self._send(sent, self.client.run_program, program)
+            except RobotError as e:
+                if e.status_code != 404:
+                    raise
+            else:
+                await asyncio.wait_for(self._wait_for_movement(), self.move_timeout)
+                return answer
+        # Firmware without /program: one request per segment, each move waited for
+        answer = None
+        for endpoint, params in program.requests():
+            answer = await self._send(sent, self.client.request, endpoint, params)
+            if endpoint == "control":
+                await asyncio.wait_for(self._wait_for_movement(), self.move_timeout)
+        return answer
+
+    async def _wait_for_movement(self):
+        # A long poll in flight when the command is cancelled returns once the stop is taken
+        while not await self._call(self.client.wait_stopped):
+            if not self.client.long_poll:
+                await asyncio.sleep(self.poll_interval)
+
+
+"""
+    Awaitable that completes when the robot reports its motors stopped, with the long poll
+    of the client. Returns False if they are still moving after timeout seconds (None waits
+    as long as it takes).
+    """
+async def movement_complete(client=robot, timeout=None):
+    return await asyncio.to_thread(client.wait_for_movement, timeout)
+
+
+# Shared channel of the UI and of main, its thread starts with the first command
+robot_channel = CommandChannel()
@@ -7,6 +7,10 @@ WHEEL_RADIUS = 0.03
 STEPS_PER_ROTATION = 1600
 DISTANCE_PER_STEP = 0.214
 POOL_BALL_DIAMETER=5.7
+# Measured size of the table surface seen by the camera, used by the table calibration.
+# None until measured: the distances are then scaled by the ball diameter
+TABLE_WIDTH_CM = None
+TABLE_LENGTH_CM = None
 
 # Define constants for HSV values
 LOWER_CENTER = np.array([0, 0, 0])
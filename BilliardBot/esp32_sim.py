@@ -0,0 +1,295 @@
+import argparse
+import random
+import socket
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from udp_protocol import ANSWER, RESULTS, INVALID, OK, decode_command
+
+CONTROL_PARAMS = ("stepsX", "speedX", "stepsY", "speedY", "stepsZ", "speedZ")
+# Longest program the firmware stores
+MAX_SEGMENTS = 16
+# Number of UDP answers kept for retransmitted commands
+UDP_ANSWERS = 32
+
+
+"""
+    Stand-in for the ESP32 web server, to run the robot client and measure it without the
+    robot. It answers the same endpoints with the same texts:
+
+    /control?stepsX=..&speedX=..  starts a move, "Motors commanded successfully"
+    /status                       "Movement complete" or "Moving"
+    /wait?timeout=ms              long poll: answers like /status as soon as the motors
+                                  stop, or after timeout ms if they are still moving
+    /strike?chargeDuration=..     "Strike fired"
+    /program?segments=..          starts a program, "Program started": moves
+                                  "m:stepsX,speedX,stepsY,speedY,stepsZ,speedZ" and
+                                  strikes "s:chargeDuration" separated by ";", run one
+                                  after the other
+
+    With a udp_port, the same commands are also served as binary frames over UDP (see
+    UdpTransport). The answers of the last UDP_ANSWERS commands are kept, and sent back
+    without executing the command again when its sequence number comes again. loss drops
+    datagrams at random in both directions, like a poor WiFi link.
+
+    A move lasts as long as the slowest motor needs at its speed (steps per second), times
+    time_scale, a program as long as its moves together (strikes take no time). A new move or
+    program replaces the one that runs. Connections are kept alive like by any HTTP/1.1 server.
+
+    Parameters:
+    host (str): Address to listen on.
+    port (int): Port to listen on, 0 for any free port.
+    latency (float): Delay in seconds added to every answer, like the WiFi round trip.
+    connect_latency (float): Delay in seconds added once per new connection, like the TCP
+                             handshake with the ESP32.
+    time_scale (float): Factor applied to the duration of the moves.
+    long_poll (bool): Whether to serve /wait, like a firmware that has it.
+    programs (bool): Whether to serve /program, like a firmware that has it.
+    udp_port (int): UDP port to serve the binary commands on, 0 for any free port, None for
+                    no UDP.
+    loss (float): Probability that a UDP datagram is lost.
+    """
+class ESP32Simulator:
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, connect_latency=0.0, time_scale=1.0, long_poll=True, programs=True, udp_port=None, loss=0.0):
+        self.long_poll = long_poll
+        self.programs = programs
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.time_scale = time_scale
+        self.lock = threading.Lock()
+        # Notified when a command changes the end of the move
+        self.changed = threading.Condition(self.lock)
+        self.moving_until = 0.0
+        self.commands = []
+        self.connections = 0
+        self.open_connections = set()
+        self.stalls = []
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+        self.udp = None
+        self.udp_thread = None
+        self.loss = loss
+        self.random = random.Random(0)
+        self.udp_answers = OrderedDict()
+        self.duplicates = 0
+        if udp_port is not None:
+            self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.udp.bind((host, udp_port))
+            # So that the loop sees stop()
+            self.udp.settimeout(0.1)
+
+    @property
+    def address(self):
+        host, port = self.server.server_address[:2]
+        return f"{host}:{port}"
+
+    @property
+    def udp_port(self):
+        return self.udp.getsockname()[1] if self.udp is not None else None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        if self.udp is not None:
+            self.udp_thread = threading.Thread(target=self.serve_udp, daemon=True)
+            self.udp_thread.start()
+        return self
+
+    """
+        Stops the server and drops the open connections, like an ESP32 that is switched off.
+        """
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.udp_thread is not None:
+            udp, self.udp = self.udp, None
+            self.udp_thread.join()
+            udp.close()
+        with self.lock:
+            for connection in self.open_connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    """
+        Makes the next count requests wait seconds before being handled, like a stalled
+        ESP32.
+        """
+    def stall(self, seconds, count=1):
+        with self.lock:
+            self.stalls.extend([seconds] * count)
+
+    def moving(self):
+        return time.monotonic() < self.moving_until
+
+    def handle(self, endpoint, params):
+        with self.lock:
+            stall = self.stalls.pop(0) if self.stalls else 0.0
+        time.sleep(stall + self.latency)
+
+        if endpoint == "/control":
+            if not all(name in params for name in CONTROL_PARAMS):
+                return 400, "Invalid parameters"
+            try:
+                steps = [int(float(params[name])) for name in CONTROL_PARAMS[::2]]
+                speeds = [float(params[name]) for name in CONTROL_PARAMS[1::2]]
+            except ValueError:
+                return 400, "Invalid parameters"
+            with self.changed:
+                self.commands.append(("control", steps, speeds))
+                # Like AccelStepper.move, a new move starts from where the motors are
+                self._run(self._duration(steps, speeds))
+            return 200, "Motors commanded successfully"
+        if endpoint == "/program" and self.programs:
+            segments = self._parse_program(params.get("segments", ""))
+            if segments is None:
+                return 400, "Invalid program"
+            duration = sum(self._duration(values[::2], values[1::2]) for kind, values in segments if kind == "m")
+            with self.changed:
+                self.commands.append(("program", segments))
+                self._run(duration)
+            return 200, "Program started"
+        if endpoint == "/status":
+            return 200, "Moving" if self.moving() else "Movement complete"
+        if endpoint == "/wait" and self.long_poll:
+            try:
+                end = time.monotonic() + float(params.get("timeout", 0)) / 1000
+            except ValueError:
+                return 400, "Invalid parameters"
+            with self.changed:
+                while self.moving() and time.monotonic() < end:
+                    self.changed.wait(min(self.moving_until, end) - time.monotonic())
+            return 200, "Moving" if self.moving() else "Movement complete"
+        if endpoint == "/strike":
+            if "chargeDuration" not in params:
+                return 400, "Invalid parameters"
+            with self.lock:
+                self.commands.append(("strike", int(float(params["chargeDuration"]))))
+            return 200, "Strike fired"
+        return 404, "Not found"
+
+    """
+        Answers the UDP commands one at a time, like the loop of the ESP32, until stop().
+        """
+    def serve_udp(self):
+        udp = self.udp
+        while self.udp is not None:
+            try:
+                data, sender = udp.recvfrom(64)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if self.random.random() < self.loss:
+                continue
+            command = decode_command(data)
+            # Malformed frames are ignored, the client sends them again
+            if command is None:
+                continue
+            sequence, endpoint, params = command
+            key = (sender, sequence)
+            answer = self.udp_answers.get(key)
+            if answer is None:
+                status, text = self.handle("/" + endpoint, params)
+                result = RESULTS.get(text, OK) if status == 200 else INVALID
+                answer = self.udp_answers[key] = ANSWER.pack(sequence, data[4], result)
+                while len(self.udp_answers) > UDP_ANSWERS:
+                    self.udp_answers.popitem(last=False)
+            else:
+                self.duplicates += 1
+            if self.random.random() < self.loss:
+                continue
+            udp.sendto(answer, sender)
+
+    def _duration(self, steps, speeds):
+        return max((abs(step) / speed if speed > 0 else 0.0) for step, speed in zip(steps, speeds))
+
+    # With the lock held
+    def _run(self, duration):
+        self.moving_until = time.monotonic() + duration * self.time_scale
+        self.changed.notify_all()
+
+    # Returns the list of (kind, values) of the program, None if it is malformed. Like the
+    # firmware, steps and charge durations are integers, speeds floats
+    def _parse_program(self, text):
+        fields = {"m": (int, float, int, float, int, float), "s": (int,)}
+        segments = []
+        for segment in text.split(";") if text else []:
+            kind, _, values = segment.partition(":")
+            values = values.split(",")
+            if len(values) != len(fields.get(kind, ())):
+                return None
+            try:
+                values = [parse(value) for parse, value in zip(fields[kind], values)]
+            except ValueError:
+                return None
+            segments.append((kind, values))
+        return segments if 0 < len(segments) <= MAX_SEGMENTS else None
+
+    def _handler(self):
+        simulator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # The headers and the body are two writes, Nagle would hold the body back
+            # until the client acknowledges the headers
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with simulator.lock:
+                    simulator.connections += 1
+                    simulator.open_connections.add(self.connection)
+                time.sleep(simulator.connect_latency)
+
+            def finish(self):
+                with simulator.lock:
+                    simulator.open_connections.discard(self.connection)
+                super().finish()
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+                status, text = simulator.handle(url.path, params)
+                body = text.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "text/plain")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stand-in for the ESP32 web server of the robot")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0, help="delay added to every answer, in seconds")
+    parser.add_argument("--connect-latency", type=float, default=0.0, help="delay added to every new connection, in seconds")
+    parser.add_argument("--udp-port", type=int, help="also serve the binary commands on this UDP port")
+    parser.add_argument("--loss", type=float, default=0.0, help="probability that a UDP datagram is lost")
+    args = parser.parse_args()
+
+    simulator = ESP32Simulator(args.host, args.port, args.latency, args.connect_latency, udp_port=args.udp_port, loss=args.loss)
+    print(f"ESP32 simulator on http://{simulator.address}, use RobotClient(host=\"{simulator.address}\")")
+    if simulator.udp is not None:
+        print(f"UDP commands on port {simulator.udp_port}, use RobotClient(host=\"{simulator.address}\", transport=\"udp\", udp_port={simulator.udp_port})")
+        threading.Thread(target=simulator.serve_udp, daemon=True).start()
+    try:
+        simulator.server.serve_forever()
+    except KeyboardInterrupt:
+        simulator.server.server_close()
@@ -0,0 +1,240 @@
+import cv2
+import numpy as np
+from segmentation import range_key
+from tiling import run_stage
+
+
+"""
+    Returns the part of an image inside a region of interest given as (x, y, w, h), as a
+    view without copying. Returns the image itself if roi is None.
+    """
+def crop(image, roi):
+    if roi is None:
+        return image
+    x, y, w, h = roi
+    return image[y:y + h, x:x + w]
+
+
+"""
+    Returns the frame reduced levels times by 2 in each direction (averaging the pixels),
+    the levels of an image pyramid. With a BufferPool the result is written to one of its
+    buffers.
+    """
+def downsample(frame, levels, pool=None):
+    factor = 2 ** levels
+    height, width = frame.shape[:2]
+    size = (max(1, width // factor), max(1, height // factor))
+    dst = pool.get("downsampled", size[::-1] + frame.shape[2:], frame.dtype) if pool is not None else None
+    return cv2.resize(frame, size, dst=dst, interpolation=cv2.INTER_AREA)
+
+
+"""
+    Maps a contour found on a downsampled image back to the full resolution image.
+
+    Parameters:
+    contour (np.array): The contour in downsampled coordinates.
+    scale (tuple): Ratio (x, y) between the full and the downsampled sizes.
+    """
+def upscale_contour(contour, scale):
+    # Pixel centers: pixel i of the small image covers pixels i * s to (i + 1) * s - 1
+    scale = np.asarray(scale, np.float64)
+    return np.round(contour * scale + (scale - 1) / 2).astype(np.int32)
+
+
+"""
+    Maps an (x, y, w, h) rectangle to an image scale (x, y) times bigger (or smaller), grown
+    by margin pixels on every side and clipped to that image.
+    """
+def scale_roi(roi, scale, margin, frame_shape):
+    height, width = frame_shape[:2]
+    x0 = max(0, int(roi[0] * scale[0]) - margin)
+    y0 = max(0, int(roi[1] * scale[1]) - margin)
+    x1 = min(width, int(np.ceil((roi[0] + roi[2]) * scale[0])) + margin)
+    y1 = min(height, int(np.ceil((roi[1] + roi[3]) * scale[1])) + margin)
+    return (x0, y0, x1 - x0, y1 - y0)
+
+
+"""
+    Holds everything that is derived from a single camera frame so that the detectors
+    can share it instead of recomputing it. The frame is blurred and converted to HSV
+    exactly once, and every colour mask is computed the first time a detector asks for it.
+
+    When a Segmenter is given, all the threshold classes are computed in one pass into a
+    label image and the masks of those classes are read from it instead of re-thresholding.
+
+    Detectors never draw on the frame. They record draw commands with draw(), which are
+    only kept when render is True and applied later by overlay.render_overlay.
+
+    Parameters:
+    frame (np.array): The raw BGR frame read from the camera.
+    segmenter (Segmenter): Optional segmenter already updated with the current thresholds.
+    render (bool): Whether to record draw commands for a display.
+    lazy (bool): Only blur, convert and segment the regions of interest the detectors ask
+                 for, instead of the whole frame (coarse-to-fine mode). Masks must then be
+                 asked for with a roi, a mask without roi processes the whole frame.
+    executor (TileExecutor): Optional executor running the whole frame stages (blur, HSV,
+                             labels, full frame masks) in tiles on several threads.
+    pool (BufferPool): Optional pool the images of the context are written to instead of
+                       being allocated for every frame. They are then only valid until the
+                       next frame of the same resolution.
+
+    Attributes:
+    frame (np.array): The blurred BGR frame (the raw frame when lazy).
+    hsv (np.array): The HSV version of the blurred frame (None when lazy).
+    labels (np.array): The label image of the segmenter, or None.
+    masks (dict): Colour masks already computed for this frame, keyed by colour range.
+    overlay (list): The recorded draw commands, or None when not rendering.
+    """
+class FrameContext:
+    def __init__(self, frame, segmenter=None, render=True, lazy=False, executor=None, pool=None):
+        self.segmenter = segmenter
+        self.executor = executor
+        self.pool = pool
+        self.shape = frame.shape[:2]
+        self.masks = {}
+        self.mask_slots = {}
+        self.regions = {}
+        self.overlay = [] if render else None
+        self.lazy = lazy
+        if lazy:
+            self.frame = frame
+            self.hsv = None
+            self.labels = None
+        else:
+            self._prepare(frame)
+
+    """
+        Returns an image of the size of the frame (or the part of it inside roi) to write a
+        result to: a buffer of the pool, or a new array without pool. The content is
+        undefined.
+
+        Parameters:
+        name: Name of the buffer in the pool, one per use within a frame.
+        roi (tuple): Optional (x, y, w, h) rectangle, a view of the buffer is returned.
+        channels (int): Number of channels, None for a single channel image.
+        dtype: Type of the elements.
+        """
+    def buffer(self, name, roi=None, channels=None, dtype=np.uint8):
+        shape = self.shape if channels is None else self.shape + (channels,)
+        if self.pool is None:
+            if roi is not None:
+                shape = (roi[3], roi[2]) + shape[2:]
+            return np.empty(shape, dtype)
+        return crop(self.pool.get(name, shape, dtype), roi)
+
+    def _prepare(self, frame):
+        self.frame = self.buffer("frame", channels=3)
+        self.hsv = self.buffer("hsv", channels=3)
+        self.labels = self.buffer("labels") if self.segmenter is not None else None
+        outputs = [self.frame, self.hsv]
+        if self.labels is not None:
+            outputs += [self.labels] + [self.buffer(("plane", channel)) for channel in range(3)]
+        # The 5x5 blur reads 2 rows on each side of a tile
+        run_stage(self.executor, self._prepare_rows, frame, outputs, halo=2)
+        self.lazy = False
+
+    def _prepare_rows(self, source, core, outputs):
+        if core.stop - core.start == source.shape[0]:
+            cv2.GaussianBlur(source, (5, 5), 0, dst=outputs[0])
+        else:
+            outputs[0][:] = cv2.GaussianBlur(source, (5, 5), 0)[core]
+        cv2.cvtColor(outputs[0], cv2.COLOR_BGR2HSV, dst=outputs[1])
+        if len(outputs) > 2:
+            self.segmenter.label(outputs[1], dst=outputs[2], planes=outputs[3:])
+
+    """
+        Blurs, converts and segments one region of a lazy context. The region is read with
+        a margin of the blur radius, so its pixels are the same as in the full frame.
+        Overlapping regions give the same values where they overlap, so all the regions
+        are written to the same buffers.
+        """
+    def _region(self, roi):
+        if roi not in self.regions:
+            x, y, w, h = roi
+            height, width = self.shape
+            x0, y0 = max(0, x - 2), max(0, y - 2)
+            x1, y1 = min(width, x + w + 2), min(height, y + h + 2)
+            margin = (x0, y0, x1 - x0, y1 - y0)
+            blurred = cv2.GaussianBlur(self.frame[y0:y1, x0:x1], (5, 5), 0, dst=self.buffer("region_blur", margin, 3))
+            hsv = cv2.cvtColor(crop(blurred, (x - x0, y - y0, w, h)), cv2.COLOR_BGR2HSV, dst=self.buffer("hsv", roi, 3))
+            labels = None
+            if self.segmenter is not None:
+                planes = [self.buffer(("plane", channel), roi) for channel in range(3)]
+                labels = self.segmenter.label(hsv, dst=self.buffer("labels", roi), planes=planes)
+            self.regions[roi] = (hsv, labels)
+        return self.regions[roi]
+
+    """
+        Records a draw command for the overlay, e.g. ctx.draw("circle", center, 5, (0, 0, 255), -1)
+        for cv2.circle(frame, center, 5, (0, 0, 255), -1). Does nothing in headless mode.
+        """
+    def draw(self, name, *args, **kwargs):
+        if self.overlay is not None:
+            self.overlay.append((name, args, kwargs))
+
+    """
+        Tells for a few pixels whether they are inside a colour range, without thresholding
+        the whole frame: reads the bit of the class in the label image, or tests the HSV
+        values of those pixels only. In lazy mode the pixels come from the raw frame,
+        unblurred.
+
+        Parameters:
+        color_range (tuple): The lower and upper HSV range.
+        points (tuple): The rows and the columns of the pixels, as for numpy indexing.
+
+        Returns:
+        np.array: One boolean per pixel.
+        """
+    def sample(self, color_range, points):
+        key = range_key(color_range)
+        if key in self.masks:
+            return self.masks[key][points] != 0
+        if self.lazy:
+            hsv = cv2.cvtColor(np.ascontiguousarray(self.frame[points]).reshape(-1, 1, 3), cv2.COLOR_BGR2HSV)
+        elif self.labels is not None and self.segmenter.knows(color_range):
+            return (self.labels[points] & self.segmenter.class_bit(color_range)) != 0
+        else:
+            hsv = self.hsv[points].reshape(-1, 1, 3)
+        return cv2.inRange(hsv, color_range[0], color_range[1]).reshape(-1) != 0
+
+    """
+        Returns the mask of the HSV frame for the given colour range. The mask is only
+        computed the first time, later calls with the same range reuse it.
+
+        With a region of interest only the pixels inside it are thresholded, unless the
+        full frame mask was already computed, in which case a view of it is returned.
+
+        Parameters:
+        color_range (tuple): The lower and upper HSV range.
+        roi (tuple): Optional (x, y, w, h) rectangle to restrict the mask to.
+
+        Returns:
+        np.array: The binary mask (0 or 255) for the colour range, of the size of the roi.
+        """
+    def mask(self, color_range, roi=None):
+        key = range_key(color_range)
+        if roi is not None:
+            if key in self.masks:
+                return crop(self.masks[key], roi)
+            key = (key, tuple(roi))
+        if key not in self.masks:
+            if self.lazy and roi is not None:
+                hsv, labels = self._region(tuple(roi))
+            else:
+                if self.lazy:
+                    self._prepare(self.frame)
+                hsv = crop(self.hsv, roi)
+                labels = crop(self.labels, roi) if self.labels is not None else None
+            if labels is not None and self.segmenter.knows(color_range):
+                source = labels
+                stage = lambda rows, core, outputs: self.segmenter.class_mask(rows, color_range, dst=outputs[0])
+            else:
+                source = hsv
+                stage = lambda rows, core, outputs: cv2.inRange(rows, color_range[0], color_range[1], dst=outputs[0])
+            # One buffer per colour range, shared by its regions (same values where they overlap)
+            slot = self.mask_slots.setdefault(key if roi is None else key[0], len(self.mask_slots))
+            if roi is None:
+                self.masks[key] = run_stage(self.executor, stage, source, [self.buffer(("mask", slot))])[0]
+            else:
+                self.masks[key] = stage(source, None, [self.buffer(("mask", slot), roi)])
+        return self.masks[key]
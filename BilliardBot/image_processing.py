@@ -1,5 +1,7 @@
 import cv2
 import numpy as np
+from frame_context import crop
+from tiling import run_stage
 
 
 """
@@ -8,35 +10,37 @@ import numpy as np
     to clean up the mask.
 
     Parameters:
-    frame (np.array): The input image frame in which to detect the background boundary.
+    ctx (FrameContext): The context of the frame in which to detect the background boundary.
+    table_color_range (tuple): The lower and upper HSV range for the table color.
 
     Returns:
     np.array: The largest contour found in the frame representing the background boundary.
     """
-def detect_backgroud_boudary(frame,table_color_range):    
-    
-    # Convert to HSV for better color segmentation
-    hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-
-    # Define range for white color
-    lower_white = table_color_range[0]
-    upper_white = table_color_range[1]
-
+def detect_backgroud_boudary(ctx, table_color_range):    
     # lower_white = np.array([0, 0, 100])
     # upper_white = np.array([179, 40, 255])
 
-    # Create a mask for white color
-    white_mask = cv2.inRange(hsv, lower_white, upper_white)
+    # Create a mask for white color (shared HSV of the context)
+    white_mask = ctx.mask(table_color_range)
     # Apply morphology to clean up the mask
     kernel = np.ones((5, 5), np.uint8)
-    white_mask = cv2.morphologyEx(white_mask, cv2.MORPH_CLOSE, kernel)
-    white_mask = cv2.morphologyEx(white_mask, cv2.MORPH_OPEN, kernel)
+
+    def clean(rows, core, outputs):
+        if core.stop - core.start == rows.shape[0]:
+            closed = cv2.morphologyEx(rows, cv2.MORPH_CLOSE, kernel, dst=ctx.buffer("table_closed"))
+            cv2.morphologyEx(closed, cv2.MORPH_OPEN, kernel, dst=outputs[0])
+        else:
+            closed = cv2.morphologyEx(rows, cv2.MORPH_CLOSE, kernel)
+            outputs[0][:] = cv2.morphologyEx(closed, cv2.MORPH_OPEN, kernel)[core]
+
+    # Close then open with a 5x5 kernel reads 4 x 2 rows on each side of a tile
+    white_mask = run_stage(ctx.executor, clean, white_mask, [ctx.buffer("table_clean")], halo=8)[0]
     # Find contours for the white area
     # cv2.imshow('white_mask', white_mask)
     contours, _ = cv2.findContours(white_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     if contours:
         largest_contour = max(contours, key=cv2.contourArea)
-        cv2.drawContours(frame, [largest_contour], -1, (0, 255, 255), 3) # Yellow contour
+        ctx.draw("drawContours", [largest_contour], -1, (0, 255, 255), 3) # Yellow contour
         return largest_contour
     return None
 
@@ -46,36 +50,56 @@ def detect_backgroud_boudary(frame,table_color_range):
     Detects the largest pink area within a given white boundary in the frame.
     
     Parameters:
-    frame (np.array): The input image frame in which to detect the pink paper.
+    ctx (FrameContext): The context of the frame in which to detect the pink paper.
     white_mask (np.array): The mask representing the white area to constrain the detection.
+    robot_color_range (tuple): The lower and upper HSV range for the pink paper.
+    roi (tuple): Optional (x, y, w, h) rectangle, e.g. the table bounding box, outside of
+                 which nothing is thresholded. The contour is still in frame coordinates.
 
     Returns:
     np.array: The largest contour found representing the pink paper.
     """
-def detect_pink_paper(frame, white_mask, robot_color_range):
-     # Convert to HSV for better color segmentation
-    hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-    # Define range for pink color
-    lower_pink = robot_color_range[0]
-    upper_pink = robot_color_range[1]
-
+def detect_pink_paper(ctx, white_mask, robot_color_range, roi=None):
     # lower_pink = np.array([3, 30, 230])
     # upper_pink = np.array([20, 60, 255])
 
     # Create a mask for pink color
-    pink_mask = cv2.inRange(hsv, lower_pink, upper_pink)
+    pink_mask = ctx.mask(robot_color_range, roi)
     # cv2.imshow('pink_mask', pink_mask)
-    # Apply the white area mask to the pink mask
-    masked_pink = cv2.bitwise_and(pink_mask, pink_mask, mask=white_mask)
+    # Apply the white area mask to the pink mask (both 0 or 255, so a plain AND)
+    masked_pink = cv2.bitwise_and(pink_mask, crop(white_mask, roi), dst=ctx.buffer("pink_paper", roi))
     # cv2.imshow('pink_mask', masked_pink)
 
-    # Find contours of the pink paper
-    contours, _ = cv2.findContours(masked_pink, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    if contours:
-        largest_contour = max(contours, key=cv2.contourArea)
-        cv2.drawContours(frame, [largest_contour], 0, (190, 90, 100), 2)  
-        return largest_contour
-    return None
+    # Contour of the largest pink blob, offset back to frame coordinates
+    offset = roi[:2] if roi is not None else (0, 0)
+    largest_contour = largest_blob_contour(ctx, masked_pink, offset, roi)
+    if largest_contour is not None:
+        ctx.draw("drawContours", [largest_contour], 0, (190, 90, 100), 2)  
+    return largest_contour
+
+
+"""
+    Returns the outer contour of the largest blob of a binary mask, or None if the mask is
+    empty. The blobs are measured with connectedComponentsWithStats and only the largest
+    one is traced, instead of tracing every speck of noise of the mask with findContours.
+
+    Parameters:
+    ctx (FrameContext): The context of the frame, for the buffers.
+    mask (np.array): The binary mask.
+    offset (tuple): (x, y) added to the contour points.
+    roi (tuple): The (x, y, w, h) rectangle of the frame the mask covers, None for the
+                 whole frame.
+    """
+def largest_blob_contour(ctx, mask, offset=(0, 0), roi=None):
+    labels = ctx.buffer("components", roi, dtype=np.int32)
+    count, labels, stats, _ = cv2.connectedComponentsWithStatsWithAlgorithm(mask, 8, cv2.CV_32S, cv2.CCL_BBDT, labels)
+    if count < 2:
+        return None
+    largest = 1 + int(np.argmax(stats[1:, cv2.CC_STAT_AREA]))
+    x, y, w, h = stats[largest, :4]
+    blob = cv2.compare(labels[y:y + h, x:x + w], largest, cv2.CMP_EQ, dst=crop(ctx.buffer("blob", roi), (x, y, w, h)))
+    contours, _ = cv2.findContours(blob, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(offset[0] + x, offset[1] + y))
+    return max(contours, key=len)
 
 
 """
@@ -83,35 +107,37 @@ def detect_pink_paper(frame, white_mask, robot_color_range):
     a mask for the specified color and applies it to the given region mask.
 
     Parameters:
-    frame (np.array): The input image frame in which to detect colored spots.
+    ctx (FrameContext): The context of the frame in which to detect colored spots.
     color_mask (tuple): The lower and upper color range for spot detection.
     region_mask (np.array): The mask representing the region to constrain the detection.
+    roi (tuple): Optional (x, y, w, h) bounding box of the region. Only the pixels inside it
+                 are processed, the contours are returned in frame coordinates.
 
     Returns:
     list: A list of contours representing the detected colored spots.
     """
-def detect_colored_spots(frame, color_mask, region_mask):
-    hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
+def detect_colored_spots(ctx, color_mask, region_mask, roi=None):
     # Create a mask for colored spots
-    colored_spots_mask = cv2.inRange(hsv, color_mask[0], color_mask[1])
+    colored_spots_mask = ctx.mask(color_mask, roi)
     # cv2.imshow('colored_spots_mask', colored_spots_mask)
     # Apply the region mask to the colored spots mask
-    masked_colored_spots = cv2.bitwise_and(colored_spots_mask, colored_spots_mask, mask=region_mask)
+    masked_colored_spots = cv2.bitwise_and(colored_spots_mask, crop(region_mask, roi), dst=ctx.buffer("spots", roi))
     # Find contours of the colored spots
-    contours, _ = cv2.findContours(masked_colored_spots, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    cv2.drawContours(frame, contours, -1, (0, 255, 0), 1)
+    offset = roi[:2] if roi is not None else (0, 0)
+    contours, _ = cv2.findContours(masked_colored_spots, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=offset)
+    ctx.draw("drawContours", contours, -1, (0, 255, 0), 1)
     return contours
 #stupid function
-def detect_colored_spots2(frame, color_mask, region_mask):
-    hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
+def detect_colored_spots2(ctx, color_mask, region_mask, roi=None):
     # Create a mask for colored spots
-    colored_spots_mask = cv2.inRange(hsv, color_mask[0], color_mask[1])
+    colored_spots_mask = ctx.mask(color_mask, roi)
     # cv2.imshow('colored_spots_mask2', colored_spots_mask)
     # Apply the region mask to the colored spots mask
-    masked_colored_spots = cv2.bitwise_and(colored_spots_mask, colored_spots_mask, mask=region_mask)
+    masked_colored_spots = cv2.bitwise_and(colored_spots_mask, crop(region_mask, roi), dst=ctx.buffer("spots", roi))
     # Find contours of the colored spots
-    contours, _ = cv2.findContours(masked_colored_spots, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    cv2.drawContours(frame, contours, -1, (255, 255, 0), 1)
+    offset = roi[:2] if roi is not None else (0, 0)
+    contours, _ = cv2.findContours(masked_colored_spots, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=offset)
+    ctx.draw("drawContours", contours, -1, (255, 255, 0), 1)
     return contours
 
 
@@ -119,30 +145,35 @@ def detect_colored_spots2(frame, color_mask, region_mask):
     Detects balls on a table within a given color range.
 
     Parameters:
-    frame (np.array): The image frame in which to detect the balls.
-    table_contour (np.array): The contour that defines the boundary of the table.
+    ctx (FrameContext): The context of the frame in which to detect the balls.
+    table_mask (np.array): The filled mask of the table contour.
     color_range (tuple): The lower and upper range for the ball color.
     min_contour_area (int): The minimum area threshold for a contour to be considered a ball.
+    roi (tuple): Optional (x, y, w, h) bounding box of the table. Only the pixels inside it
+                 are processed, the ball centers are returned in frame coordinates.
+    backend (str): "components" measures every blob in one connectedComponentsWithStats
+                   call and splits touching balls, "contours" uses findContours and
+                   minEnclosingCircle per contour.
+    ball_area (float): Area of one ball in pixels, used to find touching balls when the
+                       frame has no lone ball to measure it on.
 
     Returns:
     list: A list of tuples, each containing the center coordinates and radius of a detected ball.
     """
-def detect_balls(frame, table_contour, color_range, min_contour_area=100):
-    # Convert the frame to HSV color space
-    hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-
+def detect_balls(ctx, table_mask, color_range, min_contour_area=100, roi=None, backend="components", ball_area=None):
     # Create a mask for the ball color
-    ball_mask = cv2.inRange(hsv, color_range[0], color_range[1])
-
-    # Create a mask from the table contour
-    table_mask = np.zeros_like(frame[:, :, 0])
-    cv2.drawContours(table_mask, [table_contour], -1, 255, -1)
+    ball_mask = ctx.mask(color_range, roi)
 
     # Combine the table mask with the color mask
-    combined_mask = cv2.bitwise_and(ball_mask, ball_mask, mask=table_mask)
+    combined_mask = cv2.bitwise_and(ball_mask, crop(table_mask, roi), dst=ctx.buffer("balls", roi))
+
+    offset = roi[:2] if roi is not None else (0, 0)
+    if backend == "components":
+        return balls_from_components(combined_mask, min_contour_area, offset, ball_area=ball_area,
+                                     labels=ctx.buffer("components", roi, dtype=np.int32))
 
     # Find contours for the balls
-    contours, _ = cv2.findContours(combined_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    contours, _ = cv2.findContours(combined_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=offset)
     
     balls = []
     for contour in contours:
@@ -150,4 +181,168 @@ def detect_balls(frame, table_contour, color_range, min_contour_area=100):
             (x, y), radius = cv2.minEnclosingCircle(contour)
             balls.append(((int(x), int(y)), int(radius)))
     
-    return balls
\ No newline at end of file
+    return balls
+
+
+"""
+    Detects balls only inside small search windows, e.g. around the positions predicted by
+    the ball tracker, instead of the whole table.
+
+    Parameters:
+    ctx (FrameContext): The context of the frame in which to detect the balls.
+    table_mask (np.array): The filled mask of the table contour.
+    color_range (tuple): The lower and upper range for the ball color.
+    windows (list): The (x, y, w, h) search windows.
+    min_contour_area (int): The minimum area threshold for a blob to be considered a ball.
+    ball_area (float): Area of one ball in pixels, see detect_balls.
+
+    Returns:
+    list: A list of ((x, y), radius) tuples in frame coordinates. A ball seen by two
+          overlapping windows is only reported once.
+    """
+def detect_balls_in_windows(ctx, table_mask, color_range, windows, min_contour_area=100, ball_area=None):
+    balls = []
+    for window in windows:
+        for center, radius in detect_balls(ctx, table_mask, color_range, min_contour_area, roi=window, ball_area=ball_area):
+            if all((center[0] - x) ** 2 + (center[1] - y) ** 2 > radius ** 2 for (x, y), _ in balls):
+                balls.append((center, radius))
+    return balls
+
+
+"""
+    Finds the bounding boxes of the ball colored blobs of a (downsampled) frame, the
+    candidates of the coarse-to-fine mode. Touching balls give one box for the group, so
+    the balls are measured whole at full resolution.
+
+    Parameters:
+    ctx (FrameContext): The context of the frame.
+    table_mask (np.array): The filled mask of the table contour.
+    color_range (tuple): The lower and upper range for the ball color.
+    min_area (float): The minimum area of a blob in pixels of this frame.
+    roi (tuple): Optional (x, y, w, h) bounding box of the table.
+
+    Returns:
+    list: The (x, y, w, h) boxes of the blobs in frame coordinates.
+    """
+def ball_candidate_windows(ctx, table_mask, color_range, min_area, roi=None):
+    ball_mask = ctx.mask(color_range, roi)
+    combined_mask = cv2.bitwise_and(ball_mask, crop(table_mask, roi), dst=ctx.buffer("balls", roi))
+    labels = ctx.buffer("components", roi, dtype=np.int32)
+    _, _, stats, _ = cv2.connectedComponentsWithStatsWithAlgorithm(combined_mask, 8, cv2.CV_32S, cv2.CCL_BBDT, labels)
+    stats = stats[1:]
+    stats = stats[stats[:, cv2.CC_STAT_AREA] >= min_area]
+    offset = roi[:2] if roi is not None else (0, 0)
+    return [(int(x) + offset[0], int(y) + offset[1], int(w), int(h)) for x, y, w, h in stats[:, :4]]
+
+
+"""
+    Merges overlapping (x, y, w, h) windows into their bounding boxes until no two windows
+    overlap, so no blob is cut by the edge of a window that overlaps another.
+    """
+def merge_windows(windows):
+    windows = [list(window) for window in windows]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(windows)):
+            for j in range(i + 1, len(windows)):
+                a, b = windows[i], windows[j]
+                if a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and a[1] < b[1] + b[3] and b[1] < a[1] + a[3]:
+                    x0, y0 = min(a[0], b[0]), min(a[1], b[1])
+                    x1, y1 = max(a[0] + a[2], b[0] + b[2]), max(a[1] + a[3], b[1] + b[3])
+                    windows[i] = [x0, y0, x1 - x0, y1 - y0]
+                    del windows[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return [tuple(window) for window in windows]
+
+
+"""
+    Finds the balls of a binary mask with connectedComponentsWithStats, which returns the
+    area and bounding box of every blob in one native call. The blobs are then filtered with
+    numpy instead of a Python loop over contours, which matters on noisy masks with many
+    small blobs.
+
+    Blobs bigger than split_ratio times the area of one ball are touching balls merged
+    together and are split with split_cluster. The area of one ball is the median area of
+    the round blobs of the frame, or ball_area if the frame has none (e.g. only a rack).
+    Single balls never go through the split, so that path stays cheap.
+
+    Parameters:
+    mask (np.array): The binary ball mask.
+    min_area (int): The minimum area in pixels of a ball.
+    offset (tuple): (x, y) added to the centers, e.g. the corner of the region of interest.
+    min_circularity (float): The minimum ratio between the blob area and the area of its
+                             enclosing circle. Rejects thin streaks.
+    split_ratio (float): Area, in balls, above which a blob is split. None to never split.
+    ball_area (float): Area of one ball in pixels when no round blob can be measured.
+    labels (np.array): Optional int32 image of the size of mask to write the component
+                       labels to.
+
+    Returns:
+    list: A list of ((x, y), radius) tuples, like detect_balls.
+    """
+def balls_from_components(mask, min_area=100, offset=(0, 0), min_circularity=0.3, split_ratio=1.6, ball_area=None, labels=None):
+    # The block based algorithm (BBDT) is several times faster than the default one here
+    _, labels, stats, _ = cv2.connectedComponentsWithStatsWithAlgorithm(mask, 8, cv2.CV_32S, cv2.CCL_BBDT, labels)
+    stats = stats[1:]  # label 0 is the background
+    area = stats[:, cv2.CC_STAT_AREA]
+    width = stats[:, cv2.CC_STAT_WIDTH]
+    height = stats[:, cv2.CC_STAT_HEIGHT]
+
+    # Same circle as minEnclosingCircle on the contour of a round blob
+    radius = (np.maximum(width, height) - 1) / 2
+    circularity = area / (np.pi * np.maximum(radius + 0.5, 0.5) ** 2)
+    large = area > min_area
+
+    clusters = np.zeros_like(large)
+    if split_ratio is not None:
+        round_blobs = area[large & (circularity >= 0.7)]
+        if len(round_blobs):
+            ball_area = float(np.median(round_blobs))
+        if ball_area is not None:
+            clusters = large & (area > split_ratio * ball_area)
+
+    keep = large & (circularity >= min_circularity) & ~clusters
+    x = stats[keep, cv2.CC_STAT_LEFT] + (width[keep] - 1) / 2 + offset[0]
+    y = stats[keep, cv2.CC_STAT_TOP] + (height[keep] - 1) / 2 + offset[1]
+    balls = [((int(cx), int(cy)), int(r)) for cx, cy, r in zip(x, y, radius[keep])]
+
+    for index in np.flatnonzero(clusters):
+        left, top, w, h = stats[index, :4]
+        blob = (labels[top:top + h, left:left + w] == index + 1).astype(np.uint8)
+        ball_radius = np.sqrt(ball_area / np.pi)
+        balls.extend(((cx + left + offset[0], cy + top + offset[1]), r)
+                     for (cx, cy), r in split_cluster(blob, ball_radius))
+    return balls
+
+
+"""
+    Splits a blob of touching balls into the individual balls. The distance transform of
+    the blob peaks at the center of every ball, with the ball radius as its value, and drops
+    where two balls touch.
+
+    Parameters:
+    blob (np.array): Binary mask of the blob (nonzero inside).
+    ball_radius (float): Expected radius of one ball in pixels.
+
+    Returns:
+    list: A list of ((x, y), radius) tuples in blob coordinates.
+    """
+def split_cluster(blob, ball_radius):
+    distance = cv2.distanceTransform(blob, cv2.DIST_L2, 5)
+    # A peak is the maximum of its neighbourhood and deep enough to be a ball center
+    size = 2 * int(ball_radius * 0.7) + 1
+    local_max = cv2.dilate(distance, np.ones((size, size), np.uint8))
+    peaks = ((distance >= local_max) & (distance >= 0.6 * ball_radius)).astype(np.uint8)
+
+    # Plateaus give several peak pixels per ball, keep one point per plateau
+    count, _, _, centroids = cv2.connectedComponentsWithStats(peaks, connectivity=8)
+    balls = []
+    for cx, cy in centroids[1:count]:
+        if any((cx - x) ** 2 + (cy - y) ** 2 < ball_radius ** 2 for (x, y), _ in balls):
+            continue
+        balls.append(((cx, cy), distance[int(round(cy)), int(round(cx))]))
+    return [((int(cx), int(cy)), int(r)) for (cx, cy), r in balls]
@@ -1,81 +1,268 @@
 import cv2
 import numpy as np
-import threading
 import time
 # Import other necessary modules
-from image_processing import detect_backgroud_boudary, detect_pink_paper, detect_colored_spots, detect_colored_spots2, detect_balls
+from frame_context import FrameContext, crop, downsample, upscale_contour, scale_roi
+from segmentation import Segmenter
+from table_model import TableModel
+from tracking import BallTracker, PoseTracker
+from calibration import TableCalibration, LensCalibration
+from capture import FrameGrabber
+from overlay import render_overlay
+from scene_gate import SceneGate
+from tiling import TileExecutor
+from buffer_pool import BufferPool
+from image_processing import detect_backgroud_boudary, detect_pink_paper, detect_colored_spots, detect_colored_spots2, detect_balls, detect_balls_in_windows, ball_candidate_windows, merge_windows
 from utility_functions import create_click_event, detect_and_draw_Y_axis, calculate_center, calculate_ball_measurements, annotate_ball_measurements
-from robot_control import send_command, calculate_rotation_steps, calculate_translation_steps, send_strike_command, getCartesianStepsAndSpeed
+from command_channel import robot_channel
+from robot_control import send_command, calculate_rotation_steps, calculate_translation_steps, send_strike_command, getCartesianStepsAndSpeed, polar_program
 from constants import MOTOR_SPEED, LOWER_CENTER, UPPER_CENTER, LOWER_Y_AXIS, UPPER_Y_AXIS, LOWER_BALL, UPPER_BALL, LOWER_TABLE, UPPER_TABLE,LOWER_ROBOT,UPPER_ROBOT , POOL_BALL_DIAMETER
 
-# Initialize camera
-cap = cv2.VideoCapture(0, cv2.CAP_DSHOW)  
-cap.set(cv2.CAP_PROP_AUTOFOCUS, 0)  # Disable autofocus
-cap.set(cv2.CAP_PROP_FRAME_WIDTH, 800)
-cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 800)
+# Lookup tables of the single pass segmentation, rebuilt only when the thresholds change
+segmenter = Segmenter()
+# Table contour and mask cached between frames, detected again only on drift
+table_model = TableModel()
+# Area of one ball in pixels, remembered to split a rack when no lone ball is visible
+ball_area = None
+# Balls keep their ID between frames. Between full searches of the table, balls are only
+# looked for around the positions predicted by the tracker
+ball_tracker = BallTracker()
+FULL_SEARCH_EVERY = 15
+frame_index = 0
+# Filtered robot pose, the markers are looked for around its prediction
+pose_tracker = PoseTracker()
+# Lens distortion of the camera (None until calibration.py has been run on checkerboard
+# images). Only the measured points are undistorted, not the frames
+lens_calibration = LensCalibration.load()
+# Pixel to cm homography of the table, fitted again when the table moves. Only the camera
+# loops save it to disk
+table_calibration = TableCalibration(lens=lens_calibration)
+if not table_calibration.configured:
+    print("Table size not set (TABLE_WIDTH_CM, TABLE_LENGTH_CM in constants.py), distances are scaled by the ball diameter")
+# Reuses the last result while the scene does not change, see scene_gate.metrics()
+scene_gate = SceneGate()
+# Whole frame stages run in tiles on all the cores for frames of 720p and more
+tile_executor = TileExecutor()
+# Images of the pipeline, reused from frame to frame instead of allocated for every frame
+frame_buffers = BufferPool()
 
 
-def get_processed_frame(cap, thresholds):
-    # print(thresholds)
-    global ball_measurements
-    ret, frameOrigin = cap.read()
-    if not ret:
-        print("No frame received")
+"""
+    Finds the pink paper of the robot and the center and Y-axis spots on it.
+
+    Parameters:
+    ctx (FrameContext): The context of the frame.
+    thresholds (list): The ten HSV bounds.
+    table_mask (np.array): The filled mask of the table.
+    roi (tuple): The (x, y, w, h) region in which to look for the paper.
+    coarse (tuple): In coarse-to-fine mode, the context of the downsampled frame, the table
+                    mask at that resolution and the (x, y) ratio between the full and the
+                    downsampled frames. The paper is then found on the downsampled frame,
+                    the spots still at full resolution.
+
+    Returns:
+    tuple: The origin, the Y direction vector (each None if not found) and the size of the
+           paper in pixels (None if the paper was not found).
+    """
+def detect_robot_pose(ctx, thresholds, table_mask, roi, coarse=None):
+    LOWER_ROBOT=thresholds[8]
+    UPPER_ROBOT=thresholds[9]
+    if coarse is None:
+        pink_paper_box = detect_pink_paper(ctx, table_mask, (LOWER_ROBOT, UPPER_ROBOT), roi=roi)
+    else:
+        coarse_ctx, coarse_table_mask, scale = coarse
+        coarse_roi = scale_roi(roi, (1 / scale[0], 1 / scale[1]), 0, coarse_ctx.frame.shape)
+        pink_paper_box = detect_pink_paper(coarse_ctx, coarse_table_mask, (LOWER_ROBOT, UPPER_ROBOT), roi=coarse_roi)
+        if pink_paper_box is not None:
+            pink_paper_box = upscale_contour(pink_paper_box, scale)
+            ctx.draw("drawContours", [pink_paper_box], 0, (190, 90, 100), 2)
+    if pink_paper_box is None:
+        return None, None, None
+
+    # Only the bounding box of the paper is read, only it is cleared
+    paper_roi = cv2.boundingRect(pink_paper_box)
+    pink_paper_mask = ctx.buffer("paper")
+    crop(pink_paper_mask, paper_roi)[:] = 0
+    cv2.drawContours(pink_paper_mask, [pink_paper_box], 0, 255, -1)
+
+    origin = None
+    LOWER_CENTER=thresholds[4]
+    UPPER_CENTER=thresholds[5]
+    center_spot = detect_colored_spots(ctx, (LOWER_CENTER, UPPER_CENTER), pink_paper_mask, roi=paper_roi)
+    if center_spot:
+        origin = calculate_center(center_spot[0])
+        ctx.draw("circle", origin, 5, (0, 0, 255), -1)
+
+    LOWER_Y_AXIS=thresholds[2]
+    UPPER_Y_AXIS=thresholds[3]
+    y_direction = detect_and_draw_Y_axis(ctx, (LOWER_Y_AXIS, UPPER_Y_AXIS), pink_paper_mask, origin, roi=paper_roi)
+    return origin, y_direction, max(paper_roi[2], paper_roi[3])
+
+
+"""
+    Returns the intersection of two (x, y, w, h) rectangles, or None if they do not overlap.
+    """
+def intersect_rois(a, b):
+    x0, y0 = max(a[0], b[0]), max(a[1], b[1])
+    x1, y1 = min(a[0] + a[2], b[0] + b[2]), min(a[1] + a[3], b[1] + b[3])
+    if x1 <= x0 or y1 <= y0:
         return None
-    
-    frame = cv2.GaussianBlur(frameOrigin, (5, 5), 0)
+    return (x0, y0, x1 - x0, y1 - y0)
 
-    LOWER_TABLE=thresholds[6]
-    UPPER_TABLE=thresholds[7]
-    table_contour = detect_backgroud_boudary(frame, (LOWER_TABLE, UPPER_TABLE))
-    if table_contour is not None:
-        table_mask = np.zeros_like(frame[:, :, 0])
-        cv2.drawContours(table_mask, [table_contour], -1, 255, -1)
 
-        LOWER_ROBOT=thresholds[8]
-        UPPER_ROBOT=thresholds[9]
-        pink_paper_box = detect_pink_paper(frame, table_mask, (LOWER_ROBOT, UPPER_ROBOT))
+"""
+    Runs the detection pipeline on one frame without drawing anything on it.
 
-        origin = None
+    Parameters:
+    frameOrigin (np.array): The raw BGR frame.
+    thresholds (list): The ten HSV bounds (ball, Y-axis, center, table, robot).
+    render (bool): Whether to record the draw commands of the overlay. When False nothing
+                   is drawn or recorded (headless mode).
+    track (bool): Whether the frame follows the previous one. When False the robot pose and
+                  the balls of this frame alone are reported, without the trackers (e.g.
+                  unrelated test frames).
+    pyramid (int): Coarse-to-fine mode when > 0: the table, the paper and the ball
+                   candidates are found on the frame downsampled pyramid times by 2, then
+                   the spots and the balls are measured at full resolution, only inside
+                   small windows. 0 processes the whole frame at full resolution.
 
-        if pink_paper_box is not None:
-            pink_paper_mask = np.zeros_like(frame[:, :, 0])
-            cv2.drawContours(pink_paper_mask, [pink_paper_box], 0, 255, -1)
+    Returns:
+    tuple: The blurred frame, the ball measurements (or None) and the list of draw
+           commands (None in headless mode). The blurred frame is a buffer of
+           frame_buffers, overwritten by the next frame.
+    """
+def process_frame(frameOrigin, thresholds, render=True, track=True, pyramid=0):
+    global ball_area, frame_index
+    frame_index += 1
+    # Blur, HSV conversion and segmentation happen once here and are shared by every detector
+    segmenter.update(thresholds)
+    if pyramid:
+        # The full resolution context only processes the windows it is asked for
+        ctx = FrameContext(frameOrigin, segmenter, render, lazy=True, executor=tile_executor, pool=frame_buffers)
+        coarse_ctx = FrameContext(downsample(frameOrigin, pyramid, frame_buffers), segmenter, False, executor=tile_executor, pool=frame_buffers)
+        scale = (frameOrigin.shape[1] / coarse_ctx.frame.shape[1], frameOrigin.shape[0] / coarse_ctx.frame.shape[0])
+    else:
+        ctx = coarse_ctx = FrameContext(frameOrigin, segmenter, render, executor=tile_executor, pool=frame_buffers)
 
-            LOWER_CENTER=thresholds[4]
-            UPPER_CENTER=thresholds[5]
-            center_spot = detect_colored_spots(frame, (LOWER_CENTER, UPPER_CENTER), pink_paper_mask)
-            if center_spot:
-                origin = calculate_center(center_spot[0])
-                cv2.circle(frame, origin, 5, (0, 0, 255), -1)
+    LOWER_TABLE=thresholds[6]
+    UPPER_TABLE=thresholds[7]
+    table_contour = table_model.update(coarse_ctx, (LOWER_TABLE, UPPER_TABLE), frameOrigin.shape)
+    homography = table_calibration.update(table_model)
+    if table_contour is not None:
+        table_mask = table_model.mask
+        coarse = (coarse_ctx, table_model.coarse_mask, scale) if pyramid else None
+        if pyramid:
+            ctx.draw("drawContours", [table_contour], -1, (0, 255, 255), 3) # Yellow contour
 
-            LOWER_Y_AXIS=thresholds[2]
-            UPPER_Y_AXIS=thresholds[3]
-            y_direction = detect_and_draw_Y_axis(frame, (LOWER_Y_AXIS, UPPER_Y_AXIS), pink_paper_mask, origin)
+        # Each stage only looks inside the bounding box of its parent region, and the robot
+        # markers only around the pose predicted from the previous frames
+        pose_window = pose_tracker.search_window(ctx.frame.shape) if track else None
+        if pose_window is not None:
+            pose_window = intersect_rois(pose_window, table_model.roi)
+        origin, y_direction, paper_size = detect_robot_pose(ctx, thresholds, table_mask, pose_window or table_model.roi, coarse)
+        if (origin is None or y_direction is None) and pose_window is not None:
+            origin, y_direction, paper_size = detect_robot_pose(ctx, thresholds, table_mask, table_model.roi, coarse)
+
+        if track:
+            if origin is not None and y_direction is not None:
+                pose_tracker.update(origin, y_direction, paper_size)
+            else:
+                # Short dropout: keep going on the predicted pose
+                pose_tracker.coast()
+            origin, y_direction = pose_tracker.origin_and_y_direction()
 
         if origin is not None and y_direction is not None:
            
             LOWER_BALL=thresholds[0]
             UPPER_BALL=thresholds[1]
-            balls = detect_balls(frame, table_contour, (LOWER_BALL, UPPER_BALL))
+            windows = ball_tracker.search_windows(ctx.frame.shape) if track and frame_index % FULL_SEARCH_EVERY else None
+            if not windows and pyramid:
+                # Ball colored blobs of the downsampled frame, measured at full resolution
+                min_area = 100 / (scale[0] * scale[1]) / 2
+                candidates = ball_candidate_windows(coarse_ctx, table_model.coarse_mask, (LOWER_BALL, UPPER_BALL), min_area, roi=table_model.coarse_roi)
+                margin = int(2 * max(scale)) + 2
+                windows = merge_windows([scale_roi(window, scale, margin, ctx.frame.shape) for window in candidates])
+            if windows or pyramid:
+                balls = detect_balls_in_windows(ctx, table_mask, (LOWER_BALL, UPPER_BALL), windows, ball_area=ball_area)
+            else:
+                balls = detect_balls(ctx, table_mask, (LOWER_BALL, UPPER_BALL), roi=table_model.roi, ball_area=ball_area)
+            if len(balls) >= 3:
+                # The median ignores a cluster that could not be split
+                ball_area = np.pi * np.median([radius for _, radius in balls]) ** 2
+
+            if track:
+                # Smoothed positions of the tracked balls, oldest first
+                ball_tracker.update(balls)
+                balls = ball_tracker.balls()
+
+            ball_measurements = calculate_ball_measurements(balls, origin, y_direction, homography=homography, lens=lens_calibration, frame_size=frameOrigin.shape[1::-1], frame_id=frame_index, timestamp=time.time())
+            annotate_ball_measurements(ctx, ball_measurements, origin)
+
+            return ctx.frame, ball_measurements, ctx.overlay
+
+    return ctx.frame, None, ctx.overlay
+
 
-            ball_measurements = calculate_ball_measurements(frame, balls, origin, y_direction)
-            annotate_ball_measurements(frame, ball_measurements, origin)
+"""
+    Reads a frame from the capture and runs the pipeline on it. With render=True the
+    overlay is drawn on the returned frame for display, with render=False the frame is
+    returned untouched. With undistort=True the displayed frame is also remapped to remove
+    the lens distortion (only when there is a lens calibration).
 
-            return frame,ball_measurements
+    With skip_static=True a frame that looks like the last processed one is not processed:
+    the previous measurements are returned and its overlay is drawn on the new frame.
+    pyramid > 0 runs the coarse-to-fine mode of process_frame.
+
+    Returns:
+    tuple: The frame and the ball measurements (or None), or None if no frame was received.
+    """
+def get_processed_frame(cap, thresholds, render=True, undistort=False, skip_static=True, pyramid=0):
+    # print(thresholds)
+    global ball_measurements
+    ret, frameOrigin = cap.read()
+    if not ret:
+        print("No frame received")
+        return None
+
+    key = (tuple(tuple(np.asarray(threshold).tolist()) for threshold in thresholds), render, pyramid)
+    if not skip_static or scene_gate.check(frameOrigin, key):
+        start = time.perf_counter()
+        frame, ball_measurements, overlay = process_frame(frameOrigin, thresholds, render, pyramid=pyramid)
+        if skip_static:
+            scene_gate.store((ball_measurements, overlay), time.perf_counter() - start)
+    else:
+        ball_measurements, overlay = scene_gate.result
+        frame = frameOrigin
+    if render and frame is frameOrigin:
+        # Drawn on below, the frame may still be in the buffer of the capture
+        frame = frame_buffers.get("display", frameOrigin.shape)
+        np.copyto(frame, frameOrigin)
+    if render:
+        render_overlay(frame, overlay)
+        if undistort and lens_calibration is not None:
+            frame = lens_calibration.undistort_frame(frame, dst=frame_buffers.get("undistorted", frame.shape))
     # cv2.imshow('hold', frame)
 
-    return frame,None
+    return frame,ball_measurements
     
 
 
 if __name__ == "__main__":
 
+    # Initialize camera
+    camera = cv2.VideoCapture(0, cv2.CAP_DSHOW)  
+    camera.set(cv2.CAP_PROP_AUTOFOCUS, 0)  # Disable autofocus
+    camera.set(cv2.CAP_PROP_FRAME_WIDTH, 800)
+    camera.set(cv2.CAP_PROP_FRAME_HEIGHT, 800)
+    cap = FrameGrabber(camera).start()
+
     while True:
-        frame,_ = get_processed_frame(cap=cap, thresholds=[LOWER_BALL, UPPER_BALL, LOWER_Y_AXIS, UPPER_Y_AXIS, LOWER_CENTER, UPPER_CENTER, LOWER_TABLE, UPPER_TABLE,LOWER_ROBOT,UPPER_ROBOT])
-        if frame is None:
+        result = get_processed_frame(cap=cap, thresholds=[LOWER_BALL, UPPER_BALL, LOWER_Y_AXIS, UPPER_Y_AXIS, LOWER_CENTER, UPPER_CENTER, LOWER_TABLE, UPPER_TABLE,LOWER_ROBOT,UPPER_ROBOT])
+        if result is None:
             print("No frame received")
             break
+        frame, _ = result
+        table_calibration.save()
 
         cv2.imshow('Frame', frame)
         cv2.setMouseCallback('Frame', create_click_event(frame))
@@ -92,22 +279,25 @@ if __name__ == "__main__":
             
         #Polar coordinates
         elif key & 0xFF == ord('p'):
-            if 'hold_measurement' in locals():
-                for center, radius, distance, angle, X_coordinate, Y_coordinate in hold_measurement:
-                    print(f"Distance = {distance:.1f} cm, Angle = {angle:.1f} degrees")
+            if 'hold_measurement' in locals() and hold_measurement:
+                for measurement in hold_measurement:
+                    print(f"Distance = {measurement['distance']:.1f} cm, Angle = {measurement['angle']:.1f} degrees")
 
-                rotation_steps = -calculate_rotation_steps(angle)
-                translation_steps = calculate_translation_steps(distance/100)-100
+                # Target the ball tracked the longest, it keeps its place between frames
+                target = hold_measurement[0]
+                distance, angle = float(target["distance"]), float(target["angle"])
+                program = polar_program(angle, distance, MOTOR_SPEED)
 
-                print(f"Rotation Steps: {rotation_steps}, Translation Steps: {translation_steps}")
+                print(f"Rotation and translation: {program}")
 
-                send_command(rotation_steps, MOTOR_SPEED, rotation_steps, MOTOR_SPEED, rotation_steps, MOTOR_SPEED)
-                threading.Thread(target=lambda: (time.sleep(2), send_command(translation_steps, MOTOR_SPEED, 0, MOTOR_SPEED, -translation_steps, MOTOR_SPEED))).start()
+                # Rotation then translation in one request, the ESP32 chains them
+                robot_channel.program(program)
 
         #Cartesian coordinates
         elif key & 0xFF == ord('c'):
-            if 'hold_measurement' in locals():
-                for center, radius, distance, angle, X_coordinate, Y_coordinate in hold_measurement:
+            if 'hold_measurement' in locals() and hold_measurement:
+                for measurement in hold_measurement:
+                    X_coordinate, Y_coordinate = float(measurement["X"]), float(measurement["Y"])
                     print(f"X_coordinate = {X_coordinate:.1f} cm, Y_coordinate = {Y_coordinate:.1f} cm")
                     # send_strike_command(1500) 
                 
@@ -115,5 +305,8 @@ if __name__ == "__main__":
                     # send_command(steps[0], speeds[0], steps[2], speeds[2], steps[1], speeds[1])
 
 
-cap.release()
-cv2.destroyAllWindows()
\ No newline at end of file
+    print(f"Dropped frames: {cap.dropped_frames}")
+    print(f"Static scene gate: {scene_gate.metrics()}")
+    robot_channel.close()
+    cap.release()
+    cv2.destroyAllWindows()
\ No newline at end of file
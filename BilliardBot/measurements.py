@@ -0,0 +1,81 @@
+import struct
+import numpy as np
+
+# One record per ball: image position and radius in pixels, then the distance (cm), the
+# signed angle from the Y-axis (degrees, positive to the right) and the X and Y coordinates
+# (cm) in the frame of the robot
+MEASUREMENT_DTYPE = np.dtype([("x", np.float32), ("y", np.float32), ("radius", np.float32),
+                              ("distance", np.float32), ("angle", np.float32),
+                              ("X", np.float32), ("Y", np.float32)])
+
+# Frame id, timestamp and number of records, before the records in to_bytes()
+HEADER = struct.Struct("<QdI")
+
+
+"""
+    The measurements of the balls of one frame, backed by a NumPy structured array of
+    MEASUREMENT_DTYPE, with the id and the timestamp of the frame.
+
+    Indexing with an int gives one record (fields read with record["angle"]), with a field
+    name the column of all the balls, and with a slice a new batch that is a view of the
+    same records. Boolean masks and index arrays select a copy, e.g.
+    batch[batch["distance"] < 50].
+
+    Parameters:
+    records (np.array): The structured array of the measurements.
+    frame_id (int): Index of the frame the balls were measured in.
+    timestamp (float): Time of the frame in seconds.
+    """
+class MeasurementBatch:
+    __slots__ = ("records", "frame_id", "timestamp")
+
+    def __init__(self, records=None, frame_id=0, timestamp=0.0):
+        self.records = np.empty(0, MEASUREMENT_DTYPE) if records is None else records
+        self.frame_id = frame_id
+        self.timestamp = timestamp
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer, str)):
+            return self.records[index]
+        return MeasurementBatch(self.records[index], self.frame_id, self.timestamp)
+
+    def __repr__(self):
+        return f"MeasurementBatch(frame_id={self.frame_id}, timestamp={self.timestamp:.3f}, balls={len(self)})"
+
+    # Pickled through to_bytes, e.g. in the queues of pipeline.py
+    def __reduce__(self):
+        return (MeasurementBatch.from_bytes, (self.to_bytes(),))
+
+    """
+        Returns the centers of the balls as an (N, 2) array of integer pixel coordinates,
+        for drawing.
+        """
+    def centers(self):
+        return np.rint(np.column_stack((self.records["x"], self.records["y"]))).astype(np.int32)
+
+    """
+        Serialises the batch: a fixed header (frame id, timestamp, number of balls) followed
+        by the raw records, 28 bytes per ball.
+        """
+    def to_bytes(self):
+        return HEADER.pack(self.frame_id, self.timestamp, len(self.records)) + self.records.tobytes()
+
+    """
+        Reads a batch written by to_bytes. The records are a read-only view of the buffer,
+        nothing is copied.
+
+        Parameters:
+        buffer (bytes): The serialised batch, or any buffer containing it.
+        offset (int): Position of the batch in the buffer.
+        """
+    @classmethod
+    def from_bytes(cls, buffer, offset=0):
+        frame_id, timestamp, count = HEADER.unpack_from(buffer, offset)
+        records = np.frombuffer(buffer, MEASUREMENT_DTYPE, count, offset + HEADER.size)
+        return cls(records, frame_id, timestamp)
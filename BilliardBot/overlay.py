@@ -0,0 +1,19 @@
+import cv2
+
+
+"""
+    Applies a list of draw commands to a frame. Each command is a tuple
+    (name, args, kwargs) where name is the OpenCV drawing function (e.g. "circle",
+    "drawContours", "putText") and args/kwargs are what comes after the image argument.
+
+    Parameters:
+    frame (np.array): The image to draw on, modified in place.
+    commands (list): The draw commands recorded by the pipeline.
+
+    Returns:
+    np.array: The same frame, for convenience.
+    """
+def render_overlay(frame, commands):
+    for name, args, kwargs in commands:
+        getattr(cv2, name)(frame, *args, **kwargs)
+    return frame
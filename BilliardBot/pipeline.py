@@ -0,0 +1,260 @@
+import argparse
+import multiprocessing as mp
+import queue
+import time
+import cv2
+import numpy as np
+from multiprocessing import shared_memory
+from constants import LOWER_CENTER, UPPER_CENTER, LOWER_Y_AXIS, UPPER_Y_AXIS, LOWER_BALL, UPPER_BALL, LOWER_TABLE, UPPER_TABLE, LOWER_ROBOT, UPPER_ROBOT
+
+THRESHOLDS = [LOWER_BALL, UPPER_BALL, LOWER_Y_AXIS, UPPER_Y_AXIS, LOWER_CENTER, UPPER_CENTER, LOWER_TABLE, UPPER_TABLE, LOWER_ROBOT, UPPER_ROBOT]
+
+
+"""
+    Opens a frame source from a picklable description, so each worker process can open
+    its own: an int is a camera index, "synthetic" plays synthetic scenes, anything else
+    is a video file path. The source runs for max_frames frames, or until it ends if
+    max_frames is None: the 20 synthetic scenes are then played once, and looped otherwise.
+    """
+def open_source(source, max_frames=None):
+    if source == "synthetic":
+        from synthetic import SyntheticCapture
+        return LimitedCapture(SyntheticCapture(n_frames=20, loop=max_frames is not None), max_frames)
+    if is_camera(source):
+        camera = cv2.VideoCapture(int(source), cv2.CAP_DSHOW)
+        camera.set(cv2.CAP_PROP_AUTOFOCUS, 0)
+        camera.set(cv2.CAP_PROP_FRAME_WIDTH, 800)
+        camera.set(cv2.CAP_PROP_FRAME_HEIGHT, 800)
+        return LimitedCapture(camera, max_frames)
+    return LimitedCapture(cv2.VideoCapture(source), max_frames)
+
+
+def is_camera(source):
+    return isinstance(source, int) or str(source).isdigit()
+
+
+"""
+    Makes main work on a calibration of the table kept in memory, when the source is not the
+    camera: its table is not the real one, and its fits must not replace the saved one.
+    """
+def use_scratch_calibration(source):
+    import main
+    from calibration import TableCalibration
+    from synthetic import SYNTHETIC_TABLE_CM
+    if not is_camera(source):
+        table_size_cm = SYNTHETIC_TABLE_CM if source == "synthetic" else main.table_calibration.table_size_cm
+        main.table_calibration = TableCalibration(path=None, table_size_cm=table_size_cm, lens=main.lens_calibration)
+
+
+"""
+    Wraps a capture so that it ends after max_frames frames (never if max_frames is None).
+    """
+class LimitedCapture:
+    def __init__(self, capture, max_frames=None):
+        self.capture = capture
+        self.max_frames = max_frames
+        self.count = 0
+
+    def read(self):
+        if self.max_frames is not None and self.count >= self.max_frames:
+            return False, None
+        self.count += 1
+        return self.capture.read()
+
+    def release(self):
+        self.capture.release()
+
+
+"""
+    Preallocated frame slots in one shared memory block. Workers pass slot indices through
+    queues and read or write the pixels in place, so frames are never pickled.
+    """
+class SharedFrameSlots:
+    def __init__(self, n_slots, frame_shape, name=None):
+        self.n_slots = n_slots
+        self.frame_shape = tuple(frame_shape)
+        size = n_slots * int(np.prod(self.frame_shape))
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=size)
+        self.frames = np.ndarray((n_slots,) + self.frame_shape, np.uint8, buffer=self.shm.buf)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def close(self):
+        del self.frames
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+"""
+    Capture worker: reads frames into free slots and hands them to perception.
+    With drop_when_busy a frame is dropped when every slot is in use (live camera),
+    otherwise it waits for a slot (files and synthetic sources, so no frame is lost).
+    """
+def capture_worker(source, max_frames, slots_name, n_slots, frame_shape, free_slots, ready, drop_when_busy, stats):
+    slots = SharedFrameSlots(n_slots, frame_shape, slots_name)
+    cap = open_source(source, max_frames)
+    sequence = 0
+    dropped = 0
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        sequence += 1
+        try:
+            slot = free_slots.get(block=not drop_when_busy)
+        except queue.Empty:
+            dropped += 1
+            continue
+        if frame.shape != slots.frame_shape:
+            frame = cv2.resize(frame, (slots.frame_shape[1], slots.frame_shape[0]))
+        slots.frames[slot][:] = frame
+        ready.put((slot, sequence, time.monotonic()))
+    ready.put(None)
+    cap.release()
+    stats.put(("capture", {"frames": sequence, "dropped": dropped}))
+    slots.close()
+
+
+"""
+    Perception worker: runs the detection pipeline on each slot and forwards the slot
+    with the measurements and draw commands to the display worker. The table calibration is
+    only saved for the camera.
+    """
+def perception_worker(source, slots_name, n_slots, frame_shape, thresholds, ready, results, render, stats):
+    import main
+    use_scratch_calibration(source)
+    slots = SharedFrameSlots(n_slots, frame_shape, slots_name)
+    busy = 0.0
+    frames = 0
+    while True:
+        item = ready.get()
+        if item is None:
+            break
+        slot, sequence, timestamp = item
+        start = time.perf_counter()
+        _, ball_measurements, overlay = main.process_frame(slots.frames[slot], thresholds, render)
+        main.table_calibration.save()
+        busy += time.perf_counter() - start
+        frames += 1
+        results.put((slot, sequence, timestamp, ball_measurements, overlay))
+    results.put(None)
+    stats.put(("perception", {"frames": frames, "mean_ms": 1000 * busy / max(frames, 1)}))
+    slots.close()
+
+
+"""
+    Display worker: draws the overlay on the slot and shows it, then gives the slot back
+    to the capture worker. In headless mode it only counts the frames.
+    """
+def display_worker(slots_name, n_slots, frame_shape, results, free_slots, headless, stats):
+    from overlay import render_overlay
+    slots = SharedFrameSlots(n_slots, frame_shape, slots_name)
+    frames = 0
+    latency = 0.0
+    first = last = None
+    while True:
+        item = results.get()
+        if item is None:
+            break
+        slot, sequence, timestamp, ball_measurements, overlay = item
+        if not headless:
+            frame = slots.frames[slot]
+            render_overlay(frame, overlay)
+            cv2.imshow("Frame", frame)
+            cv2.waitKey(1)
+        free_slots.put(slot)
+        last = time.monotonic()
+        first = first or last
+        latency += last - timestamp
+        frames += 1
+    if not headless:
+        cv2.destroyAllWindows()
+    elapsed = (last - first) if frames > 1 else 0.0
+    stats.put(("display", {"frames": frames, "fps": (frames - 1) / elapsed if elapsed else 0.0,
+                           "mean_latency_ms": 1000 * latency / max(frames, 1)}))
+    slots.close()
+
+
+"""
+    Runs capture, perception and display in three processes connected by queues of slot
+    indices. Throughput is bounded by the slowest stage instead of the sum of the stages.
+
+    Parameters:
+    source: Camera index, video file path or "synthetic".
+    thresholds (list): The ten HSV bounds used by the perception worker.
+    n_slots (int): Number of shared frame slots.
+    headless (bool): Skip the overlay and the window in the display worker.
+    max_frames (int): Stop after this many frames (None to run until the source ends).
+
+    Returns:
+    dict: Statistics reported by each worker.
+    """
+def run_pipeline(source, thresholds=THRESHOLDS, n_slots=6, headless=False, max_frames=None):
+    # Read one frame here to size the slots
+    probe = open_source(source, 1)
+    ret, frame = probe.read()
+    probe.release()
+    if not ret:
+        raise RuntimeError(f"No frame received from {source!r}")
+
+    slots = SharedFrameSlots(n_slots, frame.shape)
+    free_slots, ready, results, stats = mp.Queue(), mp.Queue(), mp.Queue(), mp.Queue()
+    for slot in range(n_slots):
+        free_slots.put(slot)
+
+    drop_when_busy = is_camera(source)
+    workers = [
+        mp.Process(target=capture_worker, args=(source, max_frames, slots.name, n_slots, frame.shape, free_slots, ready, drop_when_busy, stats)),
+        mp.Process(target=perception_worker, args=(source, slots.name, n_slots, frame.shape, thresholds, ready, results, not headless, stats)),
+        mp.Process(target=display_worker, args=(slots.name, n_slots, frame.shape, results, free_slots, headless, stats)),
+    ]
+    for worker in workers:
+        worker.start()
+    report = dict(stats.get() for _ in workers)
+    for worker in workers:
+        worker.join()
+    slots.close()
+    return report
+
+
+"""
+    Runs the same work one stage after the other in this process, for comparison.
+    """
+def run_sequential(source, thresholds=THRESHOLDS, max_frames=None):
+    import main
+    use_scratch_calibration(source)
+    cap = open_source(source, max_frames)
+    frames = 0
+    start = time.monotonic()
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        main.process_frame(frame, thresholds, render=False)
+        main.table_calibration.save()
+        frames += 1
+    cap.release()
+    return {"frames": frames, "fps": frames / (time.monotonic() - start)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run capture, perception and display in separate processes")
+    parser.add_argument("--source", default="0", help='camera index, video file or "synthetic"')
+    parser.add_argument("--frames", type=int, default=None, help="stop after this many frames")
+    parser.add_argument("--slots", type=int, default=6)
+    parser.add_argument("--headless", action="store_true")
+    parser.add_argument("--compare", action="store_true", help="also run the sequential loop and compare")
+    args = parser.parse_args()
+
+    source = int(args.source) if args.source.isdigit() else args.source
+    report = run_pipeline(source, n_slots=args.slots, headless=args.headless, max_frames=args.frames)
+    for worker, values in report.items():
+        print(worker, values)
+    if args.compare:
+        sequential = run_sequential(source, max_frames=args.frames)
+        print("sequential", sequential)
+        print(f"speedup: {report['display']['fps'] / sequential['fps']:.2f}x")
@@ -1,40 +1,298 @@
 import requests
+import requests.adapters
 import time
 import numpy as np
 import math
 import numpy.linalg as la
+from udp_protocol import UdpTransport, UDP_PORT, OPCODES, TEXTS
 from constants import esp32_ip, MOTOR_SPEED, RADIUS_ROBOT, WHEEL_RADIUS, STEPS_PER_ROTATION, DISTANCE_PER_STEP
 
+"""
+    Raised by RobotClient when the ESP32 did not answer a request within its deadline, or
+    answered with an error (its HTTP status in status_code).
+    """
+class RobotError(Exception):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+"""
+    Returns value as an int, raises ValueError if it is not a whole number (e.g. 2.5 steps).
+    """
+def whole(value):
+    if value != int(value):
+        raise ValueError(f"{value} is not a whole number")
+    return int(value)
+
+
+"""
+    Ordered list of segments that the ESP32 runs back to back from a single request, e.g.
+    the rotation, the translation and the strike of a shot, instead of one request and one
+    wait per segment.
+
+    The segments are sent as "m:stepsX,speedX,stepsY,speedY,stepsZ,speedZ" for a move of the
+    three motors and "s:chargeDuration" for a strike, separated by ";". Steps and charge
+    durations are whole numbers, read with toInt() by the firmware. Speeds are written in
+    full, without exponent, for toFloat(). The methods return the program, so they can be
+    chained.
+    """
+class MotionProgram:
+    def __init__(self):
+        self.segments = []
+
+    def __len__(self):
+        return len(self.segments)
+
+    def __repr__(self):
+        return f"MotionProgram({self.encode()})"
+
+    def move(self, stepsX, speedX, stepsY, speedY, stepsZ, speedZ):
+        self.segments.append(("m", (whole(stepsX), float(speedX), whole(stepsY), float(speedY), whole(stepsZ), float(speedZ))))
+        return self
+
+    # The three wheels turn the same way
+    def rotation(self, steps, speed=MOTOR_SPEED):
+        return self.move(steps, speed, steps, speed, steps, speed)
+
+    # Wheels X and Z in opposite directions, Y still
+    def translation(self, steps, speed=MOTOR_SPEED):
+        return self.move(steps, speed, 0, speed, -steps, speed)
+
+    def strike(self, chargeDuration):
+        self.segments.append(("s", (whole(chargeDuration),)))
+        return self
+
+    def encode(self):
+        return ";".join(kind + ":" + ",".join(str(value) if isinstance(value, int) else np.format_float_positional(value, trim="-")
+                                              for value in values) for kind, values in self.segments)
+
+    # The segments as separate (endpoint, params) requests, for firmware without /program
+    def requests(self):
+        for kind, values in self.segments:
+            if kind == "m":
+                yield "control", dict(zip(('stepsX', 'speedX', 'stepsY', 'speedY', 'stepsZ', 'speedZ'), values))
+            else:
+                yield "strike", {'chargeDuration': values[0]}
+
+
+"""
+    HTTP client of the ESP32. All the requests go through one requests.Session, so the TCP
+    connection is kept alive and reused instead of opened for every command.
+
+    Every endpoint has its own (connect, read) timeouts, a request never waits longer than
+    that for the ESP32. A request that fails is tried again until its deadline runs out,
+    each attempt only getting the time left. Commands (control, strike) are only retried
+    when the connection failed: after a read timeout the ESP32 may have executed the
+    command already, and sending it again would move the robot twice. Status requests are
+    retried on any failure.
+
+    The end of a move is waited for with a long poll: GET /wait?timeout=ms only answers when
+    the motors stop (or after timeout ms), so the end is seen as soon as it happens, with one
+    request per LONG_POLL_HOLD seconds instead of one per polling period. Firmware without
+    /wait answers 404, the client then falls back to polling /status.
+
+    A MotionProgram is sent in one request to /program, the ESP32 runs its segments one after
+    the other. Firmware without /program answers 404 and programs is set to False, the
+    command channel then sends the segments one by one.
+
+    With transport="udp", control, strike and status go as binary frames over UDP instead
+    (see UdpTransport), with the same answers, and are retransmitted until their deadline:
+    the ESP32 does not execute a retransmitted command twice. The long poll and the programs
+    stay on HTTP.
+
+    Parameters:
+    host (str): Address of the ESP32, with an optional port (e.g. "127.0.0.1:8080").
+    timeouts (dict): (connect, read) timeouts in seconds per endpoint, overriding TIMEOUTS.
+    deadline (float): Default total time budget of a request in seconds, retries included.
+    retry_delay (float): Pause between two attempts in seconds.
+    pool_size (int): Number of connections kept alive, for requests from several threads.
+    transport (str): "http", or "udp" for the binary protocol.
+    udp_port (int): UDP port of the ESP32.
+    """
+class RobotClient:
+    # Longest time a /wait request is held by the ESP32, in seconds
+    LONG_POLL_HOLD = 2.0
+    TIMEOUTS = {"control": (0.5, 1.0), "program": (0.5, 1.0), "status": (0.5, 0.5), "strike": (0.5, 2.0), "wait": (0.5, LONG_POLL_HOLD + 1.0)}
+    IDEMPOTENT = {"status", "wait"}
+
+    def __init__(self, host=esp32_ip, timeouts=None, deadline=2.0, retry_delay=0.05, pool_size=2, transport="http", udp_port=UDP_PORT):
+        self.base_url = f"http://{host}"
+        self.timeouts = dict(self.TIMEOUTS, **(timeouts or {}))
+        self.deadline = deadline
+        self.retry_delay = retry_delay
+        self.session = requests.Session()
+        # Retries are done here, within the deadline, not by urllib3
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.requests = 0
+        self.retries = 0
+        self.long_poll = True
+        self.programs = True
+        if transport not in ("http", "udp"):
+            raise ValueError(f"unknown transport {transport}")
+        self.udp = UdpTransport(host.split(":")[0], udp_port) if transport == "udp" else None
+
+    def close(self):
+        self.session.close()
+        if self.udp is not None:
+            self.udp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    """
+        Sends a GET request to an endpoint of the ESP32 and returns the text of the answer.
+
+        Parameters:
+        endpoint (str): Name of the endpoint, e.g. "control".
+        params (dict): Query parameters.
+        deadline (float): Total time budget in seconds, defaults to self.deadline.
+
+        Returns:
+        str: The text of the answer.
+        """
+    def request(self, endpoint, params=None, deadline=None):
+        budget = self.deadline if deadline is None else deadline
+        if self.udp is not None and endpoint in OPCODES:
+            return self._request_udp(endpoint, params, budget)
+        end = time.monotonic() + budget
+        connect_timeout, read_timeout = self.timeouts[endpoint]
+        url = f"{self.base_url}/{endpoint}"
+        attempt = 0
+        while True:
+            left = end - time.monotonic()
+            if left <= 0:
+                raise RobotError(f"/{endpoint}: no answer within {budget:.2f} s ({attempt} attempts)")
+            attempt += 1
+            self.requests += 1
+            try:
+                response = self.session.get(url, params=params, timeout=(min(connect_timeout, left), min(read_timeout, left)))
+            except requests.ConnectionError as e:
+                # Includes connect timeouts, the request did not reach the ESP32
+                error = e
+            except requests.Timeout as e:
+                if endpoint not in self.IDEMPOTENT:
+                    raise RobotError(f"/{endpoint}: no answer within {min(read_timeout, left):.2f} s, the command may have been executed") from e
+                error = e
+            else:
+                if response.status_code < 500:
+                    if not response.ok:
+                        raise RobotError(f"/{endpoint}: {response.status_code} {response.text}", response.status_code)
+                    return response.text
+                error = RobotError(f"/{endpoint}: {response.status_code} {response.text}", response.status_code)
+            if end - time.monotonic() <= self.retry_delay:
+                raise RobotError(f"/{endpoint}: failed after {attempt} attempts: {error}") from error
+            self.retries += 1
+            time.sleep(self.retry_delay)
+
+    def _request_udp(self, endpoint, params, budget):
+        self.requests += 1
+        try:
+            result = self.udp.exchange(endpoint, params, budget)
+        except (KeyError, ValueError) as e:
+            raise RobotError(f"/{endpoint}: invalid parameters {params}", 400) from e
+        if result is None:
+            raise RobotError(f"/{endpoint}: no UDP answer within {budget:.2f} s")
+        if (OPCODES[endpoint], result) not in TEXTS:
+            raise RobotError(f"/{endpoint}: invalid command (result {result})", 400)
+        return TEXTS[(OPCODES[endpoint], result)]
+
+    """
+        Moves the three motors by the given number of steps at the given speeds (steps per
+        second).
+        """
+    def control(self, stepsX, speedX, stepsY, speedY, stepsZ, speedZ, deadline=None):
+        params = {'stepsX': stepsX, 'speedX': speedX, 'stepsY': stepsY, 'speedY': speedY, 'stepsZ': stepsZ, 'speedZ': speedZ}
+        return self.request("control", params, deadline)
+
+    """
+        Charges the solenoid for chargeDuration milliseconds and fires it.
+        """
+    def strike(self, chargeDuration, deadline=None):
+        return self.request("strike", {'chargeDuration': chargeDuration}, deadline)
+
+    """
+        Sends a MotionProgram, which the ESP32 starts at once. Raises a RobotError with
+        status_code 404 if the firmware has no /program.
+        """
+    def run_program(self, program, deadline=None):
+        try:
+            return self.request("program", {'segments': program.encode()}, deadline)
+        except RobotError as e:
+            if e.status_code == 404:
+                self.programs = False
+            raise
+
+    def status(self, deadline=None):
+        return self.request("status", None, deadline)
+
+    def is_movement_complete(self, deadline=None):
+        return self.status(deadline) == "Movement complete"
+
+    """
+        Waits for the motors to stop with one long poll request, at most hold seconds (one
+        status request without long poll). Returns True if they stopped.
+        """
+    def wait_stopped(self, hold=LONG_POLL_HOLD):
+        if self.long_poll:
+            try:
+                return self.request("wait", {"timeout": int(1000 * hold)}, hold + self.deadline) == "Movement complete"
+            except RobotError as e:
+                if e.status_code != 404:
+                    raise
+                self.long_poll = False
+        return self.is_movement_complete()
+
+    """
+        Waits until the motors stopped. Returns False if they are still moving after
+        timeout seconds (None waits as long as it takes).
+
+        Parameters:
+        timeout (float): Longest wait in seconds.
+        poll_interval (float): Time between two status requests when there is no long poll.
+        """
+    def wait_for_movement(self, timeout=None, poll_interval=0.5):
+        end = None if timeout is None else time.monotonic() + timeout
+        while True:
+            hold = self.LONG_POLL_HOLD if end is None else max(0.0, min(self.LONG_POLL_HOLD, end - time.monotonic()))
+            failed = False
+            try:
+                if self.wait_stopped(hold):
+                    return True
+            except RobotError as e:
+                print(f"Error waiting for the motors: {e}")
+                failed = True
+            # A long poll already waited on the ESP32
+            pause = poll_interval if failed or not self.long_poll else 0.0
+            if end is not None and time.monotonic() + pause >= end:
+                return False
+            time.sleep(pause)
+
+
+# Shared client of the functions below, its connection is reused by every command
+robot = RobotClient()
+
+
 """
     Send a command to the ESP32 to control motor movements.
 """
 def send_command(stepsX, speedX, stepsY, speedY, stepsZ, speedZ):
-    
-    url = f"http://{esp32_ip}/control"
-    params = {
-        'stepsX': stepsX,
-        'speedX': speedX,
-        'stepsY': stepsY,
-        'speedY': speedY,
-        'stepsZ': stepsZ,
-        'speedZ': speedZ
-    }
     try:
-        response = requests.get(url, params=params)
-        print(response.text)
-    except requests.RequestException as e:
+        print(robot.control(stepsX, speedX, stepsY, speedY, stepsZ, speedZ))
+    except RobotError as e:
         print(f"Error sending request: {e}")
 
 
 """
- check_movement_complete() returns True if the ESP32 has finished moving the motors.
+ check_movement_complete() returns True if the ESP32 has finished moving the motors,
+ False if it is still moving after timeout seconds (None to wait as long as it takes).
 """
-def check_movement_complete():
-    while True:
-        response = requests.get(f"http://{esp32_ip}/status")
-        if response.text == "Movement complete":
-            break
-        time.sleep(0.5)  # Poll every half second
+def check_movement_complete(timeout=None):
+    return robot.wait_for_movement(timeout)
 
 
 # def check_movement_complete():
@@ -49,10 +307,10 @@ def check_movement_complete():
     Send a command to trigger the firing sequece of the selenoid.
 """
 def send_strike_command(chargeDuration):
-    url = f"http://{esp32_ip}/strike"
-    params = {'chargeDuration': chargeDuration}
-    response = requests.get(url, params=params)
-    print(response.text)
+    try:
+        print(robot.strike(chargeDuration))
+    except RobotError as e:
+        print(f"Error sending request: {e}")
 
 
 # POLAR MOTION FUNCTIONS
@@ -75,6 +333,26 @@ def calculate_translation_steps(distance):
     return int(distance / DISTANCE_PER_STEP * STEPS_PER_ROTATION)
 
 
+"""
+    Builds the program of a polar shot: turn towards a ball, drive to it and optionally
+    strike it.
+
+    Parameters:
+    angle (float): Angle of the ball from the Y-axis, in degrees.
+    distance (float): Distance of the ball, in cm.
+    speed (float): Speed of the motors, in steps per second.
+    chargeDuration (int): Charge of the strike in milliseconds, None for no strike.
+    """
+def polar_program(angle, distance, speed=MOTOR_SPEED, chargeDuration=None):
+    rotation_steps = -calculate_rotation_steps(angle)
+    # Stops short of the ball
+    translation_steps = calculate_translation_steps(distance / 100) - 100
+    program = MotionProgram().rotation(rotation_steps, speed).translation(translation_steps, speed)
+    if chargeDuration is not None:
+        program.strike(chargeDuration)
+    return program
+
+
 # CARTESIAN MOTION FUNCTIONS
 
 '''
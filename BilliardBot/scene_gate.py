@@ -0,0 +1,105 @@
+import time
+import cv2
+import numpy as np
+
+
+"""
+    Cheap change detector in front of the pipeline. Between shots the table is static, so a
+    frame that looks like the last processed one can reuse its result instead of running
+    blur, segmentation, morphology and contours again.
+
+    Each frame is reduced to a thumbnail (1/scale of the size, bilinear so the camera noise is
+    averaged a little) and compared with the thumbnail of the last processed frame. The
+    frame is processed when enough thumbnail values changed by more than pixel_threshold,
+    when the key (e.g. the thresholds) changed, or every heartbeat frames anyway.
+
+    Parameters:
+    scale (int): Downsampling factor of the thumbnail.
+    pixel_threshold (int): Change of a thumbnail value (0-255) that counts as a change.
+    min_changed (int): Number of changed thumbnail values for the scene to count as changed.
+    heartbeat (int): Maximum number of frames between two processed frames.
+    """
+class SceneGate:
+    def __init__(self, scale=8, pixel_threshold=20, min_changed=2, heartbeat=30):
+        self.scale = scale
+        self.pixel_threshold = pixel_threshold
+        self.min_changed = min_changed
+        self.heartbeat = heartbeat
+        self.reference = None
+        self.key = None
+        self.result = None
+        self.pending = None
+        self.since_processed = 0
+        self.frames = 0
+        self.skipped = 0
+        self.check_time = 0.0
+        self.process_time = 0.0
+
+    def reset(self):
+        self.reference = None
+        self.result = None
+
+    def _thumbnail(self, frame):
+        height, width = frame.shape[:2]
+        size = (max(1, width // self.scale), max(1, height // self.scale))
+        return cv2.resize(frame, size, interpolation=cv2.INTER_LINEAR)
+
+    """
+        Returns True if the frame has to go through the pipeline, False if the result of the
+        last processed frame can be reused (available in self.result).
+
+        Parameters:
+        frame (np.array): The new frame.
+        key: Anything the result depends on besides the frame, compared with ==.
+        """
+    def check(self, frame, key=None):
+        start = time.perf_counter()
+        self.frames += 1
+        thumbnail = self._thumbnail(frame)
+        if (self.reference is None or self.result is None or key != self.key
+                or thumbnail.shape != self.reference.shape
+                or self.since_processed + 1 >= self.heartbeat):
+            changed = True
+        else:
+            difference = cv2.absdiff(thumbnail, self.reference)
+            changed = np.count_nonzero(difference > self.pixel_threshold) >= self.min_changed
+
+        if changed:
+            self.pending = (thumbnail, key)
+        else:
+            self.skipped += 1
+            self.since_processed += 1
+        self.check_time += time.perf_counter() - start
+        return changed
+
+    """
+        Stores the result of a frame that check() sent through the pipeline.
+
+        Parameters:
+        result: What the pipeline returned, handed back for the next static frames.
+        elapsed (float): Time the pipeline took in seconds.
+        """
+    def store(self, result, elapsed):
+        self.reference, self.key = self.pending
+        self.result = result
+        self.since_processed = 0
+        self.process_time += elapsed
+
+    """
+        Returns the skip rate and the CPU time saved by skipping, estimated from the mean
+        time of the processed frames minus the time spent in the checks.
+        """
+    def metrics(self):
+        processed = self.frames - self.skipped
+        mean_process = self.process_time / processed if processed else 0.0
+        saved = self.skipped * mean_process - self.check_time
+        spent = self.process_time + self.check_time
+        return {
+            "frames": self.frames,
+            "skipped": self.skipped,
+            "skip_rate": self.skipped / self.frames if self.frames else 0.0,
+            "mean_process_ms": 1000 * mean_process,
+            "mean_check_ms": 1000 * self.check_time / self.frames if self.frames else 0.0,
+            "cpu_saved_s": saved,
+            "cpu_saved_ratio": saved / (saved + spent) if saved + spent > 0 else 0.0,
+        }
@@ -0,0 +1,96 @@
+import cv2
+import numpy as np
+
+# Order of the classes in the thresholds list (a lower and an upper bound each)
+CLASS_NAMES = ["ball", "y_axis", "center", "table", "robot"]
+
+
+"""
+    Returns a hashable key for an HSV colour range, so ranges given as numpy arrays or
+    lists can be compared and used in dictionaries.
+    """
+def range_key(color_range):
+    return (tuple(np.asarray(color_range[0]).tolist()), tuple(np.asarray(color_range[1]).tolist()))
+
+
+"""
+    Classifies every pixel against all the threshold pairs at once and produces a single
+    uint8 label image where bit i is set if the pixel is inside the range of class i
+    (see CLASS_NAMES). Ranges can overlap, so a pixel can have several bits set.
+
+    The ranges are boxes in HSV space, so the 3-D lookup table (h, s, v) -> label splits
+    into three 1-D tables, one per channel, and the label is the AND of the three lookups.
+    The tables are only rebuilt when the thresholds change.
+    """
+class Segmenter:
+    def __init__(self):
+        self.channel_luts = None
+        self.class_bits = {}
+        self.class_luts = {}
+        self.thresholds_key = None
+
+    """
+        Rebuilds the lookup tables if the thresholds are different from the ones they were
+        built with. Does nothing otherwise, so it is cheap to call on every frame.
+
+        Parameters:
+        thresholds (list): Lower and upper bounds in the order of CLASS_NAMES (ten arrays).
+
+        Returns:
+        bool: True if the tables were rebuilt.
+        """
+    def update(self, thresholds):
+        key = tuple(range_key((thresholds[2 * i], thresholds[2 * i + 1])) for i in range(len(CLASS_NAMES)))
+        if key == self.thresholds_key:
+            return False
+
+        values = np.arange(256)
+        channel_luts = [np.zeros(256, np.uint8) for _ in range(3)]
+        class_bits = {}
+        class_luts = {}
+        for i, (lower, upper) in enumerate(key):
+            bit = 1 << i
+            for channel in range(3):
+                inside = (values >= lower[channel]) & (values <= upper[channel])
+                channel_luts[channel][inside] |= bit
+            # Two classes with the same range share the bit of the first one
+            if (lower, upper) not in class_bits:
+                class_bits[(lower, upper)] = bit
+                # Maps a label value to 255 if the bit of the class is set
+                class_luts[(lower, upper)] = np.where(values & bit, 255, 0).astype(np.uint8)
+
+        self.channel_luts = channel_luts
+        self.class_bits = class_bits
+        self.class_luts = class_luts
+        self.thresholds_key = key
+        return True
+
+    def knows(self, color_range):
+        return range_key(color_range) in self.class_bits
+
+    """
+        Computes the label image of an HSV frame in one lookup pass.
+
+        Parameters:
+        hsv (np.array): The HSV frame.
+        dst (np.array): Optional uint8 image to write the labels to.
+        planes (list): Optional three uint8 images of the size of the frame, used as
+                       temporaries (overwritten).
+
+        Returns:
+        np.array: The uint8 label image, one bit per class.
+        """
+    def label(self, hsv, dst=None, planes=None):
+        h, s, v = cv2.split(hsv, planes)
+        labels = cv2.LUT(h, self.channel_luts[0], dst=dst)
+        cv2.bitwise_and(labels, cv2.LUT(s, self.channel_luts[1], dst=s), dst=labels)
+        return cv2.bitwise_and(labels, cv2.LUT(v, self.channel_luts[2], dst=v), dst=labels)
+
+    def class_bit(self, color_range):
+        return self.class_bits[range_key(color_range)]
+
+    """
+        Extracts the binary mask (0 or 255) of one class from a label image.
+        """
+    def class_mask(self, labels, color_range, dst=None):
+        return cv2.LUT(labels, self.class_luts[range_key(color_range)], dst=dst)
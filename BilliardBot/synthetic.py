@@ -0,0 +1,175 @@
+import math
+import cv2
+import numpy as np
+
+# HSV colors picked inside the default ranges of constants.py
+BACKGROUND_HSV = (20, 120, 60)
+TABLE_HSV = (0, 10, 250)
+PAPER_HSV = (8, 45, 255)
+CENTER_HSV = (0, 50, 60)
+Y_AXIS_HSV = (7, 175, 230)
+BALL_HSV = (120, 200, 80)
+# Size of the synthetic table, width and length in centimeters
+SYNTHETIC_TABLE_CM = (130.0, 130.0)
+
+
+def hsv_to_bgr(hsv):
+    return cv2.cvtColor(np.uint8([[hsv]]), cv2.COLOR_HSV2BGR)[0, 0].tolist()
+
+
+"""
+    Renders a synthetic top view of the table with its ground truth, so the pipeline can be
+    tested and timed without a camera.
+
+    The scene has a white table on a dark background, the pink paper of the robot with the
+    center spot and the Y-axis spot, and blue balls placed at random on the table.
+
+    Parameters:
+    width, height (int): Resolution of the frame.
+    n_balls (int): Number of balls.
+    robot_pose (tuple): (x, y, heading) of the robot. x and y are the center spot in pixels,
+                        heading is the angle of the Y-axis in degrees, 0 pointing up and
+                        positive clockwise. Defaults to the center of the frame, heading 0.
+    noise (float): Standard deviation of the gaussian pixel noise.
+    lighting (float): Strength of a left to right brightness falloff, 0 for even lighting.
+    ball_radius (int): Radius of the balls in pixels.
+    clusters (int): Number of balls placed touching another ball instead of at random.
+    speckles (int): Number of small ball colored dots scattered on the table (mask noise).
+    markers (bool): Draw the center and Y-axis spots. False simulates a frame where they are
+                    not seen (glare, motion blur), the truth still has the real pose.
+    seed (int): Seed of the random generator.
+
+    Returns:
+    tuple: The BGR frame and a dict with the ground truth: table_corners, paper_corners,
+           origin, y_point, y_direction, balls (list of ((x, y), r)) and measurements
+           (list of (distance_cm, angle_degrees, X, Y), the table being SYNTHETIC_TABLE_CM).
+    """
+def render_scene(width=800, height=800, n_balls=5, robot_pose=None, noise=0.0, lighting=0.0,
+                 ball_radius=14, clusters=0, speckles=0, markers=True, seed=None):
+    rng = np.random.default_rng(seed)
+    scale = min(width, height) / 800
+    if robot_pose is None:
+        robot_pose = (width / 2, height / 2, 0.0)
+    ox, oy, heading = robot_pose
+    heading_rad = math.radians(heading)
+    y_unit = np.array([math.sin(heading_rad), -math.cos(heading_rad)])
+    x_unit = np.array([-y_unit[1], y_unit[0]])
+
+    frame = np.empty((height, width, 3), np.uint8)
+    frame[:] = hsv_to_bgr(BACKGROUND_HSV)
+
+    margin_x, margin_y = width // 10, height // 10
+    table_corners = np.array([[margin_x, margin_y], [width - margin_x, margin_y],
+                              [width - margin_x, height - margin_y], [margin_x, height - margin_y]], np.int32)
+    cv2.fillPoly(frame, [table_corners], hsv_to_bgr(TABLE_HSV))
+
+    half_paper = 60 * scale
+    origin = np.array([ox, oy])
+    paper_corners = np.array([origin + sx * half_paper * x_unit + sy * half_paper * y_unit
+                              for sx, sy in ((-1, -1), (1, -1), (1, 1), (-1, 1))]).round().astype(np.int32)
+    cv2.fillPoly(frame, [paper_corners], hsv_to_bgr(PAPER_HSV), lineType=cv2.LINE_AA)
+
+    spot_radius = max(3, int(round(10 * scale)))
+    y_point = origin + 40 * scale * y_unit
+    origin_px = tuple(int(round(v)) for v in origin)
+    y_point_px = tuple(int(round(v)) for v in y_point)
+    if markers:
+        cv2.circle(frame, origin_px, spot_radius, hsv_to_bgr(CENTER_HSV), -1, cv2.LINE_AA)
+        cv2.circle(frame, y_point_px, spot_radius, hsv_to_bgr(Y_AXIS_HSV), -1, cv2.LINE_AA)
+
+    # Place the balls on the table, away from the paper and from each other
+    balls = []
+    keep_out = half_paper * math.sqrt(2) + ball_radius + 4
+    attempts = 0
+    while len(balls) < n_balls and attempts < 10000:
+        attempts += 1
+        if clusters > 0 and balls and len(balls) > n_balls - 1 - clusters:
+            # Touching the previous ball
+            angle = rng.uniform(0, 2 * math.pi)
+            px, py = balls[-1][0]
+            candidate = (px + 2 * ball_radius * math.cos(angle), py + 2 * ball_radius * math.sin(angle))
+        else:
+            candidate = (rng.uniform(margin_x + ball_radius + 4, width - margin_x - ball_radius - 4),
+                         rng.uniform(margin_y + ball_radius + 4, height - margin_y - ball_radius - 4))
+        candidate = (int(round(candidate[0])), int(round(candidate[1])))
+        inside = (margin_x + ball_radius + 4 <= candidate[0] <= width - margin_x - ball_radius - 4
+                  and margin_y + ball_radius + 4 <= candidate[1] <= height - margin_y - ball_radius - 4)
+        if not inside or math.dist(candidate, origin) < keep_out:
+            continue
+        if any(math.dist(candidate, center) < 2 * ball_radius - 1 for center, _ in balls):
+            continue
+        balls.append((candidate, ball_radius))
+
+    ball_color = hsv_to_bgr(BALL_HSV)
+    for center, radius in balls:
+        cv2.circle(frame, center, radius, ball_color, -1, cv2.LINE_AA)
+    for _ in range(speckles):
+        dot = (int(rng.integers(margin_x, width - margin_x)), int(rng.integers(margin_y, height - margin_y)))
+        cv2.circle(frame, dot, int(rng.integers(1, 4)), ball_color, -1)
+
+    if lighting:
+        falloff = 1 - lighting * np.linspace(0, 1, width, dtype=np.float32)
+        frame = (frame * falloff[None, :, None]).astype(np.uint8)
+    if noise:
+        frame = np.clip(frame + rng.normal(0, noise, frame.shape), 0, 255).astype(np.uint8)
+
+    # The camera looks straight down, the table is only scaled to centimeters
+    cm_per_pixel = np.array([SYNTHETIC_TABLE_CM[0] / (width - 2 * margin_x), SYNTHETIC_TABLE_CM[1] / (height - 2 * margin_y)])
+    y_axis_cm = y_unit * cm_per_pixel
+    y_axis_cm /= np.linalg.norm(y_axis_cm)
+    x_axis_cm = np.array([-y_axis_cm[1], y_axis_cm[0]])
+    measurements = []
+    for center, radius in balls:
+        vector = (np.array(center) - origin) * cm_per_pixel
+        X = float(vector @ x_axis_cm)
+        Y = float(vector @ y_axis_cm)
+        measurements.append((math.hypot(X, Y), math.degrees(math.atan2(X, Y)), X, Y))
+
+    truth = {
+        "table_corners": table_corners,
+        "paper_corners": paper_corners,
+        "origin": origin_px,
+        "y_point": y_point_px,
+        "y_direction": (y_point_px[0] - origin_px[0], y_point_px[1] - origin_px[1]),
+        "balls": balls,
+        "measurements": measurements,
+    }
+    return frame, truth
+
+
+"""
+    Capture stand-in that plays synthetic scenes, with the same read()/release() interface
+    as cv2.VideoCapture. A few frames are rendered up front and played in a loop, the robot
+    turning by turn_per_frame degrees between them.
+
+    Parameters:
+    n_frames (int): Number of distinct frames rendered up front.
+    loop (bool): Start again after the last frame instead of returning (False, None).
+    turn_per_frame (float): Heading change of the robot between frames in degrees.
+    **scene: Arguments passed to render_scene.
+    """
+class SyntheticCapture:
+    def __init__(self, n_frames=10, loop=True, turn_per_frame=0.0, **scene):
+        width, height = scene.get("width", 800), scene.get("height", 800)
+        seed = scene.pop("seed", 0)
+        self.frames = []
+        self.truths = []
+        for i in range(n_frames):
+            pose = (width / 2, height / 2, i * turn_per_frame)
+            frame, truth = render_scene(robot_pose=pose, seed=seed + i, **scene)
+            self.frames.append(frame)
+            self.truths.append(truth)
+        self.loop = loop
+        self.index = 0
+
+    def read(self):
+        if self.index >= len(self.frames):
+            if not self.loop:
+                return False, None
+            self.index = 0
+        frame = self.frames[self.index]
+        self.index += 1
+        return True, frame.copy()
+
+    def release(self):
+        pass
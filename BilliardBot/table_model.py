@@ -0,0 +1,119 @@
+import cv2
+import numpy as np
+from image_processing import detect_backgroud_boudary
+from segmentation import range_key
+from frame_context import upscale_contour
+
+
+"""
+    Keeps the table contour and its filled mask between frames. The table almost never
+    moves, so the full detection (threshold, close, open, findContours) only runs every
+    redetect_every frames, when the table thresholds change, or when the cheap drift check
+    fails.
+
+    The drift check tests only the pixels of a ring just inside the cached contour (their
+    table bit in the label image), not a mask of the whole frame. If the table moved, part
+    of that ring is no longer table.
+
+    The table can be detected on a downsampled frame (coarse-to-fine mode): contour, mask and
+    roi are then scaled back to the full frame, and coarse_mask and coarse_roi keep the
+    table at the resolution it was detected at.
+
+    Parameters:
+    redetect_every (int): Number of frames after which the table is detected again anyway.
+    drift_ratio (float): Minimum fraction of ring points that must still be table.
+    inset (int): Distance in pixels between the cached contour and the sampled ring.
+    samples (int): Number of points sampled on the ring.
+    """
+class TableModel:
+    def __init__(self, redetect_every=30, drift_ratio=0.9, inset=6, samples=200):
+        self.redetect_every = redetect_every
+        self.drift_ratio = drift_ratio
+        self.inset = inset
+        self.samples = samples
+        self.contour = None
+        self.mask = None
+        self.roi = None
+        self.coarse_mask = None
+        self.coarse_roi = None
+        self.full_shape = None
+        self.ring = None
+        self.color_key = None
+        self.frames_since_detection = 0
+        self.detections = 0
+
+    def invalidate(self):
+        self.contour = None
+
+    def _build_ring(self):
+        kernel = np.ones((2 * self.inset + 1, 2 * self.inset + 1), np.uint8)
+        inner = cv2.erode(self.coarse_mask, kernel)
+        contours, _ = cv2.findContours(inner, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+        if not contours:
+            self.ring = None
+            return
+        points = max(contours, key=len)[:, 0, :]
+        step = max(1, len(points) // self.samples)
+        points = points[::step]
+        self.ring = (points[:, 1], points[:, 0])
+
+    """
+        Returns True if the table mask of the frame no longer matches the cached contour.
+        """
+    def drifted(self, ctx, table_color_range):
+        if self.ring is None:
+            return True
+        still_table = np.count_nonzero(ctx.sample(table_color_range, self.ring))
+        return still_table < self.drift_ratio * len(self.ring[0])
+
+    """
+        Returns the table contour for the frame, detecting it again only when needed.
+        The filled mask of the contour and its bounding box are available in self.mask
+        and self.roi afterwards.
+
+        Parameters:
+        ctx (FrameContext): The context of the current frame, or of the frame downsampled.
+        table_color_range (tuple): The lower and upper HSV range for the table color.
+        full_shape (tuple): Shape of the full frame when ctx is downsampled.
+
+        Returns:
+        np.array: The table contour in full frame coordinates, or None if no table was found.
+        """
+    def update(self, ctx, table_color_range, full_shape=None):
+        color_key = range_key(table_color_range)
+        full_shape = tuple(full_shape[:2]) if full_shape is not None else ctx.frame.shape[:2]
+        self.frames_since_detection += 1
+        if (self.contour is None or color_key != self.color_key
+                or self.coarse_mask.shape != ctx.frame.shape[:2] or full_shape != self.full_shape
+                or self.frames_since_detection >= self.redetect_every
+                or self.drifted(ctx, table_color_range)):
+            downsampled = full_shape != ctx.frame.shape[:2]
+            contour = detect_backgroud_boudary(ctx, table_color_range)
+            self.color_key = color_key
+            self.full_shape = full_shape
+            self.frames_since_detection = 0
+            self.detections += 1
+            if contour is None:
+                self.contour = None
+                self.mask = None
+                self.ring = None
+                return None
+            if downsampled:
+                # At low resolution a ball close to the cushion cuts into the table, the
+                # table itself is convex
+                contour = cv2.convexHull(contour)
+            self.coarse_mask = np.zeros_like(ctx.frame[:, :, 0])
+            cv2.drawContours(self.coarse_mask, [contour], -1, 255, -1)
+            self.coarse_roi = cv2.boundingRect(contour)
+            if not downsampled:
+                self.contour, self.mask, self.roi = contour, self.coarse_mask, self.coarse_roi
+            else:
+                scale = (full_shape[1] / ctx.frame.shape[1], full_shape[0] / ctx.frame.shape[0])
+                self.contour = upscale_contour(contour, scale)
+                self.mask = np.zeros(full_shape, np.uint8)
+                cv2.drawContours(self.mask, [self.contour], -1, 255, -1)
+                self.roi = cv2.boundingRect(self.contour)
+            self._build_ring()
+        else:
+            ctx.draw("drawContours", [self.contour], -1, (0, 255, 255), 3) # Yellow contour
+        return self.contour
@@ -277,7 +277,8 @@ def setup_robot_control():
     def send_Polar_command():
         global dial3, dial4, slider_distance, X_direction, Y_direction, text2, text4, text5, center_sliders
         if ball_measurements is not None:
-            for center, radius, distance, angle, X_coordinate, Y_coordinate in ball_measurements:
+            for measurement in ball_measurements:
+                distance, angle, X_coordinate, Y_coordinate = (float(measurement[name]) for name in ("distance", "angle", "X", "Y"))
                 print(f"Distance = {distance:.1f} cm, Angle = {angle:.1f} degrees")
 
             rotation_steps = -calculate_rotation_steps(angle)
@@ -360,7 +361,8 @@ def setup_robot_control():
     def send_Cartesian_command():
         global dial3, dial4, slider_distance, X_direction, Y_direction, text2, text4, text5, center_sliders
         if ball_measurements is not None:
-            for center, radius, distance, angle, X_coordinate, Y_coordinate in ball_measurements:
+            for measurement in ball_measurements:
+                distance, angle, X_coordinate, Y_coordinate = (float(measurement[name]) for name in ("distance", "angle", "X", "Y"))
                 print(f"X_coordinate = {X_coordinate:.1f} cm, Y_coordinate = {Y_coordinate:.1f} cm")
                 # send_strike_command(1500)
                 steps , speeds = getCartesianStepsAndSpeed(X_coordinate/100,Y_coordinate/100)
@@ -412,7 +414,8 @@ def update_dial():
     global ball_measurements, switch_var, dial3, slider_distance, text2, text4, text5, X_direction, Y_direction
     if switch_var.get() == "off":
         if ball_measurements is not None:
-            for center, radius, distance, angle, X_coordinate, Y_coordinate in ball_measurements:
+            for measurement in ball_measurements:
+                distance, angle, X_coordinate, Y_coordinate = (float(measurement[name]) for name in ("distance", "angle", "X", "Y"))
                 dial3.set(angle)
                 slider_distance.set(distance)
                 text2.configure(text=f"Distance: {distance:.1f} cm")
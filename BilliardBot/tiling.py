@@ -0,0 +1,86 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+
+
+"""
+    Runs per-pixel stages on horizontal tiles of the frame on a thread pool. OpenCV releases
+    the GIL, so the tiles run on all the cores.
+
+    Each tile is given halo extra rows above and below, so neighbourhood operations (blur,
+    morphology) see the same pixels as on the whole frame, and only its own rows are written
+    to the outputs: the stitched result is exactly the single-thread result, as long as
+    halo is at least the total radius of the operations of the stage.
+
+    Frames smaller than min_pixels, or a pool of one thread, run in one call on the calling
+    thread, the tiles would cost more than they save.
+
+    OpenCV can also parallelise some functions internally (cv2.setNumThreads). Both on the
+    same cores oversubscribe them, so OpenCV is set to one thread (cv2.setNumThreads(1))
+    while a frame runs in tiles, and gets its threads back after it. Frames that are not
+    split keep the threads of OpenCV.
+
+    Parameters:
+    n_threads (int): Number of threads and of tiles, defaults to the number of cores.
+    min_pixels (int): Smallest frame (width x height) that is split into tiles.
+    """
+class TileExecutor:
+    def __init__(self, n_threads=None, min_pixels=1280 * 720):
+        self.n_threads = n_threads or os.cpu_count() or 1
+        self.min_pixels = min_pixels
+        self.pool = ThreadPoolExecutor(self.n_threads, thread_name_prefix="tile") if self.n_threads > 1 else None
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def uses_tiles(self, image):
+        return self.pool is not None and image.shape[0] * image.shape[1] >= self.min_pixels
+
+    """
+        Runs a stage on the image, in tiles when the image is big enough.
+
+        Parameters:
+        stage (function): Called as stage(source, core, outputs): source is the tile with
+                          its halo, core the slice of its own rows in source, outputs the
+                          views of the outputs for those rows, to be written in place.
+        image (np.array): The input image.
+        outputs (list): The preallocated output images, with as many rows as image.
+        halo (int): Number of extra rows given to each tile above and below.
+
+        Returns:
+        list: The outputs.
+        """
+    def run(self, stage, image, outputs, halo=0):
+        if not self.uses_tiles(image):
+            stage(image, slice(0, image.shape[0]), outputs)
+            return outputs
+
+        height = image.shape[0]
+        bounds = np.linspace(0, height, self.n_threads + 1).astype(int)
+
+        def run_tile(top, bottom):
+            start, stop = max(0, top - halo), min(height, bottom + halo)
+            stage(image[start:stop], slice(top - start, bottom - start), [output[top:bottom] for output in outputs])
+
+        opencv_threads = cv2.getNumThreads()
+        cv2.setNumThreads(1)
+        try:
+            futures = [self.pool.submit(run_tile, top, bottom) for top, bottom in zip(bounds[:-1], bounds[1:]) if bottom > top]
+            for future in futures:
+                future.result()
+        finally:
+            cv2.setNumThreads(opencv_threads)
+        return outputs
+
+
+"""
+    Runs a stage with the executor, or in one call when executor is None.
+    """
+def run_stage(executor, stage, image, outputs, halo=0):
+    if executor is None:
+        stage(image, slice(0, image.shape[0]), outputs)
+        return outputs
+    return executor.run(stage, image, outputs, halo)
@@ -0,0 +1,270 @@
+import numpy as np
+
+
+"""
+    One tracked ball: a constant velocity Kalman filter on the center (x, y, vx, vy) and an
+    exponentially smoothed radius. Velocities are in pixels per frame.
+    """
+class BallTrack:
+    def __init__(self, track_id, center, radius, position_noise, measurement_noise):
+        self.id = track_id
+        self.state = np.array([center[0], center[1], 0.0, 0.0])
+        self.covariance = np.diag([measurement_noise, measurement_noise, 100.0, 100.0])
+        self.radius = float(radius)
+        self.hits = 1
+        self.misses = 0
+        self.process_noise = position_noise
+        self.measurement_noise = measurement_noise
+
+    @property
+    def center(self):
+        return (self.state[0], self.state[1])
+
+    @property
+    def velocity(self):
+        return (self.state[2], self.state[3])
+
+    def predict(self, dt=1.0):
+        transition = np.array([[1, 0, dt, 0], [0, 1, 0, dt], [0, 0, 1, 0], [0, 0, 0, 1]], float)
+        # Random acceleration model
+        q = self.process_noise
+        noise = q * np.array([[dt ** 4 / 4, 0, dt ** 3 / 2, 0], [0, dt ** 4 / 4, 0, dt ** 3 / 2],
+                              [dt ** 3 / 2, 0, dt ** 2, 0], [0, dt ** 3 / 2, 0, dt ** 2]])
+        self.state = transition @ self.state
+        self.covariance = transition @ self.covariance @ transition.T + noise
+
+    def correct(self, center, radius, radius_smoothing):
+        observation = np.array([[1, 0, 0, 0], [0, 1, 0, 0]], float)
+        innovation = np.asarray(center, float) - observation @ self.state
+        innovation_covariance = observation @ self.covariance @ observation.T + self.measurement_noise * np.eye(2)
+        gain = self.covariance @ observation.T @ np.linalg.inv(innovation_covariance)
+        self.state = self.state + gain @ innovation
+        self.covariance = (np.eye(4) - gain @ observation) @ self.covariance
+        self.radius += radius_smoothing * (radius - self.radius)
+        self.hits += 1
+        self.misses = 0
+
+
+"""
+    Multi-target ball tracker. Gives every ball a stable ID across frames, smooths its
+    position and radius and estimates its velocity.
+
+    Detections are associated with the predicted tracks greedily: all track/detection pairs
+    closer than the gate are taken in order of increasing distance, each track and each
+    detection being used at most once. Unmatched detections start new tracks, tracks that
+    are not seen for max_misses frames are removed.
+
+    Parameters:
+    gate (float): Maximum distance in pixels between a prediction and its detection.
+    min_hits (int): Number of detections before a track is reported.
+    max_misses (int): Number of frames a track survives without detection.
+    position_noise (float): Process noise of the Kalman filter (acceleration variance).
+    measurement_noise (float): Variance of the detected center in pixels^2.
+    radius_smoothing (float): Weight of a new radius in the smoothed radius.
+    """
+class BallTracker:
+    def __init__(self, gate=30.0, min_hits=2, max_misses=5, position_noise=1.0, measurement_noise=2.0, radius_smoothing=0.3):
+        self.gate = gate
+        self.min_hits = min_hits
+        self.max_misses = max_misses
+        self.position_noise = position_noise
+        self.measurement_noise = measurement_noise
+        self.radius_smoothing = radius_smoothing
+        self.tracks = []
+        self.next_id = 1
+
+    """
+        Advances the tracks by one frame and associates them with the new detections.
+
+        Parameters:
+        balls (list): The detections of the frame as ((x, y), radius) tuples.
+        dt (float): Time since the previous frame, in frames.
+
+        Returns:
+        list: The confirmed tracks, oldest ID first.
+        """
+    def update(self, balls, dt=1.0):
+        for track in self.tracks:
+            track.predict(dt)
+
+        pairs = []
+        if self.tracks and balls:
+            predicted = np.array([track.center for track in self.tracks])
+            detected = np.array([center for center, _ in balls], float)
+            distances = np.linalg.norm(predicted[:, None, :] - detected[None, :, :], axis=2)
+            close = np.argwhere(distances < self.gate)
+            pairs = sorted(close.tolist(), key=lambda pair: distances[pair[0], pair[1]])
+
+        used_tracks = set()
+        used_balls = set()
+        for track_index, ball_index in pairs:
+            if track_index in used_tracks or ball_index in used_balls:
+                continue
+            used_tracks.add(track_index)
+            used_balls.add(ball_index)
+            center, radius = balls[ball_index]
+            self.tracks[track_index].correct(center, radius, self.radius_smoothing)
+
+        for track_index, track in enumerate(self.tracks):
+            if track_index not in used_tracks:
+                track.misses += 1
+        self.tracks = [track for track in self.tracks if track.misses <= self.max_misses]
+
+        for ball_index, (center, radius) in enumerate(balls):
+            if ball_index not in used_balls:
+                self.tracks.append(BallTrack(self.next_id, center, radius, self.position_noise, self.measurement_noise))
+                self.next_id += 1
+
+        return self.confirmed()
+
+    def confirmed(self):
+        return [track for track in self.tracks if track.hits >= self.min_hits]
+
+    """
+        Returns the tracked balls as ((x, y), radius) tuples with integer values, like the
+        output of detect_balls, oldest ID first. Tracks that were missed in the last frame
+        are reported at their predicted position.
+        """
+    def balls(self):
+        return [((int(round(track.state[0])), int(round(track.state[1]))), int(round(track.radius)))
+                for track in self.confirmed()]
+
+    """
+        Returns a search window (x, y, w, h) around the predicted position of every confirmed
+        track, clipped to the frame, so detection can run in small windows instead of the full
+        frame. Returns None if there is nothing to track yet.
+
+        Parameters:
+        frame_shape (tuple): Shape of the frame.
+        margin (float): Extra space around the ball, in ball radii.
+        """
+    def search_windows(self, frame_shape, margin=2.0):
+        tracks = self.confirmed()
+        if not tracks:
+            return None
+        height, width = frame_shape[:2]
+        windows = []
+        for track in tracks:
+            # The window grows with the uncertainty of the prediction
+            spread = np.sqrt(max(track.covariance[0, 0], track.covariance[1, 1]))
+            half = int(np.ceil(track.radius * (1 + margin) + 3 * spread))
+            x0 = max(0, int(track.state[0]) - half)
+            y0 = max(0, int(track.state[1]) - half)
+            x1 = min(width, int(track.state[0]) + half + 1)
+            y1 = min(height, int(track.state[1]) + half + 1)
+            if x1 > x0 and y1 > y0:
+                windows.append((x0, y0, x1 - x0, y1 - y0))
+        return windows
+
+
+"""
+    Tracks the pose of the robot: the origin (center spot) and the heading of the Y-axis,
+    with an alpha-beta filter that also estimates their rates, so the next pose can be
+    predicted while the robot moves.
+
+    When the markers are not found in a frame, the tracker coasts on its prediction for up
+    to max_coast frames, so a short dropout does not stop the measurements. After a longer
+    dropout the old pose and rates mean nothing, the next measurement starts a new track.
+
+    Parameters:
+    alpha (float): Weight of a new measurement in the position and heading.
+    beta (float): Weight of a new measurement in the rates.
+    max_coast (int): Number of frames the pose is predicted without a measurement.
+    """
+class PoseTracker:
+    def __init__(self, alpha=0.6, beta=0.2, max_coast=5):
+        self.alpha = alpha
+        self.beta = beta
+        self.max_coast = max_coast
+        self.pose = None  # x, y, heading in radians
+        self.rate = np.zeros(3)
+        self.y_length = None
+        self.paper_size = None
+        self.misses = 0
+
+    def reset(self):
+        self.pose = None
+        self.rate = np.zeros(3)
+        self.misses = 0
+
+    """
+        Returns the predicted pose for the next frame as (x, y, heading), or None when the
+        pose is unknown or has been coasting for too long.
+        """
+    def predict(self):
+        if self.pose is None or self.misses > self.max_coast:
+            return None
+        return self.pose + self.rate
+
+    """
+        Returns the search window (x, y, w, h) around the predicted origin that contains the
+        whole paper, clipped to the frame, or None if there is no prediction.
+        """
+    def search_window(self, frame_shape, margin=1.5):
+        predicted = self.predict()
+        if predicted is None or self.paper_size is None:
+            return None
+        height, width = frame_shape[:2]
+        # Grows with the speed of the robot and while coasting
+        half = int(self.paper_size * margin + np.hypot(self.rate[0], self.rate[1]) * (1 + self.misses))
+        x0 = max(0, int(predicted[0]) - half)
+        y0 = max(0, int(predicted[1]) - half)
+        x1 = min(width, int(predicted[0]) + half + 1)
+        y1 = min(height, int(predicted[1]) + half + 1)
+        if x1 <= x0 or y1 <= y0:
+            return None
+        return (x0, y0, x1 - x0, y1 - y0)
+
+    """
+        Corrects the pose with the markers found in the frame.
+
+        Parameters:
+        origin (tuple): The (x, y) coordinates of the center spot.
+        y_direction (tuple): The vector from the center spot to the Y-axis spot.
+        paper_size (float): Size in pixels of the paper (largest side of its bounding box).
+        """
+    def update(self, origin, y_direction, paper_size=None):
+        measured = np.array([origin[0], origin[1], np.arctan2(y_direction[1], y_direction[0])], float)
+        length = float(np.hypot(y_direction[0], y_direction[1]))
+        if paper_size is not None:
+            self.paper_size = paper_size
+        if self.pose is None or self.misses > self.max_coast:
+            self.pose = measured
+            self.rate = np.zeros(3)
+            self.y_length = length
+            self.misses = 0
+            return
+        predicted = self.pose + self.rate
+        residual = measured - predicted
+        # Shortest way around the circle for the heading
+        residual[2] = (residual[2] + np.pi) % (2 * np.pi) - np.pi
+        self.pose = predicted + self.alpha * residual
+        self.pose[2] = (self.pose[2] + np.pi) % (2 * np.pi) - np.pi
+        self.rate = self.rate + self.beta * residual
+        self.y_length += self.alpha * (length - self.y_length)
+        self.misses = 0
+
+    """
+        Moves the pose to its prediction for a frame without markers.
+        Returns False when the tracker has been coasting for too long.
+        """
+    def coast(self):
+        if self.pose is None:
+            return False
+        self.misses += 1
+        if self.misses > self.max_coast:
+            return False
+        self.pose = self.pose + self.rate
+        return True
+
+    """
+        Returns the current pose as (origin, y_direction) with integer pixel values, like the
+        output of the marker detection, or (None, None) if the pose is unknown.
+        """
+    def origin_and_y_direction(self):
+        if self.pose is None or self.misses > self.max_coast:
+            return None, None
+        x, y, heading = self.pose
+        origin = (int(round(x)), int(round(y)))
+        y_direction = (int(round(self.y_length * np.cos(heading))), int(round(self.y_length * np.sin(heading))))
+        return origin, y_direction
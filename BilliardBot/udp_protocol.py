@@ -0,0 +1,170 @@
+import random
+import socket
+import struct
+import threading
+import time
+
+# Port of the UDP command server of the ESP32
+UDP_PORT = 4210
+
+# Command: sequence number, opcode, steps of X, Y and Z (int32), speeds of X, Y and Z (float32)
+COMMAND = struct.Struct("<IB3i3f")
+# Answer: sequence number of the command, opcode of the command, result
+ANSWER = struct.Struct("<IBB")
+
+# Opcodes
+CONTROL = 1
+STRIKE = 2
+STATUS = 3
+
+# Results
+OK = 0
+MOVING = 1
+COMPLETE = 2
+INVALID = 3
+
+OPCODES = {"control": CONTROL, "strike": STRIKE, "status": STATUS}
+ENDPOINTS = {opcode: endpoint for endpoint, opcode in OPCODES.items()}
+CONTROL_PARAMS = ("stepsX", "speedX", "stepsY", "speedY", "stepsZ", "speedZ")
+
+# Texts of the HTTP server for the results, so that both transports give the same answers
+TEXTS = {
+    (CONTROL, OK): "Motors commanded successfully",
+    (STRIKE, OK): "Strike fired",
+    (STATUS, MOVING): "Moving",
+    (STATUS, COMPLETE): "Movement complete",
+}
+RESULTS = {text: result for (opcode, result), text in TEXTS.items()}
+
+
+"""
+    Packs a request of the HTTP API (endpoint and query parameters) into a command frame.
+    A strike carries its chargeDuration in the steps of X. Raises KeyError or ValueError if
+    the endpoint has no opcode or the parameters are missing.
+    """
+def encode_command(sequence, endpoint, params=None):
+    params = params or {}
+    opcode = OPCODES[endpoint]
+    steps, speeds = [0, 0, 0], [0.0, 0.0, 0.0]
+    if opcode == CONTROL:
+        steps = [int(float(params[name])) for name in CONTROL_PARAMS[::2]]
+        speeds = [float(params[name]) for name in CONTROL_PARAMS[1::2]]
+    elif opcode == STRIKE:
+        steps[0] = int(float(params['chargeDuration']))
+    return COMMAND.pack(sequence, opcode, *steps, *speeds)
+
+
+"""
+    Unpacks a command frame into (sequence, endpoint, params), the request of the HTTP API
+    it stands for. Returns None if the frame is malformed.
+    """
+def decode_command(data):
+    if len(data) != COMMAND.size:
+        return None
+    sequence, opcode, *values = COMMAND.unpack(data)
+    endpoint = ENDPOINTS.get(opcode)
+    if endpoint is None:
+        return None
+    steps, speeds = values[:3], values[3:]
+    params = {}
+    if opcode == CONTROL:
+        for name, step, speed in zip(CONTROL_PARAMS[::2], steps, speeds):
+            params[name] = step
+            params[name.replace("steps", "speed")] = speed
+    elif opcode == STRIKE:
+        params['chargeDuration'] = steps[0]
+    return sequence, endpoint, params
+
+
+"""
+    Binary command transport to the ESP32 over UDP, for commands at a high rate (jogging,
+    closed-loop corrections) where an HTTP request, its headers and the parsing of its query
+    string cost more than the command itself.
+
+    A command is a COMMAND frame of 29 bytes, answered by an ANSWER frame of 6 bytes with the
+    same sequence number. A command that is not answered within retransmit_timeout seconds
+    is sent again with the same sequence number, until its deadline. The ESP32 keeps the
+    answers of the last commands and sends them back for a repeated sequence number without
+    executing the command again, so retransmitting a move cannot move the robot twice.
+    Sequence numbers start at a random value, so that they do not collide with those of a
+    previous run that the ESP32 still remembers.
+
+    One command is in flight at a time, commands from several threads wait for each other.
+    Answers arriving after their command was given up are dropped.
+
+    Parameters:
+    host (str): Address of the ESP32.
+    port (int): UDP port of the ESP32.
+    retransmit_timeout (float): Time to wait for an answer before sending again, in seconds.
+
+    Attributes:
+    commands (int): Number of commands sent.
+    retransmits (int): Number of frames sent again.
+    """
+class UdpTransport:
+    def __init__(self, host, port=UDP_PORT, retransmit_timeout=0.05):
+        self.address = (host, port)
+        self.retransmit_timeout = retransmit_timeout
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Only datagrams from the ESP32 are received
+        self.socket.connect(self.address)
+        self.sequence = random.getrandbits(32)
+        self.lock = threading.Lock()
+        self.commands = 0
+        self.retransmits = 0
+
+    def close(self):
+        self.socket.close()
+
+    """
+        Sends a request of the HTTP API as a command frame and waits for its answer.
+
+        Parameters:
+        endpoint (str): "control", "strike" or "status".
+        params (dict): Query parameters of the request.
+        deadline (float): Longest wait for the answer in seconds, retransmits included.
+
+        Returns:
+        int: The result (OK, MOVING, COMPLETE or INVALID), None if there was no answer
+             within the deadline.
+        """
+    def exchange(self, endpoint, params, deadline):
+        with self.lock:
+            self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+            sequence = self.sequence
+            frame = encode_command(sequence, endpoint, params)
+            self.commands += 1
+            end = time.monotonic() + deadline
+            first = True
+            while time.monotonic() < end:
+                if not first:
+                    self.retransmits += 1
+                first = False
+                try:
+                    self.socket.send(frame)
+                except OSError:
+                    # No route yet, like a WiFi that is reconnecting
+                    pass
+                result = self._receive(sequence, min(end, time.monotonic() + self.retransmit_timeout))
+                if result is not None:
+                    return result
+            return None
+
+    def _receive(self, sequence, until):
+        while True:
+            left = until - time.monotonic()
+            if left <= 0:
+                return None
+            self.socket.settimeout(left)
+            try:
+                data = self.socket.recv(64)
+            except socket.timeout:
+                return None
+            except ConnectionRefusedError:
+                # Nothing listens on the port (yet): wait for the next retransmit
+                time.sleep(max(0.0, until - time.monotonic()))
+                return None
+            if len(data) == ANSWER.size:
+                answer_sequence, _, result = ANSWER.unpack(data)
+                if answer_sequence == sequence:
+                    return result
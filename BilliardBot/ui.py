@@ -2,12 +2,14 @@ import cv2
 import customtkinter as ctk
 from PIL import Image, ImageTk
 import numpy as np
+import main as pipeline
 from main import get_processed_frame
+from capture import FrameGrabber
 from tkdial import Meter, Dial, Jogwheel
 import tkinter as tk
 import time
-import threading
-from robot_control import send_command, calculate_rotation_steps, calculate_translation_steps, send_strike_command, getCartesianStepsAndSpeed, check_movement_complete
+from command_channel import robot_channel, CommandQueueFull
+from robot_control import send_command, calculate_rotation_steps, calculate_translation_steps, send_strike_command, getCartesianStepsAndSpeed, polar_program
 from constants import MOTOR_SPEED, LOWER_CENTER, UPPER_CENTER, LOWER_Y_AXIS, UPPER_Y_AXIS, LOWER_BALL, UPPER_BALL, LOWER_TABLE, UPPER_TABLE,LOWER_ROBOT,UPPER_ROBOT , POOL_BALL_DIAMETER
 
 # Constants
@@ -49,10 +51,12 @@ def initialize_gui():
     ctk.set_appearance_mode("dark")
     ctk.set_default_color_theme("blue")
 
-    cap = cv2.VideoCapture(0, cv2.CAP_DSHOW)
-    cap.set(cv2.CAP_PROP_AUTOFOCUS, 0)
-    cap.set(cv2.CAP_PROP_FRAME_WIDTH, 850)
-    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 700)
+    camera = cv2.VideoCapture(0, cv2.CAP_DSHOW)
+    camera.set(cv2.CAP_PROP_AUTOFOCUS, 0)
+    camera.set(cv2.CAP_PROP_FRAME_WIDTH, 850)
+    camera.set(cv2.CAP_PROP_FRAME_HEIGHT, 700)
+    # Frames are grabbed on a background thread, get_processed_frame takes the newest one
+    cap = FrameGrabber(camera).start()
 
     root = ctk.CTk()
     root.title("Billiard Bot")
@@ -106,9 +110,10 @@ def create_main_frames():
 
 def update_camera_feed():
     global ball_measurements
-    ret, frame = cap.read()
-    if ret:
-        frame, ball_measurements = get_processed_frame(cap, thresholds)
+    result = get_processed_frame(cap, thresholds)
+    if result is not None:
+        frame, ball_measurements = result
+        pipeline.table_calibration.save()
         frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
         img = Image.fromarray(frame)
         imgtk = ImageTk.PhotoImage(image=img)
@@ -271,15 +276,17 @@ def setup_robot_control():
 
     def send_Polar_command():
         global dial3, dial4, slider_distance, X_direction, Y_direction, text2, text4, text5, center_sliders
-        if ball_measurements is not None:
-            for center, radius, distance, angle, X_coordinate, Y_coordinate in ball_measurements:
-                print(f"Distance = {distance:.1f} cm, Angle = {angle:.1f} degrees")
-
-            rotation_steps = -calculate_rotation_steps(angle)
-            translation_steps = calculate_translation_steps(distance/100)-100
-            print(f"Rotation Steps: {rotation_steps}, Translation Steps: {translation_steps}")
-            send_command(rotation_steps, MOTOR_SPEED, rotation_steps, MOTOR_SPEED, rotation_steps, MOTOR_SPEED)
-            threading.Thread(target=lambda: execute_follow_up_command(translation_steps, MOTOR_SPEED)).start()
+        if ball_measurements:
+            for measurement in ball_measurements:
+                print(f"Distance = {measurement['distance']:.1f} cm, Angle = {measurement['angle']:.1f} degrees")
+
+            # Same target as the dial: the ball tracked the longest
+            target = ball_measurements[0]
+            distance, angle = float(target["distance"]), float(target["angle"])
+            program = polar_program(angle, distance, MOTOR_SPEED)
+            print(f"Rotation and translation: {program}")
+            # Rotation then translation in one request, the ESP32 chains them
+            robot_channel.program(program)
 
             # send_command(translation_steps, MOTOR_SPEED, 0, MOTOR_SPEED, -translation_steps, MOTOR_SPEED)
             # sthreading.Thread(target=lambda: (time.sleep(wait_time(angle)), send_command(translation_steps, MOTOR_SPEED, 0, MOTOR_SPEED, -translation_steps, MOTOR_SPEED))).start()
@@ -313,36 +320,44 @@ def setup_robot_control():
 
 
 
+    # Jogs that do not fit in the queue of the channel are dropped, the robot is already
+    # behind the button
+    def queue_jog(stepsX, speedX, stepsY, speedY, stepsZ, speedZ):
+        try:
+            robot_channel.jog(stepsX, speedX, stepsY, speedY, stepsZ, speedZ)
+        except CommandQueueFull:
+            print("Robot busy, jog dropped")
+
     def CW():
         value=sensitivity_entry.get()
         value=-int(value)
         MOTOR_SPEED=dial4.get()
-        send_command(value,MOTOR_SPEED,value,MOTOR_SPEED,value,MOTOR_SPEED)
+        queue_jog(value,MOTOR_SPEED,value,MOTOR_SPEED,value,MOTOR_SPEED)
 
     def CCW():
         value=int(sensitivity_entry.get())
         MOTOR_SPEED=dial4.get()
-        send_command(value,MOTOR_SPEED,value,MOTOR_SPEED,value,MOTOR_SPEED)
+        queue_jog(value,MOTOR_SPEED,value,MOTOR_SPEED,value,MOTOR_SPEED)
     
     def Right():
         value=int(sensitivity_entry.get())
         MOTOR_SPEED=dial4.get()/2
-        send_command(value,MOTOR_SPEED,-value*2,MOTOR_SPEED*2,value,MOTOR_SPEED)
+        queue_jog(value,MOTOR_SPEED,-value*2,MOTOR_SPEED*2,value,MOTOR_SPEED)
 
     def Left():
         value=int(sensitivity_entry.get())
         MOTOR_SPEED=dial4.get()/2
-        send_command(-value,MOTOR_SPEED,value*2,MOTOR_SPEED*2,-value,MOTOR_SPEED)
+        queue_jog(-value,MOTOR_SPEED,value*2,MOTOR_SPEED*2,-value,MOTOR_SPEED)
 
     def Up():
         value=int(sensitivity_entry.get())
         MOTOR_SPEED=dial4.get()
-        send_command(value,MOTOR_SPEED,0,MOTOR_SPEED,-value,MOTOR_SPEED)
+        queue_jog(value,MOTOR_SPEED,0,MOTOR_SPEED,-value,MOTOR_SPEED)
 
     def Down():
         value=int(sensitivity_entry.get())
         MOTOR_SPEED=dial4.get()
-        send_command(-value,MOTOR_SPEED,0,MOTOR_SPEED,value,MOTOR_SPEED)
+        queue_jog(-value,MOTOR_SPEED,0,MOTOR_SPEED,value,MOTOR_SPEED)
     
 
     # Cartesian coordinates section
@@ -354,8 +369,9 @@ def setup_robot_control():
 
     def send_Cartesian_command():
         global dial3, dial4, slider_distance, X_direction, Y_direction, text2, text4, text5, center_sliders
-        if ball_measurements is not None:
-            for center, radius, distance, angle, X_coordinate, Y_coordinate in ball_measurements:
+        if ball_measurements:
+            for measurement in ball_measurements:
+                X_coordinate, Y_coordinate = float(measurement["X"]), float(measurement["Y"])
                 print(f"X_coordinate = {X_coordinate:.1f} cm, Y_coordinate = {Y_coordinate:.1f} cm")
                 # send_strike_command(1500)
                 steps , speeds = getCartesianStepsAndSpeed(X_coordinate/100,Y_coordinate/100)
@@ -406,15 +422,18 @@ def setup_robot_control():
 def update_dial():
     global ball_measurements, switch_var, dial3, slider_distance, text2, text4, text5, X_direction, Y_direction
     if switch_var.get() == "off":
-        if ball_measurements is not None:
-            for center, radius, distance, angle, X_coordinate, Y_coordinate in ball_measurements:
-                dial3.set(angle)
-                slider_distance.set(distance)
-                text2.configure(text=f"Distance: {distance:.1f} cm")
-                text4.configure(text=f"X-direction: {X_coordinate:.1f}")
-                text5.configure(text=f"Y-direction: {Y_coordinate:.1f}")
-                X_direction.set(X_coordinate)
-                Y_direction.set(Y_coordinate)
+        if ball_measurements:
+            # The ball tracked the longest comes first and stays the target between frames
+            target = ball_measurements[0]
+            distance, angle = float(target["distance"]), float(target["angle"])
+            X_coordinate, Y_coordinate = float(target["X"]), float(target["Y"])
+            dial3.set(angle)
+            slider_distance.set(distance)
+            text2.configure(text=f"Distance: {distance:.1f} cm")
+            text4.configure(text=f"X-direction: {X_coordinate:.1f}")
+            text5.configure(text=f"Y-direction: {Y_coordinate:.1f}")
+            X_direction.set(X_coordinate)
+            Y_direction.set(Y_coordinate)
     robot_control_frame.after(100, update_dial)
 
 
@@ -428,6 +447,8 @@ def save_thresholds():
 
 def on_closing():
     save_thresholds()
+    robot_channel.close()
+    cap.release()
     root.destroy()
 
 def wait_time(angle):
@@ -442,12 +463,6 @@ def wait_time(angle):
     if abs(angle)>130 and abs(angle)<=180:
         return 4
 
-def execute_follow_up_command(translation_steps, motor_speed):
-    # Wait for the first command to complete
-    check_movement_complete()
-    # Execute the second command
-    send_command(translation_steps, motor_speed, 0, motor_speed, -translation_steps, motor_speed)
-
 def main():
     initialize_gui()
     create_main_frames()
@@ -1,8 +1,9 @@
 import cv2
 import numpy as np
-import math
 from image_processing import detect_colored_spots2
 from constants import POOL_BALL_DIAMETER
+from measurements import MEASUREMENT_DTYPE, MeasurementBatch
+from calibration import apply_homography
 
 
 """
@@ -39,16 +40,17 @@ def calculate_center(contour):
     Detects the Y-axis spots in the frame within a specified color range and draws the axis.
 
     Parameters:
-    frame (np.array): The input image frame.
+    ctx (FrameContext): The context of the input image frame.
     color_range (tuple): The lower and upper range for the Y-axis color.
     mask (np.array): The mask to constrain the detection area.
     origin (tuple): The (x, y) coordinates of the origin.
+    roi (tuple): Optional (x, y, w, h) bounding box of the mask to restrict the detection to.
 
     Returns:
     tuple: The direction vector of the Y-axis, or None if not detected.
     """
-def detect_and_draw_Y_axis(frame, color_range, mask, origin):
-    Y_axis_spots = detect_colored_spots2(frame, color_range, mask)
+def detect_and_draw_Y_axis(ctx, color_range, mask, origin, roi=None):
+    Y_axis_spots = detect_colored_spots2(ctx, color_range, mask, roi)
     Y_axis_center = None
     y_direction = None
 
@@ -59,7 +61,7 @@ def detect_and_draw_Y_axis(frame, color_range, mask, origin):
             break
 
     if origin is not None and Y_axis_center is not None:
-        draw_axes(frame, origin, Y_axis_center)
+        draw_axes(ctx, origin, Y_axis_center)
 
     return y_direction
 
@@ -69,17 +71,19 @@ def detect_and_draw_Y_axis(frame, color_range, mask, origin):
     The X-axis is drawn perpendicular to the right of Y-axis.
 
     Parameters:
-    frame (np.array): The image frame on which to draw the axes.
+    ctx (FrameContext): The context of the frame, the axes are recorded as draw commands.
     origin (tuple): The (x, y) coordinates of the origin of the axes.
     y_point (tuple): The (x, y) coordinates of a point on the Y-axis.
 
     Returns:
     None
     """
-def draw_axes(frame, origin, y_point):
+def draw_axes(ctx, origin, y_point):
+    if ctx.overlay is None:
+        return
     # Draw Y-axis as an arrow pointing to the yellow spot
-    cv2.arrowedLine(frame, origin, y_point, (0, 255, 0), 2, tipLength=0.2)
-    cv2.putText(frame, 'Y', (y_point[0] + 10, y_point[1]), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 255), 2)
+    ctx.draw("arrowedLine", origin, y_point, (0, 255, 0), 2, tipLength=0.2)
+    ctx.draw("putText", 'Y', (y_point[0] + 10, y_point[1]), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 255), 2)
 
     # Calculate the length of the Y-axis
     y_length = np.sqrt((y_point[0] - origin[0])**2 + (y_point[1] - origin[1])**2)
@@ -96,81 +100,115 @@ def draw_axes(frame, origin, y_point):
     x_point = (origin[0] + x_direction[0], origin[1] + x_direction[1])
 
     # Draw X-axis as an arrow of the same length as the Y-axis
-    cv2.arrowedLine(frame, origin, x_point, (255, 0, 0), 2, tipLength=0.2)
-    cv2.putText(frame, 'X', (x_point[0] - 10, x_point[1] +20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 0), 2)
+    ctx.draw("arrowedLine", origin, x_point, (255, 0, 0), 2, tipLength=0.2)
+    ctx.draw("putText", 'X', (x_point[0] - 10, x_point[1] +20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 0), 2)
 
 
 
 """
-    Calculates the measurements (polar and cartesian coordiantes) of detected balls from the origin.
-    The origin and Y direction are used to establish a coordinate system for measurement.
+    Calculates the measurements (polar and cartesian coordiantes) of many balls at once.
+    The origin and Y direction are used to establish a coordinate system for measurement,
+    the X-axis pointing to the right of the Y-axis.
+
+    With a table homography (see calibration.TableCalibration) the points are mapped to the
+    table in centimeters first. Without it the pixel to cm ratio is guessed from the radius
+    of each ball, which is noisy and wrong for merged blobs.
 
     Parameters:
-    frame (np.array): The image frame for reference.
-    balls (list): A list of tuples containing the center and radius of each detected ball.
+    balls (np.array): An (N, 3) array with the x, y coordinates of the center and the radius of each ball.
     origin (tuple): The (x, y) coordinates of the origin of the coordinate system.
     y_direction (tuple): The Y direction vector for establishing the coordinate system.
     ball_diameter_cm (float): The diameter of the balls in centimeters.
+    homography (np.array): Optional 3x3 homography from the image to the table in centimeters.
+    lens (LensCalibration): Optional lens calibration, the points are undistorted first.
+    frame_size (tuple): Width and height of the frame, needed with a lens calibration.
 
     Returns:
-    list: A list of tuples containing calculated measurements for each ball (polar and cartesian coordiantes).
+    np.array: A structured array of MEASUREMENT_DTYPE with one record per ball.
     """
-def calculate_ball_measurements(frame, balls, origin, y_direction, ball_diameter_cm=POOL_BALL_DIAMETER):
-    ball_data = []
-    y_length = math.sqrt(y_direction[0]**2 + y_direction[1]**2)
-
-    for center, radius in balls:
-        # Draw circle around the ball
-        cv2.circle(frame, center, radius, (255, 255, 0), 2)
-        cv2.line(frame, origin, center, (255, 100, 255), 2)  # Line from origin to ball
-
-        # Calculate distance
-        ball_vector = (center[0] - origin[0], center[1] - origin[1])
-        distance_pixels = math.sqrt(ball_vector[0]**2 + ball_vector[1]**2)
-        pixel_to_cm_ratio = ball_diameter_cm / (2 * radius)
-        distance_cm = distance_pixels * pixel_to_cm_ratio
-
-        # Calculate angle
-        dot_product = ball_vector[0]*y_direction[0] + ball_vector[1]*y_direction[1]
-        if (distance_pixels * y_length) != 0:
-            angle = math.acos(dot_product / (distance_pixels * y_length))
-            angle_degrees = math.degrees(angle)
+def measure_balls(balls, origin, y_direction, ball_diameter_cm=POOL_BALL_DIAMETER, homography=None, lens=None, frame_size=None):
+    balls = np.asarray(balls, np.float64).reshape(-1, 3)
+    # Columns of the plain array are the fields of MEASUREMENT_DTYPE, in order
+    columns = np.empty((len(balls), 7), np.float64)
+    columns[:, :3] = balls
+
+    # Balls, origin and Y-axis point are undistorted and mapped to the table together,
+    # the records keep the image coordinates for drawing
+    points = np.vstack((balls[:, :2], origin, np.add(origin, y_direction)))
+    if lens is not None:
+        points = lens.undistort_points(points, frame_size)
+    if homography is not None:
+        points = apply_homography(homography, points)
+        pixel_to_cm_ratio = 1.0
+    else:
+        # The size of each ball gives the pixel to cm ratio at its position
+        pixel_to_cm_ratio = ball_diameter_cm / (2 * balls[:, 2])
+    vectors = points[:-2] - points[-2]
+    y_axis = points[-1] - points[-2]
+    y_axis = y_axis / np.hypot(y_axis[0], y_axis[1])
+
+    # Coordinates along the X-axis (to the right of Y) and the Y-axis
+    columns[:, 5] = (vectors[:, 1] * y_axis[0] - vectors[:, 0] * y_axis[1]) * pixel_to_cm_ratio
+    columns[:, 6] = (vectors @ y_axis) * pixel_to_cm_ratio
+    np.hypot(columns[:, 5], columns[:, 6], out=columns[:, 3])
+    # atan2 is defined everywhere, a ball on the origin gets an angle of 0
+    np.degrees(np.arctan2(columns[:, 5], columns[:, 6]), out=columns[:, 4])
+    return columns.astype(np.float32).view(MEASUREMENT_DTYPE).reshape(-1)
 
-        # Determine the sign of the angle using the cross product
-        cross_product_z = y_direction[0] * ball_vector[1] - y_direction[1] * ball_vector[0]
-        angle_degrees = -angle_degrees if cross_product_z < 0 else angle_degrees
 
-        #Cartesian coordinates
-        dirX= distance_pixels * pixel_to_cm_ratio * math.sin(angle)
-        dirY= distance_pixels * pixel_to_cm_ratio * math.cos(angle)
-        dirX = -dirX if angle_degrees < 0 else dirX
+"""
+    Calculates the measurements (polar and cartesian coordiantes) of detected balls from the origin.
+    The origin and Y direction are used to establish a coordinate system for measurement.
 
-        # Store the calculated data
-        ball_data.append((center, radius, distance_cm, angle_degrees , dirX, dirY))
+    Parameters:
+    balls (list): A list of tuples containing the center and radius of each detected ball.
+    origin (tuple): The (x, y) coordinates of the origin of the coordinate system.
+    y_direction (tuple): The Y direction vector for establishing the coordinate system.
+    ball_diameter_cm (float): The diameter of the balls in centimeters.
+    homography (np.array): Optional 3x3 homography from the image to the table in centimeters.
+    lens (LensCalibration): Optional lens calibration, the points are undistorted first.
+    frame_size (tuple): Width and height of the frame, needed with a lens calibration.
+    frame_id (int): Index of the frame, stored in the batch.
+    timestamp (float): Time of the frame in seconds, stored in the batch.
 
-    return ball_data
+    Returns:
+    MeasurementBatch: The measurements of the balls (polar and cartesian coordiantes), in the order of balls.
+    """
+def calculate_ball_measurements(balls, origin, y_direction, ball_diameter_cm=POOL_BALL_DIAMETER, homography=None, lens=None, frame_size=None, frame_id=0, timestamp=0.0):
+    array = np.array([(center[0], center[1], radius) for center, radius in balls], np.float64)
+    return MeasurementBatch(measure_balls(array, origin, y_direction, ball_diameter_cm, homography, lens, frame_size), frame_id, timestamp)
 
 
 """ Annotates the frame with measurements of detected balls.
 
     Parameters:
-    frame (np.array): The image frame to draw annotations on.
-    ball_measurements (list): A list of tuples containing ball measurements (center, radius, distance_cm, angle_degrees, X_coordinate, Y_coordinate).
+    ctx (FrameContext): The context of the frame, the annotations are recorded as draw commands.
+    ball_measurements (MeasurementBatch): The measurements of the balls.
     origin (tuple): The (x, y) coordinates of the origin point for measurements.
 
     Returns:
     None
     """
-def annotate_ball_measurements(frame, ball_measurements, origin):
+def annotate_ball_measurements(ctx, ball_measurements, origin):
+    if ctx.overlay is None:
+        return
   
-    for center, radius, distance_cm, angle_degrees, X_coordinate, Y_coordinate in ball_measurements:
+    for center, measurement in zip(ball_measurements.centers().tolist(), ball_measurements):
+        center = tuple(center)
+        radius = int(round(float(measurement["radius"])))
+        distance_cm, angle_degrees = measurement["distance"], measurement["angle"]
+        X_coordinate, Y_coordinate = measurement["X"], measurement["Y"]
+        # Draw circle around the ball
+        ctx.draw("circle", center, radius, (255, 255, 0), 2)
+        ctx.draw("line", origin, center, (255, 100, 255), 2)  # Line from origin to ball
+
         midpoint = ((origin[0] + center[0]) // 2, (origin[1] + center[1]) // 2)
-        cv2.putText(frame, f"{distance_cm:.1f} cm", midpoint, cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 100, 100), 2)
-        cv2.putText(frame, f"{angle_degrees:.1f} degrees", (center[0] - 40, center[1] - 40), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (100, 100, 255), 2)
+        ctx.draw("putText", f"{distance_cm:.1f} cm", midpoint, cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 100, 100), 2)
+        ctx.draw("putText", f"{angle_degrees:.1f} degrees", (center[0] - 40, center[1] - 40), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (100, 100, 255), 2)
         
         # Cartesian coordinates annotation is static and only needs to be drawn once
-        cv2.putText(frame, "Cartesian coordinates:", (50, 460), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (20, 100, 20), 2)
-        cv2.putText(frame, f"   X: {X_coordinate:.1f} cm", (100, 500), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 100, 255), 2)
-        cv2.putText(frame, f"   Y: {Y_coordinate:.1f} cm", (100, 530), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 100, 255), 2)
+        ctx.draw("putText", "Cartesian coordinates:", (50, 460), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (20, 100, 20), 2)
+        ctx.draw("putText", f"   X: {X_coordinate:.1f} cm", (100, 500), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 100, 255), 2)
+        ctx.draw("putText", f"   Y: {Y_coordinate:.1f} cm", (100, 530), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 100, 255), 2)
 
 